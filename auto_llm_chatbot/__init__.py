@@ -1,8 +1,45 @@
-try:
-    from chroma_handler import *
-    from chatbot import *
-    from llm import *
-except:
-    from auto_llm_chatbot.chroma_handler import *
-    from auto_llm_chatbot.chatbot import *
-    from auto_llm_chatbot.llm import *
\ No newline at end of file
+import importlib
+
+# public names of the package and the module which defines them, modules are imported on first access
+# so `import auto_llm_chatbot` does not load chromadb, ollama, openai or numpy
+_exports = {
+    'bulk': ('reembed_memories', 'transfer_memories'),
+    'chatbot': ('AsyncChatStream', 'ChatEngine', 'ChatStream', 'achat', 'achat_many', 'achat_stream', 'chat',
+                'chat_many', 'chat_stream', 'close_engines', 'get_engine'),
+    'chroma_handler': ('QueryRewriteCache', 'acreate_queries', 'aembed_queries', 'arecall', 'aretrieve_embeddings',
+                       'aretrieve_embeddings_try_queries', 'asearch_try_queries', 'collection_count',
+                       'collection_is_empty', 'create_client', 'create_queries', 'embed_once', 'get_rewrite_cache',
+                       'get_rewrite_stats', 'push_msg_to_vector_store', 'push_msgs_to_vector_store', 'query_rewrite_cache',
+                       'query_vector_store', 'recall', 'retrieve_embeddings', 'retrieve_embeddings_try_queries',
+                       'rewrite_skip_reason', 'search_try_queries', 'search_vector_store'),
+    'compaction': ('Compactor', 'compact_session'),
+    'instrumentation': ('CallbackHook', 'MetricsRegistry', 'OpenTelemetryHook', 'add_hook', 'is_verbose', 'remove_hook',
+                        'set_verbose', 'start_turn'),
+    'llm': ('OllamaClient', 'OpenAI'),
+    'memory_assembler': ('assemble_memories',),
+    'memory_backends': ('ChromaBackend', 'MemoryBackend', 'NumpyBackend', 'SharedChromaBackend', 'create_backend'),
+    'models': ('EmbeddingCache', 'arun_embedding', 'ollama_chat', 'openai_chat', 'response_usage', 'run_embedding'),
+    'providers': ('CustomLLM', 'LLMProvider', 'OllamaProvider', 'OpenAIProvider', 'as_provider', 'create_provider',
+                  'register_provider'),
+    'write_behind': ('WriteBehindQueue',),
+}
+_modules = {name: module for module, names in _exports.items() for name in names}
+_submodules = ('bulk', 'chatbot', 'chroma_handler', 'compaction', 'instrumentation', 'llm', 'memory_assembler',
+               'memory_backends', 'migration', 'models', 'providers', 'write_behind')
+
+__all__ = sorted(_modules)
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f'{__name__}.{name}')
+    if name not in _modules:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'{__name__}.{_modules[name]}'), name)
+    # next access does not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,445 @@
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from models import run_embedding, write_settings
+    from providers import create_provider
+    from memory_backends import MemoryBackend, ChromaBackend, SharedChromaBackend, create_backend
+    from memory_backends import get_collection
+    from migration import _session_of
+    from chroma_handler import create_client
+except:
+    from auto_llm_chatbot.models import run_embedding, write_settings
+    from auto_llm_chatbot.providers import create_provider
+    from auto_llm_chatbot.memory_backends import MemoryBackend, ChromaBackend, SharedChromaBackend, create_backend
+    from auto_llm_chatbot.memory_backends import get_collection
+    from auto_llm_chatbot.migration import _session_of
+    from auto_llm_chatbot.chroma_handler import create_client
+
+# a record is one message: collection_name, unique_session_id, unique_message_id, document, metadata, embedding
+# (None when it is not read or not exported) and layout, 'session' or 'shared' for messages read from chroma
+
+
+def _file_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.json'):
+        return 'jsonl'
+    if extension == '.parquet':
+        return 'parquet'
+    raise ValueError(f'Invalid file {path!r}. Supported files are: .jsonl, .parquet')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet files need pyarrow, install it with `pip install pyarrow`')
+    return pyarrow
+
+
+def _record(collection_name, unique_session_id, unique_message_id, document, metadata, embedding, layout = None):
+    metadata = dict(metadata or {})
+    # metadata of messages pushed by the chatbot, files written by hand may not have it
+    metadata.setdefault('collection_name', collection_name)
+    metadata.setdefault('unique_session_id', unique_session_id)
+    metadata.setdefault('unique_message_id', unique_message_id)
+    if embedding is not None:
+        # chroma returns numpy arrays
+        embedding = embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding)
+    return {'collection_name': collection_name, 'unique_session_id': unique_session_id,
+            'unique_message_id': unique_message_id, 'document': document, 'metadata': metadata,
+            'embedding': embedding, 'layout': layout}
+
+
+def _read_jsonl(path, collection_name, batch_size, cursor):
+    # cursor is the number of records already read
+    position = 0
+    page = list()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            position += 1
+            if cursor is not None and position <= cursor:
+                continue
+            item = json.loads(line)
+            if collection_name is not None and item['collection_name'] != collection_name:
+                continue
+            page.append(_record(item['collection_name'], item['unique_session_id'], item['unique_message_id'],
+                                item.get('document'), item.get('metadata'), item.get('embedding')))
+            if len(page) >= batch_size:
+                yield page, position
+                page = list()
+    if page:
+        yield page, position
+
+
+def _read_parquet(path, collection_name, batch_size, cursor):
+    pyarrow = _import_pyarrow()
+    position = 0
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+        rows = batch.to_pylist()
+        start = position
+        position += len(rows)
+        if cursor is not None and position <= cursor:
+            continue
+        if cursor is not None and start < cursor:
+            rows = rows[cursor - start:]
+        page = [_record(row['collection_name'], row['unique_session_id'], row['unique_message_id'],
+                        row.get('document'), json.loads(row['metadata']) if row.get('metadata') else None,
+                        row.get('embedding'))
+                for row in rows if collection_name is None or row['collection_name'] == collection_name]
+        yield page, position
+
+
+def _layout(collection):
+    """
+    :return: (tuple) ('session', collection_name, unique_session_id) for a per session collection,
+             ('shared', collection_name, None) for a shared collection, None for other collections
+    """
+    session = _session_of(collection)
+    if session is not None:
+        return ('session',) + session
+    record = collection.get(limit=1, include=['metadatas'])
+    if not record['ids'] or not record['metadatas'][0]:
+        return None
+    if record['metadatas'][0].get('collection_name') != collection.name:
+        return None
+    try:
+        ids = json.loads(record['ids'][0])
+    except ValueError:
+        return None
+    if not isinstance(ids, list) or len(ids) != 2:
+        return None
+    return 'shared', collection.name, None
+
+
+def _read_chroma(chroma_client, collection_name, batch_size, cursor, embeddings):
+    # cursor is [name of the collection, number of its records already read], collections are read in name order
+    include = ['documents', 'metadatas'] + (['embeddings'] if embeddings else [])
+    collections = list()
+    for collection in chroma_client.list_collections():
+        if isinstance(collection, str):
+            collection = chroma_client.get_collection(collection)
+        collections.append(collection)
+    for collection in sorted(collections, key=lambda collection: collection.name):
+        if cursor is not None and collection.name < cursor[0]:
+            continue
+        layout = _layout(collection)
+        if layout is None or (collection_name is not None and layout[1] != collection_name):
+            continue
+        offset = cursor[1] if cursor is not None and collection.name == cursor[0] else 0
+        while True:
+            records = collection.get(limit=batch_size, offset=offset, include=include)
+            if not records['ids']:
+                break
+            offset += len(records['ids'])
+            page = list()
+            for i, chroma_id in enumerate(records['ids']):
+                metadata = records['metadatas'][i] or {}
+                if layout[0] == 'session':
+                    unique_session_id, unique_message_id = layout[2], chroma_id
+                else:
+                    unique_session_id, unique_message_id = json.loads(chroma_id)
+                page.append(_record(layout[1], unique_session_id, unique_message_id, records['documents'][i],
+                                    metadata, records['embeddings'][i] if embeddings else None, layout[0]))
+            yield page, [collection.name, offset]
+
+
+class _FileWriter:
+
+    def __init__(self, path, include_embeddings, resume_size):
+        """
+        :param resume_size: (int) size of the file when the checkpoint was saved, if None then a new file is written
+        """
+        self.path = path
+        self.include_embeddings = include_embeddings
+        self.format = _file_format(path)
+        self._file = None
+        self._parquet = None
+        if self.format == 'jsonl':
+            if resume_size is None:
+                self._file = open(path, 'w', encoding='utf-8')
+            else:
+                # records written after the checkpoint are written again
+                self._file = open(path, 'r+', encoding='utf-8')
+                self._file.truncate(resume_size)
+                self._file.seek(resume_size)
+
+    def write(self, records):
+        if self.format == 'jsonl':
+            for record in records:
+                item = {key: value for key, value in record.items()
+                        if key != 'layout' and (key != 'embedding' or (self.include_embeddings and value is not None))}
+                self._file.write(json.dumps(item) + '\n')
+            self._file.flush()
+            return
+        pyarrow = _import_pyarrow()
+        columns = {'collection_name': [record['collection_name'] for record in records],
+                   'unique_session_id': [record['unique_session_id'] for record in records],
+                   'unique_message_id': [record['unique_message_id'] for record in records],
+                   'document': [record['document'] for record in records],
+                   # metadata keys differ between messages, so metadata is a json column
+                   'metadata': [json.dumps(record['metadata']) for record in records]}
+        fields = [pyarrow.field(name, pyarrow.string()) for name in columns]
+        if self.include_embeddings:
+            columns['embedding'] = [record['embedding'] for record in records]
+            fields.append(pyarrow.field('embedding', pyarrow.list_(pyarrow.float32())))
+        table = pyarrow.table(columns, schema=pyarrow.schema(fields))
+        if self._parquet is None:
+            self._parquet = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self._parquet.write_table(table)
+
+    def size(self):
+        return self._file.tell() if self._file is not None else None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+class _BackendWriter:
+
+    def __init__(self, target, mode):
+        """
+        :param target: (object) MemoryBackend, or chroma client which keeps the layout of messages read from chroma,
+                       other messages are written in per session collections
+        """
+        if mode not in ('upsert', 'add'):
+            raise ValueError(f"Invalid mode {mode!r}. Supported modes are: upsert, add")
+        self.mode = mode
+        if isinstance(target, MemoryBackend):
+            self.backends = {'session': target, 'shared': target}
+        else:
+            self.backends = {'session': ChromaBackend(target), 'shared': SharedChromaBackend(target)}
+
+    def write(self, records):
+        if any(record['embedding'] is None for record in records):
+            raise ValueError('Records have no embeddings, pass embedding_model_settings to embed them')
+        groups = dict()
+        for record in records:
+            backend = self.backends[record['layout'] or 'session']
+            if isinstance(backend, SharedChromaBackend):
+                # messages of many sessions share a collection, so they are written in one call like the migration
+                key = (backend, record['collection_name'], None)
+            else:
+                key = (backend, record['collection_name'], record['unique_session_id'])
+            groups.setdefault(key, list()).append(record)
+        for (backend, name, unique_session_id), group in groups.items():
+            if unique_session_id is not None:
+                getattr(backend, self.mode)(name, unique_session_id,
+                                            unique_message_ids=[record['unique_message_id'] for record in group],
+                                            embeddings=[record['embedding'] for record in group],
+                                            documents=[record['document'] for record in group],
+                                            metadatas=[record['metadata'] for record in group])
+                continue
+            write = getattr(get_collection(backend.chroma_client, name), self.mode)
+            write(ids=[SharedChromaBackend.shared_id(record['unique_session_id'], record['unique_message_id'])
+                       for record in group],
+                  embeddings=[record['embedding'] for record in group],
+                  documents=[record['document'] for record in group],
+                  metadatas=[{**record['metadata'], 'unique_session_id': record['unique_session_id']}
+                             for record in group])
+
+    def size(self):
+        return None
+
+    def close(self):
+        pass
+
+
+def _load_checkpoint(checkpoint):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return None
+    with open(checkpoint, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_checkpoint(checkpoint, state):
+    # written to a temp file first, so a crash never leaves a broken checkpoint
+    with open(checkpoint + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(checkpoint + '.tmp', checkpoint)
+
+
+def transfer_memories(source, target, embedding_model_settings = None, collection_name: str = None,
+                      batch_size: int = 1000, embed_batch_size: int = 256, max_workers: int = 4,
+                      mode: str = 'upsert', include_embeddings: bool = True, checkpoint: str = None,
+                      verbose: bool = True):
+    """
+    Streams conversation memories from a source to a target page by page, optionally embedding them again.
+    Source and target can be a .jsonl or .parquet file path, a chroma client or a MemoryBackend, so it exports,
+    imports, copies between backends and re-embeds a store in place (same source and target).
+    Chroma sources are read in pages of batch_size messages from per session and shared collections.
+    :param source: (object) file path, chroma client, ChromaBackend or SharedChromaBackend
+    :param target: (object) file path, chroma client or MemoryBackend
+    :param embedding_model_settings: (dict) the settings, if given then every document is embedded with this model,
+                                     otherwise stored embeddings are copied. The shared embedding cache is not used
+                                     unless the settings have their own EmbeddingCache as 'cache'
+    :param collection_name: (str) Only transfer messages of this collection name optional, if None then all
+    :param batch_size: (int) Number of messages read and written per page
+    :param embed_batch_size: (int) Number of documents per embedding request
+    :param max_workers: (int) Max concurrent embedding requests
+    :param mode: (str) 'upsert' replaces messages which already exist in the target, 'add' keeps them
+    :param include_embeddings: (bool) Write embeddings to file targets
+    :param checkpoint: (str) json file of the progress optional, a transfer with an existing checkpoint resumes after
+                       the last written page, a finished transfer does nothing until the checkpoint is removed
+    :param verbose: (bool) Print progress
+    :return: (dict) 'documents' written, 'embedded', 'seconds', 'docs_per_second' and 'resumed'
+    """
+    started = time.perf_counter()
+    state = _load_checkpoint(checkpoint)
+    cursor = state['cursor'] if state is not None else None
+    stats = {'documents': 0, 'embedded': 0, 'seconds': 0.0, 'docs_per_second': 0.0, 'resumed': state is not None}
+    if state is not None and state['done']:
+        if verbose:
+            print(f'Transfer is already done, remove {checkpoint} to run it again')
+        return stats
+
+    reembed = embedding_model_settings is not None
+    if isinstance(target, str):
+        if state is not None and _file_format(target) == 'parquet':
+            raise ValueError('Parquet files can not be appended, resume is supported for .jsonl files')
+        writer = _FileWriter(target, include_embeddings, state['target_size'] if state is not None else None)
+        read_embeddings = include_embeddings and not reembed
+    else:
+        writer = _BackendWriter(target, mode)
+        read_embeddings = not reembed
+
+    if isinstance(source, str):
+        read = _read_jsonl if _file_format(source) == 'jsonl' else _read_parquet
+        pages = read(source, collection_name, batch_size, cursor)
+    else:
+        if isinstance(source, (ChromaBackend, SharedChromaBackend)):
+            source = source.chroma_client
+        elif isinstance(source, MemoryBackend):
+            raise ValueError(f'{type(source).__name__} can not be read, sources are files and chroma')
+        pages = _read_chroma(source, collection_name, batch_size, cursor, read_embeddings)
+
+    total = state['documents'] if state is not None else 0
+    last = cursor
+    provider = create_provider(embedding_model_settings) if reembed else None
+    if reembed:
+        # every document is embedded once, so caching would only evict the embeddings of live chats
+        embedding_model_settings = write_settings(embedding_model_settings)
+    pool = ThreadPoolExecutor(max_workers=max_workers) if reembed else None
+    pending = deque()
+    reported = started
+
+    def embed(documents):
+        return run_embedding(embedding_model_settings, documents, client=provider)
+
+    def finish(page, position, futures):
+        nonlocal total, last, reported
+        if futures is not None:
+            embeddings = [embedding for future in futures for embedding in future.result()]
+            for record, embedding in zip(page, embeddings):
+                record['embedding'] = embedding
+            stats['embedded'] += len(page)
+        if page:
+            writer.write(page)
+        stats['documents'] += len(page)
+        total += len(page)
+        last = position
+        if checkpoint is not None:
+            _save_checkpoint(checkpoint, {'cursor': position, 'documents': total, 'target_size': writer.size(),
+                                          'done': False})
+        now = time.perf_counter()
+        if verbose and now - reported >= 10:
+            reported = now
+            print(f"Transferred {stats['documents']} documents, {stats['documents'] / (now - started):.0f} docs/s")
+
+    try:
+        for page, position in pages:
+            futures = None
+            if reembed:
+                documents = [record['document'] or '' for record in page]
+                futures = [pool.submit(embed, documents[i:i + embed_batch_size])
+                           for i in range(0, len(documents), embed_batch_size)]
+            pending.append((page, position, futures))
+            # the next page is read and embedded while this one is written, in order of the source
+            if len(pending) > 1:
+                finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+        if checkpoint is not None:
+            _save_checkpoint(checkpoint, {'cursor': last, 'documents': total, 'target_size': writer.size(),
+                                          'done': True})
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if provider is not None:
+            provider.close()
+        writer.close()
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['docs_per_second'] = stats['documents'] / stats['seconds'] if stats['seconds'] else 0.0
+    if verbose:
+        print(f"Transferred {stats['documents']} documents ({stats['embedded']} embedded) in {stats['seconds']:.1f}s, "
+              f"{stats['docs_per_second']:.0f} docs/s")
+    return stats
+
+
+def reembed_memories(chroma_client, embedding_model_settings, **kwargs):
+    """
+    Embeds all stored messages again with the embedding model of the settings, in place, after the model is changed
+    :param chroma_client: (object) The chroma client instance, ChromaBackend or SharedChromaBackend
+    :param embedding_model_settings: (dict) the settings of the new embedding model
+    :param kwargs: options of transfer_memories, like batch_size, max_workers or checkpoint
+    :return: (dict) see transfer_memories
+    """
+    return transfer_memories(chroma_client, chroma_client, embedding_model_settings=embedding_model_settings,
+                             mode='upsert', **kwargs)
+
+
+def _endpoint(value, chroma_client, path):
+    # file path, or name of a memory backend, chroma keeps the layout of messages read from chroma
+    if value == 'chroma':
+        return chroma_client
+    if value in ('chroma_shared', 'numpy'):
+        return create_backend({'backend': value, 'path': path}, chroma_client=chroma_client)
+    return value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export, import and re-embed conversation memories')
+    parser.add_argument('--source', required=True, help='.jsonl / .parquet file or chroma')
+    parser.add_argument('--target', required=True, help='.jsonl / .parquet file, chroma, chroma_shared or numpy')
+    parser.add_argument('--host', default=None, help='chroma server host, persistent client if not given')
+    parser.add_argument('--port', type=int, default=None, help='chroma server port')
+    parser.add_argument('--path', default=None, help='directory of the numpy backend')
+    parser.add_argument('--collection-name', default=None, help='only transfer this collection name')
+    parser.add_argument('--embedding-provider', default=None, help='embed documents again with this provider')
+    parser.add_argument('--embedding-model', default=None)
+    parser.add_argument('--embedding-base-url', default=None)
+    parser.add_argument('--embed-endpoint', default='embeddings', choices=['embeddings', 'embed'],
+                        help='ollama endpoint of the new embeddings, see embedding_model_settings')
+    parser.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY'))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--embed-batch-size', type=int, default=256)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--mode', default='upsert', choices=['upsert', 'add'])
+    parser.add_argument('--no-embeddings', action='store_true', help='do not write embeddings to file targets')
+    parser.add_argument('--checkpoint', default=None, help='progress file, an interrupted transfer resumes from it')
+    args = parser.parse_args()
+
+    chroma_client = None
+    if {args.source, args.target} & {'chroma', 'chroma_shared'}:
+        chroma_client = create_client(args.host, args.port)
+    settings = None
+    if args.embedding_provider is not None:
+        settings = {'provider': args.embedding_provider, 'model': args.embedding_model,
+                    'base_url': args.embedding_base_url, 'api_key': args.api_key, 'cache': False,
+                    'embed_endpoint': args.embed_endpoint}
+    transfer_memories(_endpoint(args.source, chroma_client, args.path),
+                      _endpoint(args.target, chroma_client, args.path), embedding_model_settings=settings,
+                      collection_name=args.collection_name, batch_size=args.batch_size, embed_batch_size=args.embed_batch_size,
+                      max_workers=args.max_workers, mode=args.mode, include_embeddings=not args.no_embeddings,
+                      checkpoint=args.checkpoint)
@@ -1,11 +1,926 @@
-from lazyme import color_print as cprint
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 try:
-    from models import ollama_chat, openai_chat, run_embedding
-    from chroma_handler import create_client, recall, push_msg_to_vector_store
+    from models import run_embedding, arun_embedding, write_settings
+    from providers import CustomLLM, create_provider, provider_key
+    from chroma_handler import create_client, recall, push_msg_to_vector_store, arecall, embed_once
+    from chroma_handler import get_rewrite_cache, aembed_queries
+    from write_behind import WriteBehindQueue
+    from compaction import Compactor, compact_session
+    from memory_backends import create_backend
+    from instrumentation import turn, start_turn, active, span, count, is_verbose
 except:
-    from auto_llm_chatbot.models import ollama_chat, openai_chat, run_embedding
-    from auto_llm_chatbot.chroma_handler import create_client, recall, push_msg_to_vector_store
+    from auto_llm_chatbot.models import run_embedding, arun_embedding, write_settings
+    from auto_llm_chatbot.providers import CustomLLM, create_provider, provider_key
+    from auto_llm_chatbot.chroma_handler import create_client, recall, push_msg_to_vector_store, arecall, embed_once
+    from auto_llm_chatbot.chroma_handler import get_rewrite_cache, aembed_queries
+    from auto_llm_chatbot.write_behind import WriteBehindQueue
+    from auto_llm_chatbot.compaction import Compactor, compact_session
+    from auto_llm_chatbot.memory_backends import create_backend
+    from auto_llm_chatbot.instrumentation import turn, start_turn, active, span, count, is_verbose
+
+
+class ChatEngine:
+    """
+    Long-lived chatbot engine, it creates the chroma client and the providers of the chat and embedding models once
+    and keeps their http connections alive across chats
+    """
+
+    def __init__(self, llm_settings, chroma_settings, embedding_model_settings, memory_settings, hooks = None):
+        """
+        :param llm_settings: (dict) the settings
+        :param chroma_settings: (dict) the settings
+        :param embedding_model_settings: (dict) the settings
+        :param memory_settings: (dict) the settings
+        :param hooks: (list) optional instrumentation hooks, like MetricsRegistry(), they receive timings of every turn
+        """
+        self.llm_settings = llm_settings
+        self.chroma_settings = chroma_settings
+        self.embedding_model_settings = embedding_model_settings
+        self.memory_settings = memory_settings
+        self.hooks = list(hooks) if hooks is not None else list()
+        self.prompt_layout = _prompt_layout(memory_settings)
+
+        with turn('engine_init', self.hooks):
+            self.llm_client = create_provider(llm_settings)
+            self.llm_client.connect()
+            if provider_key(llm_settings) == provider_key(embedding_model_settings):
+                # same servers for chat and embeddings, so sharing the connection pools and the load balancing
+                self.embedding_client = self.llm_client
+            else:
+                self.embedding_client = create_provider(embedding_model_settings)
+                self.embedding_client.connect()
+        self._chroma_client = None
+        self._memory_backend = None
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._compactor = None
+        self._compactor_lock = threading.Lock()
+
+    @property
+    def chroma_client(self):
+        # chroma client is created on first memory chat only
+        if self._chroma_client is None:
+            self._chroma_client = create_client(chroma_host=self.chroma_settings['host'],
+                                                chroma_port=self.chroma_settings['port'],
+                                                settings=self.chroma_settings['settings'])
+        return self._chroma_client
+
+    @property
+    def memory_backend(self):
+        """
+        Storage of memories, chroma_settings 'backend' can be 'chroma' (default), 'chroma_shared' or 'numpy'
+        """
+        if self._memory_backend is None:
+            if self.chroma_settings.get('backend', 'chroma') in ('chroma', 'chroma_shared'):
+                self._memory_backend = create_backend(self.chroma_settings, chroma_client=self.chroma_client)
+            else:
+                self._memory_backend = create_backend(self.chroma_settings)
+        return self._memory_backend
+
+    @property
+    def writer(self):
+        """
+        Write-behind queue of this engine, None unless memory_settings['write_behind'] is true
+        """
+        if not self.memory_settings.get('write_behind', False):
+            return None
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = WriteBehindQueue(chroma_client=self.memory_backend,
+                                                embedding_model_settings=self.embedding_model_settings,
+                                                embedding_client=self.embedding_client,
+                                                batch_size=self.memory_settings.get('write_batch_size', 64),
+                                                max_delay=self.memory_settings.get('write_max_delay', 0.05),
+                                                hooks=self.hooks)
+            return self._writer
+
+    @property
+    def compactor(self):
+        """
+        Background compaction of session memories, None unless memory_settings['compaction'] is set,
+        see compaction.compaction_settings
+        """
+        if not self.memory_settings.get('compaction'):
+            return None
+        with self._compactor_lock:
+            if self._compactor is None:
+                self._compactor = Compactor(chroma_client=self.memory_backend,
+                                            llm_settings=self.llm_settings,
+                                            embedding_model_settings=self.embedding_model_settings,
+                                            settings=self.memory_settings['compaction'],
+                                            llm_client=self.llm_client,
+                                            embedding_client=self.embedding_client,
+                                            hooks=self.hooks)
+            return self._compactor
+
+    def compact(self, collection_name, unique_session_id, settings = None):
+        """
+        Compacts the memories of a session now, old messages are replaced with summaries written by the chat model
+        :param collection_name: (str) chroma db collection name
+        :param unique_session_id: (str) unique session id for the session using in chroma db
+        :param settings: (dict) compaction settings optional, default memory_settings['compaction']
+        :return: (dict) report of the compaction, see compaction.compact_session
+        """
+        if self.writer is not None:
+            # queued messages of the session are compacted too
+            self.writer.wait_for_session(collection_name, unique_session_id)
+        if settings is None:
+            settings = self.memory_settings.get('compaction')
+        with self._turn('compaction', True, collection_name, unique_session_id):
+            return compact_session(collection_name, unique_session_id, self.memory_backend,
+                                   self.llm_settings, self.embedding_model_settings, settings,
+                                   llm_client=self.llm_client, embedding_client=self.embedding_client)
+
+    def chat(self, query, system_message,
+             memory = True,
+             collection_name = None,
+             unique_session_id = None,
+             unique_message_id = None,
+             buffer_window_chats = None):
+        """
+        Chat with LLM using the clients of this engine
+        :param query: (str) current query that you want to ask LLM
+        :param system_message: (str) the system message
+        :param memory: (bool) the memory settings if true then vector memory will be automatically managed using chroma db
+        :param collection_name: (str) chroma db collection name
+        :param unique_session_id: (str) unique session id for the session using in chroma db
+        :param unique_message_id: (str) unique message id using in chroma db
+        :param buffer_window_chats: (list) list of chat messages in openai format excluding system message if None then no past conversation will be shown to model
+        :return: Returns the chats response from Ollama or OpenAI
+        """
+        with self._turn('chat', memory, collection_name, unique_session_id):
+            if not memory:
+                # if memory is set to False, chat with llm using openai or ollama
+                messages = _messages(query, system_message, buffer_window_chats)
+                return self._generate(messages)
+
+            _check_ids(collection_name, unique_session_id, unique_message_id, self.memory_backend)
+
+            # embeddings created in this turn, so every text is embedded only once
+            embedded = dict()
+
+            # fetching memory / history of chats from vector database
+            memories = self._recall(query, collection_name, unique_session_id, embedded)
+
+            # formatting the message system message, buffer_window_chats, user query and memories fetched
+            # in openai format
+            messages = _messages(query, system_message, buffer_window_chats, memories, self.prompt_layout)
+
+            # printing the prompt, see set_verbose
+            if is_verbose():
+                from lazyme import color_print as cprint
+                for i in messages:
+                    cprint(f"{i['role']}: {i['content']}", color='cyan')
+
+            # Final chat with llm using openai or ollama
+            chat_response = self.llm_client.content(self._generate(messages))
+
+            # saving conversation just happened in vector store
+            self._remember(query, chat_response, collection_name, unique_session_id, unique_message_id, embedded)
+            return chat_response
+
+    def _turn_attributes(self, memory, collection_name, unique_session_id):
+        attributes = {'provider': self.llm_settings['provider'], 'model': self.llm_settings['model']}
+        if memory:
+            attributes.update(collection_name=collection_name, unique_session_id=unique_session_id)
+        return attributes
+
+    def _turn(self, name, memory = False, collection_name = None, unique_session_id = None):
+        # records timings of a turn for the instrumentation hooks
+        return turn(name, self.hooks, **self._turn_attributes(memory, collection_name, unique_session_id))
+
+    def chat_stream(self, query, system_message,
+                    memory = True,
+                    collection_name = None,
+                    unique_session_id = None,
+                    unique_message_id = None,
+                    buffer_window_chats = None):
+        """
+        Streaming version of chat, parameters are same as chat
+        :return: (ChatStream) iterator over the text chunks of the answer, conversation is saved in vector store
+                 when the iteration completes
+        """
+        if memory:
+            _check_ids(collection_name, unique_session_id, unique_message_id, self.memory_backend)
+        return ChatStream(self._stream_turn(query, system_message, memory, collection_name, unique_session_id,
+                                            unique_message_id, buffer_window_chats))
+
+    def _stream_turn(self, query, system_message, memory, collection_name, unique_session_id, unique_message_id,
+                     buffer_window_chats):
+        # the turn is made current only while this generator runs its own code, not while the caller has the chunk
+        record = start_turn('chat_stream', self.hooks,
+                            **self._turn_attributes(memory, collection_name, unique_session_id))
+        try:
+            embedded = dict()
+            memories = None
+            with active(record):
+                if memory:
+                    memories = self._recall(query, collection_name, unique_session_id, embedded)
+            messages = _messages(query, system_message, buffer_window_chats, memories, self.prompt_layout)
+
+            llm_settings = self.llm_settings
+            usage = dict() if record is not None else None
+            chunks = self.llm_client.chat_stream(messages, llm_settings['model'], options=llm_settings.get('options'),
+                                                 usage=usage)
+            answer = list()
+            started = time.perf_counter()
+            for chunk in chunks:
+                if not answer:
+                    first_token = time.perf_counter()
+                answer.append(chunk)
+                yield chunk
+            _record_generation(record, started, first_token if answer else None, usage)
+
+            if memory:
+                with active(record):
+                    self._remember(query, ''.join(answer), collection_name, unique_session_id, unique_message_id,
+                                   embedded)
+        except BaseException as e:
+            if record is not None:
+                record.finish(error=e)
+            raise
+        if record is not None:
+            record.finish()
+
+    def _generate(self, messages, llm_client = None):
+        llm_settings = self.llm_settings
+        llm_client = llm_client or self.llm_client
+        with span('llm_generation'):
+            response = llm_client.chat(messages, llm_settings['model'], options=llm_settings.get('options'))
+        count(**llm_client.usage(response))
+        return response
+
+    def _recall(self, query, collection_name, unique_session_id, embedded, writer = None, llm_client = None,
+                embedding_client = None):
+        # previous turn of this session may still be in write-behind queue
+        writer = writer or self.writer
+        if writer is not None and writer.has_pending(collection_name, unique_session_id):
+            with span('write_wait'):
+                writer.wait_for_session(collection_name, unique_session_id)
+
+        memory_settings = self.memory_settings
+        return recall(query, collection_name, unique_session_id, self.memory_backend,
+                      try_queries=memory_settings['try_queries'],
+                      results_per_query=memory_settings['results_per_query'],
+                      llm_settings=self.llm_settings,
+                      embedding_model_settings=self.embedding_model_settings,
+                      llm_client=llm_client or self.llm_client,
+                      embedding_client=embedding_client or self.embedding_client,
+                      embedded=embedded,
+                      **_recall_settings(memory_settings))
+
+    def _remember(self, query, chat_response, collection_name, unique_session_id, unique_message_id, embedded,
+                  writer = None, embedding_client = None):
+        data = f"user: {query}\nassistant: {chat_response}"
+
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.record_turn(collection_name, unique_session_id)
+
+        writer = writer or self.writer
+        if writer is not None and embedding_client is None:
+            # embedding and pushing happens in background
+            writer.submit(collection_name, unique_session_id, unique_message_id, data,
+                          embedding=embedded.get(data))
+            return
+
+        # creating embedding of conversation
+        with span('write_embedding', texts=1):
+            data_embedding = embed_once([data], embedded, write_settings(self.embedding_model_settings),
+                                        client=embedding_client or self.embedding_client)[0]
+
+        if writer is not None:
+            # embedded within the provider limits of chat_many, the queue only pushes it
+            writer.submit(collection_name, unique_session_id, unique_message_id, data, embedding=data_embedding)
+            return
+
+        # pushing conversation into vector database
+        push_msg_to_vector_store(collection_name=collection_name, unique_session_id=unique_session_id,
+                                 unique_message_id=unique_message_id, chroma_client=self.memory_backend,
+                                 embeddings=data_embedding,
+                                 data=data)
+
+    async def achat(self, query, system_message,
+                    memory = True,
+                    collection_name = None,
+                    unique_session_id = None,
+                    unique_message_id = None,
+                    buffer_window_chats = None):
+        """
+        Asyncio version of chat, the query embedding, refined queries and vector database lookups run concurrently
+        :param query: (str) current query that you want to ask LLM
+        :param system_message: (str) the system message
+        :param memory: (bool) the memory settings if true then vector memory will be automatically managed using chroma db
+        :param collection_name: (str) chroma db collection name
+        :param unique_session_id: (str) unique session id for the session using in chroma db
+        :param unique_message_id: (str) unique message id using in chroma db
+        :param buffer_window_chats: (list) list of chat messages in openai format excluding system message if None then no past conversation will be shown to model
+        :return: Returns the chats response from Ollama or OpenAI
+        """
+        with self._turn('achat', memory, collection_name, unique_session_id):
+            if not memory:
+                messages = _messages(query, system_message, buffer_window_chats)
+                return await self._agenerate(messages)
+
+            _check_ids(collection_name, unique_session_id, unique_message_id, self.memory_backend)
+            memories = await self._arecall(query, collection_name, unique_session_id)
+            messages = _messages(query, system_message, buffer_window_chats, memories, self.prompt_layout)
+            chat_response = self.llm_client.content(await self._agenerate(messages))
+            await self._aremember(query, chat_response, collection_name, unique_session_id, unique_message_id)
+            return chat_response
+
+    def achat_stream(self, query, system_message,
+                     memory = True,
+                     collection_name = None,
+                     unique_session_id = None,
+                     unique_message_id = None,
+                     buffer_window_chats = None):
+        """
+        Asyncio streaming version of chat, parameters are same as chat
+        :return: (AsyncChatStream) async iterator over the text chunks of the answer, conversation is saved in
+                 vector store when the iteration completes
+        """
+        if memory:
+            _check_ids(collection_name, unique_session_id, unique_message_id, self.memory_backend)
+        return AsyncChatStream(self._astream_turn(query, system_message, memory, collection_name, unique_session_id,
+                                                  unique_message_id, buffer_window_chats))
+
+    async def _astream_turn(self, query, system_message, memory, collection_name, unique_session_id,
+                            unique_message_id, buffer_window_chats):
+        record = start_turn('achat_stream', self.hooks,
+                            **self._turn_attributes(memory, collection_name, unique_session_id))
+        try:
+            memories = None
+            with active(record):
+                if memory:
+                    memories = await self._arecall(query, collection_name, unique_session_id)
+            messages = _messages(query, system_message, buffer_window_chats, memories, self.prompt_layout)
+
+            llm_settings = self.llm_settings
+            usage = dict() if record is not None else None
+            chunks = self.llm_client.achat_stream(messages, llm_settings['model'],
+                                                  options=llm_settings.get('options'), usage=usage)
+            answer = list()
+            started = time.perf_counter()
+            async for chunk in chunks:
+                if not answer:
+                    first_token = time.perf_counter()
+                answer.append(chunk)
+                yield chunk
+            _record_generation(record, started, first_token if answer else None, usage)
+
+            if memory:
+                with active(record):
+                    await self._aremember(query, ''.join(answer), collection_name, unique_session_id,
+                                          unique_message_id)
+        except BaseException as e:
+            if record is not None:
+                record.finish(error=e)
+            raise
+        if record is not None:
+            record.finish()
+
+    async def _agenerate(self, messages, llm_client = None):
+        llm_settings = self.llm_settings
+        llm_client = llm_client or self.llm_client
+        with span('llm_generation'):
+            response = await llm_client.achat(messages, llm_settings['model'], options=llm_settings.get('options'))
+        count(**llm_client.usage(response))
+        return response
+
+    async def _arecall(self, query, collection_name, unique_session_id, writer = None, query_embedding = None,
+                       llm_client = None, embedding_client = None):
+        writer = writer or self.writer
+        if writer is not None and writer.has_pending(collection_name, unique_session_id):
+            with span('write_wait'):
+                await asyncio.to_thread(writer.wait_for_session, collection_name, unique_session_id)
+
+        memory_settings = self.memory_settings
+        if query_embedding is not None:
+            # already embedded by caller
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(query_embedding)
+            query_embedding = future
+        else:
+            # query embedding runs in background while queries are being refined
+            query_embedding = asyncio.ensure_future(
+                aembed_queries(embedding_model_settings=self.embedding_model_settings, query=query,
+                               client=embedding_client or self.embedding_client))
+        try:
+            return await arecall(query, collection_name, unique_session_id, self.memory_backend,
+                                 query_embedding, try_queries=memory_settings['try_queries'],
+                                 results_per_query=memory_settings['results_per_query'],
+                                 llm_settings=self.llm_settings,
+                                 embedding_model_settings=self.embedding_model_settings,
+                                 llm_client=llm_client or self.llm_client,
+                                 embedding_client=embedding_client or self.embedding_client,
+                                 **_recall_settings(memory_settings))
+        finally:
+            if not query_embedding.done():
+                query_embedding.cancel()
+
+    async def _aremember(self, query, chat_response, collection_name, unique_session_id, unique_message_id,
+                         writer = None, embedding_client = None):
+        data = f"user: {query}\nassistant: {chat_response}"
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.record_turn(collection_name, unique_session_id)
+        writer = writer or self.writer
+        if writer is not None and embedding_client is None:
+            writer.submit(collection_name, unique_session_id, unique_message_id, data)
+            return
+        with span('write_embedding', texts=1):
+            data_embedding = await arun_embedding(
+                embedding_model_settings=write_settings(self.embedding_model_settings), query=data,
+                client=embedding_client or self.embedding_client)
+        if writer is not None:
+            writer.submit(collection_name, unique_session_id, unique_message_id, data, embedding=data_embedding)
+            return
+        await asyncio.to_thread(push_msg_to_vector_store, collection_name=collection_name,
+                                unique_session_id=unique_session_id,
+                                unique_message_id=unique_message_id, chroma_client=self.memory_backend,
+                                embeddings=data_embedding,
+                                data=data)
+
+    def chat_many(self, requests, max_workers = 8, provider_limits = None, embed_batch_size = 64):
+        """
+        Runs many chats in a thread pool and yields the results in completion order
+        turns of the same session run one after another, in the order of requests
+        :param requests: (iterable) dicts with chat parameters: query, system_message and optional request_id, memory,
+                         collection_name, unique_session_id, unique_message_id, buffer_window_chats
+        :param max_workers: (int) number of worker threads
+        :param provider_limits: (dict) optional max concurrent chat and embedding calls per provider, like {'ollama': 2}
+        :param embed_batch_size: (int) number of requests whose queries are embedded in one request
+        :return: (generator) dicts with request_id, response and error (exception or None)
+        """
+        clients = self._limited_clients(_provider_limits(provider_limits, threading.BoundedSemaphore))
+        writer = self._batch_writer()
+        requests = enumerate(requests)
+        waiting = dict()
+        running = dict()
+        exhausted = False
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                def submit(request, embedded):
+                    future = pool.submit(self._batch_turn, request, embedded, writer, clients)
+                    running[future] = _session_key(request)
+
+                while True:
+                    while not exhausted and len(running) + sum(map(len, waiting.values())) < max_workers * 2:
+                        chunk = [_batch_request(index, request)
+                                 for index, request in itertools.islice(requests, embed_batch_size)]
+                        if not chunk:
+                            exhausted = True
+                            break
+                        for request, embedded in zip(chunk, self._batch_embed(chunk, clients[1])):
+                            key = _session_key(request)
+                            if key is not None and (key in waiting or key in running.values()):
+                                waiting.setdefault(key, deque()).append((request, embedded))
+                            else:
+                                submit(request, embedded)
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key = running.pop(future)
+                        if key in waiting:
+                            submit(*waiting[key].popleft())
+                            if not waiting[key]:
+                                del waiting[key]
+                        yield future.result()
+        finally:
+            writer.close()
+
+    async def achat_many(self, requests, max_concurrency = 64, provider_limits = None, embed_batch_size = 64):
+        """
+        Asyncio version of chat_many, runs many chats concurrently in the event loop
+        :param requests: (iterable) dicts with chat parameters, see chat_many
+        :param max_concurrency: (int) max number of chats in flight
+        :param provider_limits: (dict) optional max concurrent chat and embedding calls per provider, like {'ollama': 2}
+        :param embed_batch_size: (int) number of requests whose queries are embedded in one request
+        :return: (async generator) dicts with request_id, response and error (exception or None)
+        """
+        clients = self._limited_clients(_provider_limits(provider_limits, asyncio.BoundedSemaphore))
+        writer = self._batch_writer()
+        session_locks = dict()
+        requests = enumerate(requests)
+        running = set()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(running) < max_concurrency:
+                    chunk = [_batch_request(index, request)
+                             for index, request in itertools.islice(requests, min(embed_batch_size, max_concurrency))]
+                    if not chunk:
+                        exhausted = True
+                        break
+                    for request, embedded in zip(chunk, await self._abatch_embed(chunk, clients[1])):
+                        # asyncio locks are fair, so turns of a session run in the order of requests,
+                        # chats without memory have no session and run concurrently
+                        key = _session_key(request)
+                        lock = _anullcontext() if key is None else session_locks.setdefault(key, asyncio.Lock())
+                        running.add(asyncio.ensure_future(
+                            self._abatch_turn(request, embedded, writer, clients, lock)))
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.to_thread(writer.close)
+
+    def _batch_writer(self):
+        # the queue, and so chroma, is created by the first request with memory
+        if self.memory_settings.get('write_behind', False):
+            return _BatchWriter(lambda: self.writer, own=False)
+        return _BatchWriter(lambda: WriteBehindQueue(chroma_client=self.memory_backend,
+                                                     embedding_model_settings=self.embedding_model_settings,
+                                                     embedding_client=self.embedding_client,
+                                                     batch_size=self.memory_settings.get('write_batch_size', 64),
+                                                     max_delay=self.memory_settings.get('write_max_delay', 0.05),
+                                                     hooks=self.hooks))
+
+    def _limited_clients(self, limits):
+        # providers of the batch, wrapped when provider_limits has a limit for their provider
+        llm_limit = limits.get(self.llm_settings['provider'])
+        embedding_limit = limits.get(self.embedding_model_settings['provider'])
+        return (None if llm_limit is None else _LimitedProvider(self.llm_client, llm_limit),
+                None if embedding_limit is None else _LimitedProvider(self.embedding_client, embedding_limit))
+
+    def _batch_embed(self, chunk, embedding_client = None):
+        texts = [request['query'] for request in chunk if request['memory']]
+        try:
+            with turn('batch_embed', self.hooks, requests=len(chunk)), span('query_embedding', texts=len(texts)):
+                embedded = dict(zip(texts, run_embedding(embedding_model_settings=self.embedding_model_settings,
+                                                         query=texts,
+                                                         client=embedding_client or self.embedding_client)))
+        except Exception as e:
+            # every chat will embed its own query again
+            print(f"ERROR: {e}")
+            embedded = dict()
+        return [{request['query']: embedded[request['query']]} if request['query'] in embedded else dict()
+                for request in chunk]
+
+    async def _abatch_embed(self, chunk, embedding_client = None):
+        texts = [request['query'] for request in chunk if request['memory']]
+        try:
+            with turn('batch_embed', self.hooks, requests=len(chunk)), span('query_embedding', texts=len(texts)):
+                embedded = dict(zip(texts, await arun_embedding(
+                    embedding_model_settings=self.embedding_model_settings, query=texts,
+                    client=embedding_client or self.embedding_client)))
+        except Exception as e:
+            print(f"ERROR: {e}")
+            embedded = dict()
+        return [{request['query']: embedded[request['query']]} if request['query'] in embedded else dict()
+                for request in chunk]
+
+    def _batch_turn(self, request, embedded, writer, clients):
+        llm_client, embedding_client = clients
+        result = {'request_id': request['request_id'], 'response': None, 'error': None}
+        try:
+            with self._turn('chat', request['memory'], request['collection_name'], request['unique_session_id']):
+                query = request['query']
+                memories = None
+                if request['memory']:
+                    _check_ids(request['collection_name'], request['unique_session_id'],
+                               request['unique_message_id'], self.memory_backend)
+                    writer = writer.get()
+                    memories = self._recall(query, request['collection_name'], request['unique_session_id'],
+                                            embedded, writer=writer, llm_client=llm_client,
+                                            embedding_client=embedding_client)
+                messages = _messages(query, request['system_message'], request['buffer_window_chats'], memories,
+                                     self.prompt_layout)
+                chat_response = self._generate(messages, llm_client=llm_client)
+                if request['memory']:
+                    chat_response = self.llm_client.content(chat_response)
+                    self._remember(query, chat_response, request['collection_name'], request['unique_session_id'],
+                                   request['unique_message_id'], embedded, writer=writer,
+                                   embedding_client=embedding_client)
+            result['response'] = chat_response
+        except Exception as e:
+            result['error'] = e
+        return result
+
+    async def _abatch_turn(self, request, embedded, writer, clients, lock):
+        llm_client, embedding_client = clients
+        result = {'request_id': request['request_id'], 'response': None, 'error': None}
+        try:
+            async with lock:
+                with self._turn('achat', request['memory'], request['collection_name'],
+                                request['unique_session_id']):
+                    query = request['query']
+                    memories = None
+                    if request['memory']:
+                        _check_ids(request['collection_name'], request['unique_session_id'],
+                                   request['unique_message_id'], self.memory_backend)
+                        writer = writer.get()
+                        memories = await self._arecall(query, request['collection_name'],
+                                                       request['unique_session_id'], writer=writer,
+                                                       query_embedding=embedded.get(query), llm_client=llm_client,
+                                                       embedding_client=embedding_client)
+                    messages = _messages(query, request['system_message'], request['buffer_window_chats'],
+                                         memories, self.prompt_layout)
+                    chat_response = await self._agenerate(messages, llm_client=llm_client)
+                    if request['memory']:
+                        chat_response = self.llm_client.content(chat_response)
+                        await self._aremember(query, chat_response, request['collection_name'],
+                                              request['unique_session_id'], request['unique_message_id'],
+                                              writer=writer, embedding_client=embedding_client)
+            result['response'] = chat_response
+        except Exception as e:
+            result['error'] = e
+        return result
+
+    def flush(self, timeout = None):
+        """
+        Blocks until all conversations queued by write-behind are written to vector store
+        :param timeout: (float) max seconds to wait, if None then waits until everything is written
+        :return: (bool) False if timeout expired first
+        """
+        if self._writer is None:
+            return True
+        return self._writer.flush(timeout=timeout)
+
+    def close(self):
+        """
+        Writes queued conversations, stops background compaction and closes the http connections
+        of the clients of this engine
+        """
+        if self._writer is not None:
+            self._writer.close()
+        if self._compactor is not None:
+            self._compactor.close()
+        for provider in {id(p): p for p in (self.llm_client, self.embedding_client)}.values():
+            provider.close()
+
+    async def aclose(self):
+        """
+        Closes the http connections of the asyncio clients of this engine
+        """
+        for provider in {id(p): p for p in (self.llm_client, self.embedding_client)}.values():
+            await provider.aclose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ChatStream:
+    """
+    Iterator over the text chunks of a streamed answer, when iteration completes
+    text, first_token_latency and total_latency (seconds from the chat_stream call) are set
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._started = time.perf_counter()
+        self.text = None
+        self.first_token_latency = None
+        self.total_latency = None
+
+    def __iter__(self):
+        answer = list()
+        for chunk in self._chunks:
+            if self.first_token_latency is None:
+                self.first_token_latency = time.perf_counter() - self._started
+            answer.append(chunk)
+            yield chunk
+        self.text = ''.join(answer)
+        self.total_latency = time.perf_counter() - self._started
+
+
+class AsyncChatStream(ChatStream):
+    """
+    Async iterator over the text chunks of a streamed answer, see ChatStream
+    """
+
+    def __iter__(self):
+        raise TypeError('use "async for" with AsyncChatStream')
+
+    async def __aiter__(self):
+        answer = list()
+        async for chunk in self._chunks:
+            if self.first_token_latency is None:
+                self.first_token_latency = time.perf_counter() - self._started
+            answer.append(chunk)
+            yield chunk
+        self.text = ''.join(answer)
+        self.total_latency = time.perf_counter() - self._started
+
+
+def _record_generation(record, started, first_token, usage):
+    # streamed generation is timed by the stream, the caller's time between chunks is included
+    if record is None:
+        return
+    attributes = dict()
+    if first_token is not None:
+        attributes['first_token_seconds'] = first_token - started
+    record.add_span('llm_generation', started, time.perf_counter(), **attributes)
+    record.count(**usage)
+
+
+def _batch_request(index, request):
+    # fills the optional chat parameters of a chat_many request
+    request = dict(request)
+    request.setdefault('memory', True)
+    request.setdefault('collection_name', None)
+    request.setdefault('unique_session_id', None)
+    request.setdefault('unique_message_id', None)
+    request.setdefault('buffer_window_chats', None)
+    request.setdefault('request_id', request['unique_message_id'] if request['unique_message_id'] is not None
+                       else index)
+    return request
+
+
+def _session_key(request):
+    if not request['memory']:
+        return None
+    return request['collection_name'], request['unique_session_id']
+
+
+def _provider_limits(provider_limits, semaphore):
+    if provider_limits is None:
+        return dict()
+    return {provider: semaphore(limit) for provider, limit in provider_limits.items()}
+
+
+class _LimitedProvider(CustomLLM):
+    """
+    Provider of chat_many / achat_many whose chat and embedding calls hold the semaphore of their provider,
+    so query refining, query embeddings and conversation embeddings count against provider_limits too
+    """
+
+    def __init__(self, provider, semaphore):
+        """
+        :param provider: (CustomLLM) the provider of the engine
+        :param semaphore: (object) threading.BoundedSemaphore for chat_many, asyncio.BoundedSemaphore for achat_many
+        """
+        super().__init__(getattr(provider, 'name', 'custom_llm'))
+        self.provider = provider
+        self.semaphore = semaphore
+
+    def chat(self, messages, model, options = None, timeout = None):
+        with self.semaphore:
+            return self.provider.chat(messages, model, options, timeout=timeout)
+
+    def embed(self, texts, model, timeout = None):
+        with self.semaphore:
+            return self.provider.embed(texts, model, timeout=timeout)
+
+    async def achat(self, messages, model, options = None, timeout = None):
+        async with self.semaphore:
+            return await self.provider.achat(messages, model, options, timeout=timeout)
+
+    async def aembed(self, texts, model, timeout = None):
+        async with self.semaphore:
+            return await self.provider.aembed(texts, model, timeout=timeout)
+
+    def content(self, response):
+        return self.provider.content(response)
+
+    def usage(self, response):
+        return self.provider.usage(response)
+
+
+class _BatchWriter:
+    """
+    Write-behind queue of chat_many / achat_many, created on first use
+    """
+
+    def __init__(self, create, own = True):
+        """
+        :param create: (callable) returns the WriteBehindQueue
+        :param own: (bool) if True then the queue is closed with the batch
+        """
+        self._create = create
+        self._own = own
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = self._create()
+            return self._writer
+
+    def close(self):
+        with self._lock:
+            if self._own and self._writer is not None:
+                self._writer.close()
+
+
+class _anullcontext:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+def _check_ids(collection_name, unique_session_id, unique_message_id, memory_backend):
+    if collection_name is None or unique_session_id is None or unique_message_id is None:
+        raise ValueError('Collection name, unique session id, and unique message id are required')
+    memory_backend.check_names(collection_name, unique_session_id)
+
+
+_prompt_layouts = ('system', 'stable_prefix')
+
+
+def _prompt_layout(memory_settings):
+    layout = memory_settings.get('prompt_layout', 'system')
+    if layout not in _prompt_layouts:
+        raise ValueError(f"Invalid prompt layout {layout!r}. "
+                         f"Supported prompt layouts are: {', '.join(_prompt_layouts)}")
+    return layout
+
+
+def _messages(query, system_message, buffer_window_chats, memories = None, layout = 'system'):
+    # system message, buffer_window_chats, user query and memories in openai format
+    if buffer_window_chats is None:
+        buffer_window_chats = []
+    if memories is not None:
+        used = memories['memory_stats']['used']
+        memories = memories['memories']
+        if layout == 'stable_prefix':
+            # system message and history stay an unchanged prompt prefix across turns, so the prompt cache
+            # of the server is reused and only the memories and the query are evaluated
+            memory_message = [{'role': 'system', 'content': f"Here is the memory of old conversations-\n{memories}\n"}]
+            if not used:
+                # memories is '[]' when nothing was recalled
+                memory_message = []
+            return [
+                       {'role': 'system', 'content': system_message},
+                   ] + buffer_window_chats + memory_message + [{'role': 'user', 'content': query}]
+        system_message = system_message + f"\nHere is the memory of old conversations-\n{memories}\n"
+    return [
+               {'role': 'system', 'content': system_message},
+           ] + buffer_window_chats + [{'role': 'user', 'content': query}]
+
+
+def _recall_settings(memory_settings):
+    return {'rewrite_cache': get_rewrite_cache(memory_settings),
+            'rewrite_gate': memory_settings.get('rewrite_gate', False),
+            'rewrite_min_words': memory_settings.get('rewrite_min_words', 3),
+            'token_budget': memory_settings.get('token_budget'),
+            'token_counter': memory_settings.get('token_counter')}
+
+
+# engines of module level chat functions, the least recently used one is closed when there are more than max_engines
+max_engines = 32
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+
+def get_engine(llm_settings, chroma_settings, embedding_model_settings, memory_settings):
+    """
+    Returns a shared ChatEngine for the given settings, engine is created on the first call only.
+    At most max_engines engines are kept, so settings built per request (like per user api keys) do not leak
+    connection pools and background threads, the least recently used engine is closed
+    :param llm_settings: (dict) the settings
+    :param chroma_settings: (dict) the settings
+    :param embedding_model_settings: (dict) the settings
+    :param memory_settings: (dict) the settings
+    :return: (ChatEngine) the engine
+    """
+    key = repr((llm_settings, chroma_settings, embedding_model_settings, memory_settings))
+    evicted = list()
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = ChatEngine(llm_settings=llm_settings,
+                                chroma_settings=chroma_settings,
+                                embedding_model_settings=embedding_model_settings,
+                                memory_settings=memory_settings)
+            _engines[key] = engine
+            while len(_engines) > max(1, max_engines):
+                evicted.append(_engines.popitem(last=False)[1])
+        else:
+            _engines.move_to_end(key)
+    # closing writes queued conversations, it is done outside of the lock
+    for old in evicted:
+        old.close()
+    return engine
+
+
+def close_engines():
+    """
+    Closes and forgets all engines created by get_engine, like before shutdown
+    """
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.close()
 
 
 def chat(query, system_message,
@@ -16,7 +931,7 @@ def chat(query, system_message,
          unique_message_id = None,
          buffer_window_chats = None):
     """
-    This is the entry point for the LLM Chatbot
+    This is the entry point for the LLM Chatbot, it uses a shared ChatEngine for the given settings
     :param query: (str) current query that you want to ask LLM
     :param system_message: (str) the system message
     :param llm_settings: (dict) the settings
@@ -30,80 +945,133 @@ def chat(query, system_message,
     :param buffer_window_chats: (list) list of chat messages in openai format excluding system message if None then no past conversation will be shown to model
     :return: Returns the chats response from Ollama or OpenAI
     """
-    chroma_client = create_client(chroma_host=chroma_settings['host'],
-                                  chroma_port=chroma_settings['port'],
-                                  settings=chroma_settings['settings'])
-    if memory:
-        # If memory is enabled
-        if collection_name is None or unique_session_id is None or unique_message_id is None:
-            raise ValueError('Collection name, unique session id, and unique message id are required')
-
-        # creating embeddings for query
-        query_embedding = run_embedding(embedding_model_settings=embedding_model_settings, query=query)
-
-        # fetching memory / history of chats from vector database
-        memories = recall(query, collection_name, unique_session_id, chroma_client,
-                          query_embedding, try_queries=memory_settings['try_queries'],
-                          results_per_query=memory_settings['results_per_query'],
-                          llm_settings=llm_settings,
-                          embedding_model_settings=embedding_model_settings, )
-
-        # formatting the message system message, buffer_window_chats, user query and memories fetched in openai format
-        if buffer_window_chats is None:
-            buffer_window_chats = []
-        messages = [
-                       {'role': 'system',
-                        'content': system_message + f"\nHere is the memory of old conversations-\n{memories}\n"},
-                   ] + buffer_window_chats + [{'role': 'user', 'content': query}]
-
-        # just printing the prompt
-        for i in messages:
-            cprint(f"{i['role']}: {i['content']}", color='cyan')
-
-        # Final chat with llm using openai or ollama
-        if llm_settings['provider'] == 'ollama':
-            chat_response = ollama_chat(messages=messages,
-                                        model=llm_settings['model'],
-                                        base_url=llm_settings['base_url'],
-                                        options=llm_settings['options'])
-            chat_response = chat_response['message']['content']
-        else:
-            chat_response = openai_chat(messages=messages, api_key=llm_settings['api_key'],
-                                        base_url=llm_settings['base_url'], model=llm_settings['model'])
-            chat_response = chat_response.choices[0].message.content
+    engine = get_engine(llm_settings=llm_settings,
+                        chroma_settings=chroma_settings,
+                        embedding_model_settings=embedding_model_settings,
+                        memory_settings=memory_settings)
+    return engine.chat(query=query, system_message=system_message,
+                       memory=memory,
+                       collection_name=collection_name,
+                       unique_session_id=unique_session_id,
+                       unique_message_id=unique_message_id,
+                       buffer_window_chats=buffer_window_chats)
 
-        # saving conversation just happened in vector store
-        data = f"user: {query}\nassistant: {chat_response}"
 
-        # creating embedding of conversation
-        data_embedding = run_embedding(embedding_model_settings=embedding_model_settings, query=data)
+async def achat(query, system_message,
+                llm_settings, chroma_settings, embedding_model_settings, memory_settings,
+                memory = True,
+                collection_name = None,
+                unique_session_id = None,
+                unique_message_id = None,
+                buffer_window_chats = None):
+    """
+    Asyncio version of chat, it uses a shared ChatEngine for the given settings
+    :param query: (str) current query that you want to ask LLM
+    :param system_message: (str) the system message
+    :param llm_settings: (dict) the settings
+    :param chroma_settings: (dict) the settings
+    :param embedding_model_settings: (dict) the settings
+    :param memory_settings: (dict) the settings
+    :param memory: (bool) the memory settings if true then vector memory will be automatically managed using chroma db
+    :param collection_name: (str) chroma db collection name
+    :param unique_session_id: (str) unique session id for the session using in chroma db
+    :param unique_message_id: (str) unique message id using in chroma db
+    :param buffer_window_chats: (list) list of chat messages in openai format excluding system message if None then no past conversation will be shown to model
+    :return: Returns the chats response from Ollama or OpenAI
+    """
+    engine = get_engine(llm_settings=llm_settings,
+                        chroma_settings=chroma_settings,
+                        embedding_model_settings=embedding_model_settings,
+                        memory_settings=memory_settings)
+    return await engine.achat(query=query, system_message=system_message,
+                              memory=memory,
+                              collection_name=collection_name,
+                              unique_session_id=unique_session_id,
+                              unique_message_id=unique_message_id,
+                              buffer_window_chats=buffer_window_chats)
 
-        # pushing conversation into vector database
-        push_msg_to_vector_store(collection_name=collection_name, unique_session_id=unique_session_id,
-                                 unique_message_id=unique_message_id, chroma_client=chroma_client,
-                                 embeddings=data_embedding,
-                                 data=data)
-        return chat_response
-    else:
-        # if memory is set to False
 
-        # converting system message and query to openai format
-        if buffer_window_chats is None:
-            buffer_window_chats = []
+def chat_stream(query, system_message,
+                llm_settings, chroma_settings, embedding_model_settings, memory_settings,
+                memory = True,
+                collection_name = None,
+                unique_session_id = None,
+                unique_message_id = None,
+                buffer_window_chats = None):
+    """
+    Streaming version of chat, parameters are same as chat
+    :return: (ChatStream) iterator over the text chunks of the answer
+    """
+    engine = get_engine(llm_settings=llm_settings,
+                        chroma_settings=chroma_settings,
+                        embedding_model_settings=embedding_model_settings,
+                        memory_settings=memory_settings)
+    return engine.chat_stream(query=query, system_message=system_message,
+                              memory=memory,
+                              collection_name=collection_name,
+                              unique_session_id=unique_session_id,
+                              unique_message_id=unique_message_id,
+                              buffer_window_chats=buffer_window_chats)
 
-        messages = [
-                       {'role': 'system', 'content': system_message},
-                   ] + buffer_window_chats + [{'role': 'user', 'content': query}]
 
-        # chat with llm using openai or ollama
-        if llm_settings['provider'] == 'ollama':
-            chat_response = ollama_chat(messages=messages, model=llm_settings['model'],
-                                        base_url=llm_settings['base_url'],
-                                        options=llm_settings['options'])
-        else:
-            chat_response = openai_chat(messages=messages, api_key=llm_settings['api_key'],
-                                        base_url=llm_settings['base_url'], model=llm_settings['model'])
-        return chat_response
+def achat_stream(query, system_message,
+                 llm_settings, chroma_settings, embedding_model_settings, memory_settings,
+                 memory = True,
+                 collection_name = None,
+                 unique_session_id = None,
+                 unique_message_id = None,
+                 buffer_window_chats = None):
+    """
+    Asyncio streaming version of chat, parameters are same as chat
+    :return: (AsyncChatStream) async iterator over the text chunks of the answer
+    """
+    engine = get_engine(llm_settings=llm_settings,
+                        chroma_settings=chroma_settings,
+                        embedding_model_settings=embedding_model_settings,
+                        memory_settings=memory_settings)
+    return engine.achat_stream(query=query, system_message=system_message,
+                               memory=memory,
+                               collection_name=collection_name,
+                               unique_session_id=unique_session_id,
+                               unique_message_id=unique_message_id,
+                               buffer_window_chats=buffer_window_chats)
+
+
+def chat_many(requests, llm_settings, chroma_settings, embedding_model_settings, memory_settings,
+              max_workers = 8, provider_limits = None, embed_batch_size = 64):
+    """
+    Runs many chats in a thread pool using a shared ChatEngine for the given settings, see ChatEngine.chat_many
+    :param requests: (iterable) dicts with chat parameters: query, system_message and optional request_id, memory,
+                     collection_name, unique_session_id, unique_message_id, buffer_window_chats
+    :param llm_settings: (dict) the settings
+    :param chroma_settings: (dict) the settings
+    :param embedding_model_settings: (dict) the settings
+    :param memory_settings: (dict) the settings
+    :param max_workers: (int) number of worker threads
+    :param provider_limits: (dict) optional max concurrent llm calls per provider, like {'ollama': 2}
+    :param embed_batch_size: (int) number of requests whose queries are embedded in one request
+    :return: (generator) dicts with request_id, response and error, in completion order
+    """
+    engine = get_engine(llm_settings=llm_settings,
+                        chroma_settings=chroma_settings,
+                        embedding_model_settings=embedding_model_settings,
+                        memory_settings=memory_settings)
+    return engine.chat_many(requests, max_workers=max_workers, provider_limits=provider_limits,
+                            embed_batch_size=embed_batch_size)
+
+
+def achat_many(requests, llm_settings, chroma_settings, embedding_model_settings, memory_settings,
+               max_concurrency = 64, provider_limits = None, embed_batch_size = 64):
+    """
+    Asyncio version of chat_many, see ChatEngine.achat_many
+    :return: (async generator) dicts with request_id, response and error, in completion order
+    """
+    engine = get_engine(llm_settings=llm_settings,
+                        chroma_settings=chroma_settings,
+                        embedding_model_settings=embedding_model_settings,
+                        memory_settings=memory_settings)
+    return engine.achat_many(requests, max_concurrency=max_concurrency, provider_limits=provider_limits,
+                             embed_batch_size=embed_batch_size)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,23 @@
 import ast
-import chromadb
+import asyncio
 import os
-from ollama import Client
-from openai import OpenAI
-from tqdm import tqdm
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+try:
+    from models import run_embedding, arun_embedding
+    from memory_backends import as_backend, get_collection
+    from memory_assembler import assemble_memories
+    from instrumentation import span, count, is_verbose
+    from providers import as_provider
+except:
+    from auto_llm_chatbot.models import run_embedding, arun_embedding
+    from auto_llm_chatbot.memory_backends import as_backend, get_collection
+    from auto_llm_chatbot.memory_assembler import assemble_memories
+    from auto_llm_chatbot.instrumentation import span, count, is_verbose
+    from auto_llm_chatbot.providers import as_provider
 
 
 def create_client(chroma_host: str = None, chroma_port: int = None, settings = None):
@@ -14,13 +28,16 @@ def create_client(chroma_host: str = None, chroma_port: int = None, settings = N
     :param settings: (dict) The settings for the chroma client optional, if None then it will create persistent client
     :return: (object) The chroma client instance
     """
-    if chroma_host is None or chroma_port is None:
-        chroma_client = chromadb.PersistentClient()
-    else:
-        chroma_client = chromadb.HttpClient(host=chroma_host,
-                                            port=chroma_port,
-                                            settings=settings,
-                                            )
+    # chromadb is imported on first use, it is the slowest import of the package
+    import chromadb
+    with span('client_creation', provider='chroma'):
+        if chroma_host is None or chroma_port is None:
+            chroma_client = chromadb.PersistentClient()
+        else:
+            chroma_client = chromadb.HttpClient(host=chroma_host,
+                                                port=chroma_port,
+                                                settings=settings,
+                                                )
     return chroma_client
 
 
@@ -36,34 +53,44 @@ def push_msg_to_vector_store(collection_name: str, unique_session_id, unique_mes
     :param data: (str) The message data you want to push to the vector store
     :return: (bool) True if successful push to the vector store and false otherwise
     """
+    return push_msgs_to_vector_store(collection_name=collection_name, unique_session_id=unique_session_id,
+                                     unique_message_ids=[unique_message_id], chroma_client=chroma_client,
+                                     embeddings=[embeddings], data=[data])
+
+
+def push_msgs_to_vector_store(collection_name: str, unique_session_id, unique_message_ids, chroma_client, embeddings,
+                              data):
+    """
+    This function is used to push many messages of a session to the vector store in one call
+    :param collection_name: (str) The name of the collection
+    :param unique_session_id: (str) The unique session
+    :param unique_message_ids: (list) The unique message ids
+    :param chroma_client: (object) The chroma client instance or a MemoryBackend
+    :param embeddings: (list) The embedding of each message
+    :param data: (list) The message data of each message
+    :return: (bool) True if successful push to the vector store and false otherwise
+    """
     try:
-        vector_db_name = f'{collection_name}-{unique_session_id}'
-        vector_db = chroma_client.get_or_create_collection(name=vector_db_name)
-        vector_db.add(
-            ids=[unique_message_id],
-            embeddings=[embeddings],
-            documents=[data],
-            metadatas=[{"collection_name": collection_name,
-                        "unique_session_id": unique_session_id,
-                        "unique_message_id": unique_message_id,
-                        }]
-        )
+        created_at = time.time()
+        with span('write_push', messages=len(unique_message_ids)):
+            as_backend(chroma_client).add(
+                collection_name, unique_session_id,
+                unique_message_ids=list(unique_message_ids),
+                embeddings=list(embeddings),
+                documents=list(data),
+                metadatas=[{"collection_name": collection_name,
+                            "unique_session_id": unique_session_id,
+                            "unique_message_id": unique_message_id,
+                            "created_at": created_at,
+                            } for unique_message_id in unique_message_ids]
+            )
         return True
     except Exception as e:
         print(f"ERROR: {e}")
         return False
 
 
-def create_queries(prompt, provider, base_url, chat_model_name, api_key = None):
-    """
-    This will create refine queries to search in vector database, this can be user for retrieving from vector database
-    :param prompt: (str) Original query / msg / prompt from user end
-    :param provider: (enum) It can be 'openai' or 'ollama'
-    :param base_url: (str) base url for the model
-    :param chat_model_name: (str) model name you want to use
-    :param api_key: (str) API key you want to use for openai model
-    :return: (list) List of refine queries
-    """
+def _query_convo(prompt):
     query_msg = (
         'You are a first principle reasoning search query AI agent.'
         'Your list of search queries will be ran on an embedding database of all your conversations '
@@ -84,116 +111,503 @@ def create_queries(prompt, provider, base_url, chat_model_name, api_key = None):
          'content': '["Who is smith?", "How Smith is related to user?", "Is Smith is nickname of user?", "What is assistant nickname?"]'},
         {'role': 'user', 'content': prompt}
     ]
-    if provider == 'ollama':
-        ollama_client = Client(host=base_url)
-        response = ollama_client.chat(model=chat_model_name, messages=query_convo,
-                                      options={'num_predict': 90})
-        response = response['message']['content']
-    elif provider == 'openai':
-        client = OpenAI(
-            base_url=base_url,
-            api_key=api_key,
-        )
-        response = client.chat.completions.create(
-            messages=query_convo,
-            model=chat_model_name,
-        )
-        response = response.choices[0].message.content
-    else:
-        print('WARNING: Invalid provider. Supported providers are: ollama, openai')
-        return [prompt]
-    try:
-        queries_ = ast.literal_eval(response) + [prompt]
-        if len(queries_) > 3:
-            queries_ = queries_[-3:]
-        print(f'\nVector Database Queries sliced: {queries_}\n')
-        return queries_
-    except Exception as e:
-        print(f"Warning: {e}")
+    return query_convo
+
+
+def _parse_queries(response, prompt):
+    """
+    Parses the python list of queries from the model response, returns None if there is no valid list
+    """
+    candidates = [response]
+    match = re.search(r'\[.*\]', response, re.DOTALL)
+    if match is not None and match.group(0) != response:
+        # models often wrap the list in code fences or a sentence
+        candidates.append(match.group(0))
+    for candidate in candidates:
+        try:
+            queries_ = ast.literal_eval(candidate.strip())
+        except Exception:
+            continue
+        if isinstance(queries_, (list, tuple)) and all(isinstance(query, str) for query in queries_):
+            queries_ = list(queries_) + [prompt]
+            if len(queries_) > 3:
+                queries_ = queries_[-3:]
+            if is_verbose():
+                print(f'\nVector Database Queries sliced: {queries_}\n')
+            return queries_
+    _count('parse_failures')
+    print(f"Warning: could not parse refined queries from model response: {response!r}")
+    if is_verbose():
         print(f'\nVector Database Queries: {[prompt]}\n')
+    return None
+
+
+class QueryRewriteCache:
+    """
+    LRU cache of refined queries keyed by (provider, model, normalized prompt)
+    """
+
+    def __init__(self, max_size = 1000, ttl = None):
+        """
+        :param max_size: (int) max number of prompts kept in cache
+        :param ttl: (float) seconds after which refined queries expire, if None then they never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    @staticmethod
+    def key(provider, chat_model_name, prompt):
+        return provider, chat_model_name, ' '.join(prompt.lower().split())
+
+    def get(self, provider, chat_model_name, prompt):
+        key = self.key(provider, chat_model_name, prompt)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if self.ttl is not None and time.time() - item[1] > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            # refined queries end with the original prompt, which may differ in case / spaces
+            return item[0][:-1] + [prompt]
+
+    def put(self, provider, chat_model_name, prompt, queries):
+        key = self.key(provider, chat_model_name, prompt)
+        with self._lock:
+            self._items[key] = (list(queries), time.time())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# default cache, used when memory_settings has no 'rewrite_cache'
+query_rewrite_cache = QueryRewriteCache()
+
+_rewrite_stats = Counter()
+_rewrite_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _rewrite_stats_lock:
+        _rewrite_stats[name] += 1
+
+
+def get_rewrite_stats():
+    """
+    :return: (dict) how often queries were refined by the model, served from cache or skipped (by reason)
+    """
+    with _rewrite_stats_lock:
+        return dict(_rewrite_stats)
+
+
+def get_rewrite_cache(memory_settings):
+    """
+    :param memory_settings: (dict) the memory settings
+    :return: (QueryRewriteCache) cache from settings 'rewrite_cache' key, default cache if key is missing or None if it is False
+    """
+    cache = memory_settings.get('rewrite_cache')
+    if cache is None:
+        return query_rewrite_cache
+    if cache is False:
+        return None
+    return cache
+
+
+# words which make a query depend on the conversation, refined queries can find what they refer to
+_CONTEXT_WORDS = {
+    'i', 'me', 'my', 'mine', 'myself', 'we', 'us', 'our', 'ours', 'you', 'your', 'yours',
+    'he', 'him', 'his', 'she', 'her', 'hers', 'they', 'them', 'their', 'it', 'its',
+    'this', 'that', 'these', 'those', 'there', 'then', 'again', 'before', 'earlier', 'previous',
+    'previously', 'last', 'above', 'same', 'remember', 'said', 'told', 'mentioned',
+}
+
+
+def rewrite_skip_reason(prompt, min_words = 3):
+    """
+    Cheap check whether refining the prompt with the model can help
+    :param prompt: (str) Original query / msg / prompt from user end
+    :param min_words: (int) prompts with less words than this are not refined
+    :return: (str) 'short' or 'self_contained' if prompt should not be refined, None otherwise
+    """
+    words = re.findall(r"[a-z0-9']+", prompt.lower())
+    if len(words) < min_words:
+        return 'short'
+    if not _CONTEXT_WORDS.intersection(word.split("'")[0] for word in words):
+        return 'self_contained'
+    return None
+
+
+def collection_count(collection_name: str, unique_session_id, chroma_client):
+    """
+    :return: (int) number of messages stored for the session
+    """
+    with span('vector_count'):
+        return as_backend(chroma_client).count(collection_name, unique_session_id)
+
+
+def collection_is_empty(collection_name: str, unique_session_id, chroma_client):
+    """
+    :return: (bool) True if no message is stored for the session, it is cheaper than collection_count
+    """
+    with span('vector_count'):
+        return as_backend(chroma_client).is_empty(collection_name, unique_session_id)
+
+
+def create_queries(prompt, provider, base_url, chat_model_name, api_key = None, client = None, cache = None):
+    """
+    This will create refine queries to search in vector database, this can be user for retrieving from vector database
+    :param prompt: (str) Original query / msg / prompt from user end
+    :param provider: (str) 'openai', 'ollama' or a provider added with register_provider
+    :param base_url: (str) base url for the model
+    :param chat_model_name: (str) model name you want to use
+    :param api_key: (str) API key you want to use for openai model
+    :param client: (object) optional reusable provider or ollama / openai client, if None then a new one is created
+    :param cache: (QueryRewriteCache) optional cache of refined queries
+    :return: (list) List of refine queries
+    """
+    if cache is not None:
+        queries_ = cache.get(provider, chat_model_name, prompt)
+        if queries_ is not None:
+            _count('cache_hits')
+            return queries_
+    try:
+        llm = as_provider({'provider': provider, 'base_url': base_url, 'api_key': api_key}, client=client)
+    except ValueError as e:
+        print(f'WARNING: {e}')
+        return [prompt]
+    with span('create_queries', provider=provider):
+        response = llm.chat(_query_convo(prompt), chat_model_name, options={'num_predict': 90})
+    response = llm.content(response)
+    return _store_queries(response, prompt, provider, chat_model_name, cache)
+
+
+def _store_queries(response, prompt, provider, chat_model_name, cache):
+    _count('rewrites')
+    queries_ = _parse_queries(response, prompt)
+    if queries_ is None:
         return [prompt]
+    if cache is not None:
+        cache.put(provider, chat_model_name, prompt, queries_)
+    return queries_
+
+
+def search_vector_store(collection_name: str, unique_session_id, chroma_client, query_embeddings,
+                        results_per_query = 2):
+    """
+    This function searches many query embeddings in one vector database call
+    :param collection_name: (str) name of the collection of vector database
+    :param unique_session_id: (str) unique session id for vector database
+    :param chroma_client: (obj) chroma client object
+    :param query_embeddings: (list) list of query embeddings
+    :param results_per_query: (int) number of similar docs to fetch per query embedding
+    :return: (dict) 'ids', 'documents' and 'distances', each a list per query embedding, nearest first
+    """
+    with span('vector_query', queries=len(query_embeddings)):
+        return as_backend(chroma_client).query(collection_name, unique_session_id, query_embeddings,
+                                               n_results=results_per_query)
+
+
+def query_vector_store(collection_name: str, unique_session_id, chroma_client, query_embeddings,
+                       results_per_query = 2):
+    """
+    This function searches many query embeddings in one vector database call
+    :param collection_name: (str) name of the collection of vector database
+    :param unique_session_id: (str) unique session id for vector database
+    :param chroma_client: (obj) chroma client object
+    :param query_embeddings: (list) list of query embeddings
+    :param results_per_query: (int) number of similar docs to fetch per query embedding
+    :return: (list) list of memories (list of strings) per query embedding
+    """
+    return search_vector_store(collection_name, unique_session_id, chroma_client, query_embeddings,
+                               results_per_query=results_per_query)['documents']
 
 
 def retrieve_embeddings(collection_name: str, unique_session_id, chroma_client,
                         query_embedding,
                         results_per_query = 2):
     embeddings = list()
-    vector_db_name = f'{collection_name}-{unique_session_id}'
-    vector_db = chroma_client.get_or_create_collection(name=vector_db_name)
-    results = vector_db.query(query_embeddings=[query_embedding], n_results=results_per_query)
-    best_embeddings = results['documents'][0]
+    best_embeddings = query_vector_store(collection_name, unique_session_id, chroma_client,
+                                         [query_embedding], results_per_query=results_per_query)[0]
     for best in best_embeddings:
         embeddings.append(best)
     return embeddings
 
 
+def embed_once(texts, embedded, embedding_model_settings, client = None):
+    """
+    This function embeds the texts which are not embedded yet in this turn, in one request
+    :param texts: (list) list of texts
+    :param embedded: (dict) embeddings of this turn as {text: embedding}, new embeddings are added into it
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :param client: (object) optional reusable ollama / openai embedding client
+    :return: (list) list of embeddings of texts
+    """
+    missing = [text for text in dict.fromkeys(texts) if text not in embedded]
+    if missing:
+        embedded.update(zip(missing, run_embedding(embedding_model_settings=embedding_model_settings,
+                                                   query=missing, client=client)))
+    return [embedded[text] for text in texts]
+
+
 def retrieve_embeddings_try_queries(queries, collection_name: str, unique_session_id, chroma_client,
-                                    results_per_query = 2, embedding_model_settings = None):
+                                    results_per_query = 2, embedding_model_settings = None, client = None,
+                                    embedded = None):
     """
     This function is used to retrieve embeddings (memories as list of strings) from vector databas
+    all queries are embedded in one request and searched in one vector database call
     :param queries: (list) list of queries
     :param collection_name: (str) name of the collection of vector database
     :param unique_session_id: (str) unique session id for vector database
     :param chroma_client: (obj) chroma client object
     :param results_per_query: (int) number of similar docs to fetch
     :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :param client: (object) optional reusable ollama / openai embedding client
+    :param embedded: (dict) optional embeddings of this turn as {text: embedding}, reused and filled
     :return: (list) list of memories as list of strings
     """
-    embeddings = list()
-    vector_db_name = f'{collection_name}-{unique_session_id}'
-    if embedding_model_settings['provider'] == 'ollama':
-        llm_client = Client(host=embedding_model_settings['base_url'])
-    else:
-        llm_client = OpenAI(api_key=embedding_model_settings['api_key'], base_url=embedding_model_settings['base_url'])
-
-    for query in tqdm(queries, desc='Processing queries to vector database'):
-        if embedding_model_settings['provider'] == 'ollama':
-            response = llm_client.embeddings(model=embedding_model_settings['model'], prompt=query)
-            query_embedding = response['embedding']
-        else:
-            response = llm_client.embeddings.create(
-                input=query,
-                model=embedding_model_settings['model']
-            )
-            query_embedding = response.data[0].embedding
-        vector_db = chroma_client.get_or_create_collection(name=vector_db_name)
-        results = vector_db.query(query_embeddings=[query_embedding], n_results=results_per_query)
-        best_embeddings = results['documents'][0]
-        for best in best_embeddings:
-            embeddings.append(best)
-    print(f"{len(embeddings)} past conversation fetched.'")
+    results = search_try_queries(queries, collection_name, unique_session_id, chroma_client,
+                                 results_per_query=results_per_query,
+                                 embedding_model_settings=embedding_model_settings, client=client,
+                                 embedded=embedded)
+    embeddings = [best for best_embeddings in results['documents'] for best in best_embeddings]
+    if is_verbose():
+        print(f"{len(embeddings)} past conversation fetched.'")
     return embeddings
 
 
+def search_try_queries(queries, collection_name: str, unique_session_id, chroma_client, results_per_query = 2,
+                       embedding_model_settings = None, client = None, embedded = None):
+    """
+    Same as retrieve_embeddings_try_queries but returns the search results with message ids and distances
+    :return: (dict) 'ids', 'documents' and 'distances', each a list per unique query
+    """
+    if embedded is None:
+        embedded = dict()
+    queries = list(dict.fromkeys(queries))
+    with span('query_embedding', texts=len(queries)):
+        query_embeddings = embed_once(queries, embedded, embedding_model_settings, client=client)
+    return search_vector_store(collection_name, unique_session_id, chroma_client, query_embeddings,
+                               results_per_query=results_per_query)
+
+
+def _assemble(results, token_budget, token_counter):
+    memories = assemble_memories(results, token_budget=token_budget, token_counter=token_counter)
+    stats = memories['memory_stats']
+    count(memories_fetched=stats['fetched'], memories_used=stats['used'], memory_tokens=stats['tokens'],
+          memory_tokens_saved=stats['tokens_saved'])
+    if is_verbose():
+        print(f"{stats['fetched']} past conversation fetched, {stats['used']} used, "
+              f"{stats['tokens_saved']} tokens saved.")
+    return memories
+
+
+_no_results = {'ids': [], 'documents': [], 'distances': []}
+
+
+def _gate_rewrite(query, min_words):
+    reason = rewrite_skip_reason(query, min_words=min_words)
+    if reason is not None:
+        _count(f'skipped_{reason}')
+        return False
+    return True
+
+
 def recall(query, collection_name, unique_session_id, chroma_client,
-           query_embedding, try_queries = False, results_per_query = 2, llm_settings = None,
-           embedding_model_settings = None):
+           query_embedding = None, try_queries = False, results_per_query = 2, llm_settings = None,
+           embedding_model_settings = None, llm_client = None, embedding_client = None, embedded = None,
+           rewrite_cache = None, rewrite_gate = False, rewrite_min_words = 3, token_budget = None,
+           token_counter = None):
     """
     This function is used to recall memories from vector database
     :param query: (str) original query
     :param collection_name: (str) name of the collection of vector database
     :param unique_session_id: (str) unique session id for vector database
     :param chroma_client: (obj) chroma client object
-    :param query_embedding: (list) embedding of the query
+    :param query_embedding: (list) embedding of the query, if None then it will be created when needed
     :param try_queries: (bool) flag to use refined queries
     :param results_per_query: (int) number of similar docs to fetch
     :param llm_settings: (dict) dictionary of llm settings
     :param embedding_model_settings: (dict) dictionary of embeddings models settings
-    :return: (dict) dictionary with memories
+    :param llm_client: (object) optional reusable ollama / openai client for refining queries
+    :param embedding_client: (object) optional reusable ollama / openai client for embeddings
+    :param embedded: (dict) optional embeddings of this turn as {text: embedding}, every text is embedded once
+    :param rewrite_cache: (QueryRewriteCache) optional cache of refined queries
+    :param rewrite_gate: (bool) if true and try_queries then queries are not refined for empty sessions, short or
+                         self-contained queries
+    :param rewrite_min_words: (int) queries with less words than this are not refined when rewrite_gate is true
+    :param token_budget: (int) maximum tokens of memories optional, if None then all unique memories are used
+    :param token_counter: (callable) counts tokens of a text optional, default is a local estimate
+    :return: (dict) dictionary with memories and memory_stats of this turn
     """
+    if embedded is None:
+        embedded = dict()
+    if query_embedding is not None:
+        embedded[query] = query_embedding
     chat_model_name = llm_settings['model']
     api_key = llm_settings['api_key']
     provider = llm_settings['provider']
     base_url_chat_model = llm_settings['base_url']
+    if rewrite_gate and try_queries:
+        if collection_is_empty(collection_name, unique_session_id, chroma_client):
+            # nothing to recall, so no need to refine, embed or search
+            _count('skipped_empty')
+            return assemble_memories(_no_results, token_budget=token_budget, token_counter=token_counter)
+        try_queries = _gate_rewrite(query, rewrite_min_words)
     if try_queries:
         queries = create_queries(prompt=query, provider=provider, base_url=base_url_chat_model,
-                                 chat_model_name=chat_model_name, api_key=api_key)
-        embeddings = retrieve_embeddings_try_queries(queries, collection_name, unique_session_id, chroma_client,
-                                                     results_per_query=results_per_query,
-                                                     embedding_model_settings=embedding_model_settings)
+                                 chat_model_name=chat_model_name, api_key=api_key, client=llm_client,
+                                 cache=rewrite_cache)
+        results = search_try_queries(queries, collection_name, unique_session_id, chroma_client,
+                                     results_per_query=results_per_query,
+                                     embedding_model_settings=embedding_model_settings,
+                                     client=embedding_client, embedded=embedded)
     else:
-        embeddings = retrieve_embeddings(collection_name, unique_session_id, chroma_client,
-                                         query_embedding,
-                                         results_per_query=results_per_query)
-    memories = {'memories': f'{embeddings}'}
-    return memories
+        with span('query_embedding', texts=1):
+            query_embedding = embed_once([query], embedded, embedding_model_settings, client=embedding_client)[0]
+        results = search_vector_store(collection_name, unique_session_id, chroma_client, [query_embedding],
+                                      results_per_query=results_per_query)
+    return _assemble(results, token_budget, token_counter)
+
+
+async def acreate_queries(prompt, provider, chat_model_name, client, cache = None):
+    """
+    Asyncio version of create_queries
+    :param prompt: (str) Original query / msg / prompt from user end
+    :param provider: (str) 'openai', 'ollama' or a provider added with register_provider
+    :param chat_model_name: (str) model name you want to use
+    :param client: (object) provider, ollama AsyncClient or AsyncOpenAI client
+    :param cache: (QueryRewriteCache) optional cache of refined queries
+    :return: (list) List of refine queries
+    """
+    if cache is not None:
+        queries_ = cache.get(provider, chat_model_name, prompt)
+        if queries_ is not None:
+            _count('cache_hits')
+            return queries_
+    try:
+        llm = as_provider({'provider': provider}, async_client=client)
+    except ValueError as e:
+        print(f'WARNING: {e}')
+        return [prompt]
+    with span('create_queries', provider=provider):
+        response = await llm.achat(_query_convo(prompt), chat_model_name, options={'num_predict': 90})
+    response = llm.content(response)
+    return _store_queries(response, prompt, provider, chat_model_name, cache)
+
+
+async def aembed_queries(embedding_model_settings, query, client):
+    """
+    arun_embedding of queries, timed as query_embedding stage of the current turn
+    """
+    if isinstance(query, list) and not query:
+        return []
+    with span('query_embedding', texts=len(query) if isinstance(query, list) else 1):
+        return await arun_embedding(embedding_model_settings=embedding_model_settings, query=query, client=client)
+
+
+async def aretrieve_embeddings(collection_name: str, unique_session_id, chroma_client,
+                               query_embedding,
+                               results_per_query = 2):
+    # chroma client is blocking, so running it in a worker thread
+    return await asyncio.to_thread(retrieve_embeddings, collection_name, unique_session_id, chroma_client,
+                                   query_embedding, results_per_query)
+
+
+async def aretrieve_embeddings_try_queries(queries, collection_name: str, unique_session_id, chroma_client,
+                                           client, results_per_query = 2, embedding_model_settings = None,
+                                           query_embeddings = None):
+    """
+    Asyncio version of retrieve_embeddings_try_queries
+    :param queries: (list) list of queries
+    :param collection_name: (str) name of the collection of vector database
+    :param unique_session_id: (str) unique session id for vector database
+    :param chroma_client: (obj) chroma client object
+    :param client: (object) ollama AsyncClient or AsyncOpenAI embedding client
+    :param results_per_query: (int) number of similar docs to fetch
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :param query_embeddings: (dict) optional already started embeddings as {query: awaitable}
+    :return: (list) list of memories as list of strings
+    """
+    results = await asearch_try_queries(queries, collection_name, unique_session_id, chroma_client, client,
+                                        results_per_query=results_per_query,
+                                        embedding_model_settings=embedding_model_settings,
+                                        query_embeddings=query_embeddings)
+    embeddings = [best for best_embeddings in results['documents'] for best in best_embeddings]
+    if is_verbose():
+        print(f"{len(embeddings)} past conversation fetched.'")
+    return embeddings
+
+
+async def asearch_try_queries(queries, collection_name: str, unique_session_id, chroma_client, client,
+                              results_per_query = 2, embedding_model_settings = None, query_embeddings = None):
+    """
+    Asyncio version of search_try_queries
+    :param query_embeddings: (dict) optional already started embeddings as {query: awaitable}
+    :return: (dict) 'ids', 'documents' and 'distances', each a list per unique query
+    """
+    if query_embeddings is None:
+        query_embeddings = dict()
+    queries = list(dict.fromkeys(queries))
+    known = [query for query in queries if query in query_embeddings]
+    missing = [query for query in queries if query not in query_embeddings]
+    # one batched request for new queries while the already started embeddings finish
+    results = await asyncio.gather(
+        aembed_queries(embedding_model_settings=embedding_model_settings, query=missing, client=client),
+        *[query_embeddings[query] for query in known])
+    embedded = dict(zip(missing, results[0]))
+    embedded.update(zip(known, results[1:]))
+    return await asyncio.to_thread(search_vector_store, collection_name, unique_session_id, chroma_client,
+                                   [embedded[query] for query in queries], results_per_query)
+
+
+async def arecall(query, collection_name, unique_session_id, chroma_client,
+                  query_embedding, try_queries = False, results_per_query = 2, llm_settings = None,
+                  embedding_model_settings = None, llm_client = None, embedding_client = None,
+                  rewrite_cache = None, rewrite_gate = False, rewrite_min_words = 3, token_budget = None,
+                  token_counter = None):
+    """
+    Asyncio version of recall, refining queries runs while the query embedding is still in flight
+    :param query: (str) original query
+    :param collection_name: (str) name of the collection of vector database
+    :param unique_session_id: (str) unique session id for vector database
+    :param chroma_client: (obj) chroma client object
+    :param query_embedding: (awaitable) task or future giving the embedding of the query
+    :param try_queries: (bool) flag to use refined queries
+    :param results_per_query: (int) number of similar docs to fetch
+    :param llm_settings: (dict) dictionary of llm settings
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :param llm_client: (object) ollama AsyncClient or AsyncOpenAI client for refining queries
+    :param embedding_client: (object) ollama AsyncClient or AsyncOpenAI client for embeddings
+    :param rewrite_cache: (QueryRewriteCache) optional cache of refined queries
+    :param rewrite_gate: (bool) if true and try_queries then queries are not refined for empty sessions, short or
+                         self-contained queries
+    :param rewrite_min_words: (int) queries with less words than this are not refined when rewrite_gate is true
+    :param token_budget: (int) maximum tokens of memories optional, if None then all unique memories are used
+    :param token_counter: (callable) counts tokens of a text optional, default is a local estimate
+    :return: (dict) dictionary with memories and memory_stats of this turn
+    """
+    if rewrite_gate and try_queries:
+        if await asyncio.to_thread(collection_is_empty, collection_name, unique_session_id, chroma_client):
+            _count('skipped_empty')
+            return assemble_memories(_no_results, token_budget=token_budget, token_counter=token_counter)
+        try_queries = _gate_rewrite(query, rewrite_min_words)
+    if try_queries:
+        queries = await acreate_queries(prompt=query, provider=llm_settings['provider'],
+                                        chat_model_name=llm_settings['model'], client=llm_client,
+                                        cache=rewrite_cache)
+        results = await asearch_try_queries(queries, collection_name, unique_session_id, chroma_client,
+                                            client=embedding_client, results_per_query=results_per_query,
+                                            embedding_model_settings=embedding_model_settings,
+                                            query_embeddings={query: query_embedding})
+    else:
+        # chroma client is blocking, so running it in a worker thread
+        results = await asyncio.to_thread(search_vector_store, collection_name, unique_session_id, chroma_client,
+                                          [await query_embedding], results_per_query)
+    return _assemble(results, token_budget, token_counter)
@@ -0,0 +1,345 @@
+import atexit
+import hashlib
+import statistics
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+try:
+    from models import run_embedding, write_settings
+    from providers import as_provider
+    from memory_backends import as_backend
+    from memory_assembler import estimate_tokens
+    from instrumentation import turn, span, count, is_verbose
+except:
+    from auto_llm_chatbot.models import run_embedding, write_settings
+    from auto_llm_chatbot.providers import as_provider
+    from auto_llm_chatbot.memory_backends import as_backend
+    from auto_llm_chatbot.memory_assembler import estimate_tokens
+    from auto_llm_chatbot.instrumentation import turn, span, count, is_verbose
+
+_summary_prompt = """You compress old parts of a conversation into one memory record.
+Summarize the conversation below in a few sentences. Keep names, facts, numbers, decisions and preferences \
+of the user, drop greetings and repetitions. Answer with the summary only."""
+
+DEFAULT_COMPACTION = {
+    'policy': 'count',
+    'max_messages': 200,
+    'keep_recent': 20,
+    'max_age': 7 * 24 * 3600,
+    'similarity_threshold': 0.2,
+    'window_size': 10,
+    'max_summaries': 10,
+    'check_every': 20,
+    'probe_repeats': 5,
+}
+
+
+def compaction_settings(settings = None):
+    """
+    Fills the defaults of compaction settings
+    :param settings: (dict) compaction settings, True or None for defaults:
+        policy: 'count' compacts when the session has more than max_messages messages,
+                'age' compacts messages older than max_age seconds,
+                'similarity' compacts groups of messages within similarity_threshold (squared l2 distance)
+        keep_recent: newest messages which are never compacted
+        window_size: max messages per summary
+        max_summaries: max summaries written in one run, so a run is short and the rest is left for the next run
+        check_every: turns of a session between background checks
+        probe_repeats: vector queries timed before and after a run, 0 disables the measurement
+    :return: (dict) the settings
+    """
+    if settings is None or settings is True:
+        settings = dict()
+    settings = {**DEFAULT_COMPACTION, **settings}
+    if settings['policy'] not in ('count', 'age', 'similarity'):
+        raise ValueError(f"Invalid compaction policy {settings['policy']!r}. "
+                         f"Supported policies are: count, age, similarity")
+    return settings
+
+
+def _created_at(metadata):
+    # messages written before created_at was stored are the oldest
+    return (metadata or {}).get('created_at', 0.0)
+
+
+def _windows(rows, size):
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
+
+
+def _clusters(rows, embeddings, threshold, size):
+    import numpy as np
+    vectors = np.asarray([embeddings[i] for i in rows], dtype=np.float32)
+    free = np.ones(len(rows), dtype=bool)
+    groups = list()
+    for i in range(len(rows)):
+        if not free[i]:
+            continue
+        distances = np.sum((vectors - vectors[i]) ** 2, axis=1)
+        members = np.flatnonzero(free & (distances <= threshold))[:size]
+        free[members] = False
+        groups.append([rows[j] for j in members])
+    return groups
+
+
+def plan_compaction(session, settings = None, now = None):
+    """
+    Chooses the messages of a session which are replaced by summaries
+    :param session: (dict) messages of the session as returned by MemoryBackend.get
+    :param settings: (dict) compaction settings, see compaction_settings
+    :param now: (float) current unix time optional, used by the 'age' policy
+    :return: (list) groups of row numbers in session, oldest first, every group becomes one summary
+    """
+    settings = compaction_settings(settings)
+    metadatas = session['metadatas']
+    rows = sorted(range(len(session['ids'])), key=lambda i: (_created_at(metadatas[i]), i))
+    candidates = rows[:max(0, len(rows) - settings['keep_recent'])]
+
+    if settings['policy'] == 'count':
+        if len(rows) <= settings['max_messages']:
+            return []
+        groups = _windows(candidates, settings['window_size'])
+    elif settings['policy'] == 'age':
+        oldest = (time.time() if now is None else now) - settings['max_age']
+        groups = _windows([i for i in candidates if _created_at(metadatas[i]) < oldest], settings['window_size'])
+    else:
+        if not candidates:
+            return []
+        groups = _clusters(candidates, session['embeddings'], settings['similarity_threshold'],
+                           settings['window_size'])
+    # a single message is not worth a summary
+    return [group for group in groups if len(group) > 1][:settings['max_summaries']]
+
+
+def summarize(documents, llm_settings, client = None):
+    """
+    Summarizes conversation messages with the chat model
+    :param documents: (list) the messages
+    :param llm_settings: (dict) the settings
+    :param client: (object) optional reusable provider or ollama / openai client
+    :return: (str) the summary
+    """
+    messages = [
+        {'role': 'system', 'content': _summary_prompt},
+        {'role': 'user', 'content': '\n\n'.join(documents)},
+    ]
+    llm = as_provider(llm_settings, client=client)
+    with span('compaction_summarize', messages=len(documents)):
+        response = llm.chat(messages, llm_settings['model'], options=llm_settings.get('options'))
+    count(**llm.usage(response))
+    summary = llm.content(response)
+    return summary.strip()
+
+
+def summary_id(unique_message_ids):
+    """
+    Id of the summary of messages, same messages give same id so an interrupted run can be repeated
+    :param unique_message_ids: (list) ids of the summarized messages
+    :return: (str) the id
+    """
+    return 'summary-' + hashlib.sha256('\n'.join(unique_message_ids).encode('utf-8')).hexdigest()[:24]
+
+
+def _retrieval_ms(backend, collection_name, unique_session_id, probe, repeats, messages):
+    if probe is None or not repeats or not messages:
+        return None
+    timings = list()
+    for _ in range(repeats):
+        started = time.perf_counter()
+        backend.query(collection_name, unique_session_id, [probe], n_results=min(3, messages))
+        timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 3)
+
+
+def compact_session(collection_name, unique_session_id, chroma_client, llm_settings, embedding_model_settings,
+                    settings = None, llm_client = None, embedding_client = None, now = None):
+    """
+    Replaces old messages of a session with summaries written by the chat model, summaries are embedded and stored
+    like messages (metadata 'summary' is True) and then the summarized messages are deleted
+    :param collection_name: (str) The name of the collection
+    :param unique_session_id: (str) The unique session
+    :param chroma_client: (object) The chroma client instance or a MemoryBackend
+    :param llm_settings: (dict) the settings of the model which writes the summaries
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :param settings: (dict) compaction settings, see compaction_settings
+    :param llm_client: (object) optional reusable ollama / openai client
+    :param embedding_client: (object) optional reusable ollama / openai embedding client
+    :param now: (float) current unix time optional, used by the 'age' policy
+    :return: (dict) report with 'summaries', 'compacted' (deleted messages), 'seconds' and 'before' / 'after'
+             index size ('messages', 'tokens') and median retrieval latency ('retrieval_ms')
+    """
+    settings = compaction_settings(settings)
+    backend = as_backend(chroma_client)
+    started = time.perf_counter()
+    with span('compaction_read'):
+        session = backend.get(collection_name, unique_session_id)
+    tokens = [estimate_tokens(document) for document in session['documents']]
+    # same probe query is timed before and after
+    probe = [float(value) for value in session['embeddings'][-1]] if len(session['embeddings']) else None
+    before = {'messages': len(session['ids']), 'tokens': sum(tokens),
+              'retrieval_ms': _retrieval_ms(backend, collection_name, unique_session_id, probe,
+                                            settings['probe_repeats'], len(session['ids']))}
+    report = {'collection_name': collection_name, 'unique_session_id': unique_session_id,
+              'policy': settings['policy'], 'summaries': 0, 'compacted': 0, 'before': before, 'after': before}
+
+    groups = plan_compaction(session, settings, now)
+    if groups:
+        summaries = [summarize([session['documents'][i] for i in group], llm_settings, client=llm_client)
+                     for group in groups]
+        documents = [f'summary of earlier conversation: {summary}' for summary in summaries]
+        with span('compaction_embedding', texts=len(documents)):
+            embeddings = run_embedding(embedding_model_settings=write_settings(embedding_model_settings),
+                                       query=documents, client=embedding_client)
+        ids = [summary_id([session['ids'][i] for i in group]) for group in groups]
+        metadatas = [{'collection_name': collection_name,
+                      'unique_session_id': unique_session_id,
+                      'unique_message_id': unique_message_id,
+                      # summary takes the place of its newest message, so age policies keep working
+                      'created_at': max(_created_at(session['metadatas'][i]) for i in group),
+                      'summary': True,
+                      'summarized': len(group),
+                      } for unique_message_id, group in zip(ids, groups)]
+        compacted = [session['ids'][i] for group in groups for i in group]
+        with span('compaction_write', summaries=len(ids), compacted=len(compacted)):
+            # summaries are written first, a failure in between leaves duplicates but loses nothing
+            backend.add(collection_name, unique_session_id, ids, embeddings, documents, metadatas)
+            backend.delete(collection_name, unique_session_id, compacted)
+        report['summaries'] = len(ids)
+        report['compacted'] = len(compacted)
+        messages = before['messages'] - len(compacted) + len(ids)
+        report['after'] = {
+            'messages': messages,
+            'tokens': (before['tokens'] - sum(tokens[i] for group in groups for i in group)
+                       + sum(estimate_tokens(document) for document in documents)),
+            'retrieval_ms': _retrieval_ms(backend, collection_name, unique_session_id, probe,
+                                          settings['probe_repeats'], messages)}
+        count(compaction_summaries=len(ids), compaction_compacted=len(compacted))
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    if is_verbose():
+        print(f"Compacted {report['compacted']} messages of {collection_name}-{unique_session_id} "
+              f"into {report['summaries']} summaries, {before['messages']} -> {report['after']['messages']} messages")
+    return report
+
+
+class Compactor:
+    """
+    Background compaction of session memories, sessions are checked every few turns and compacted
+    one at a time in a daemon thread, a run writes at most max_summaries summaries and the session
+    is checked again when more are due
+    """
+
+    def __init__(self, chroma_client, llm_settings, embedding_model_settings, settings = None,
+                 llm_client = None, embedding_client = None, hooks = None):
+        """
+        :param chroma_client: (object) The chroma client instance or a MemoryBackend
+        :param llm_settings: (dict) the settings of the model which writes the summaries
+        :param embedding_model_settings: (dict) dictionary of embeddings models settings
+        :param settings: (dict) compaction settings, see compaction_settings
+        :param llm_client: (object) optional reusable ollama / openai client
+        :param embedding_client: (object) optional reusable ollama / openai embedding client
+        :param hooks: (list) optional instrumentation hooks, every run is reported as a 'compaction' turn
+        """
+        self.chroma_client = chroma_client
+        self.llm_settings = llm_settings
+        self.embedding_model_settings = embedding_model_settings
+        self.settings = compaction_settings(settings)
+        self.llm_client = llm_client
+        self.embedding_client = embedding_client
+        self.hooks = hooks
+        self.reports = deque(maxlen=100)
+        self.runs = 0
+        self.summaries = 0
+        self.compacted = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._turns = Counter()
+        self._queue = OrderedDict()
+        self._running = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='auto-llm-chatbot-compaction', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record_turn(self, collection_name, unique_session_id):
+        """
+        Counts a turn of the session, the session is scheduled every check_every turns
+        """
+        key = (collection_name, unique_session_id)
+        with self._cond:
+            self._turns[key] += 1
+            if self._turns[key] < self.settings['check_every']:
+                return
+            del self._turns[key]
+        self.schedule(collection_name, unique_session_id)
+
+    def schedule(self, collection_name, unique_session_id):
+        """
+        Queues the session for compaction, a session is queued once
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Compactor is closed')
+            self._queue[(collection_name, unique_session_id)] = None
+            self._cond.notify_all()
+
+    def flush(self, timeout = None):
+        """
+        Blocks until all queued sessions are compacted
+        :return: (bool) False if timeout expired first
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._running, timeout=timeout)
+
+    def close(self, timeout = None):
+        """
+        Stops the background thread when the running compaction is done, queued sessions are dropped
+        as compaction is optional work which the next check schedules again
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def stats(self):
+        """
+        :return: (dict) number of runs, written summaries, compacted messages, failed runs and queued sessions
+        """
+        with self._cond:
+            return {'runs': self.runs, 'summaries': self.summaries, 'compacted': self.compacted,
+                    'failed': self.failed, 'pending': len(self._queue)}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                (collection_name, unique_session_id), _ = self._queue.popitem(last=False)
+                self._running = True
+            report = None
+            try:
+                with turn('compaction', self.hooks, collection_name=collection_name,
+                          unique_session_id=unique_session_id):
+                    report = compact_session(collection_name, unique_session_id, self.chroma_client,
+                                             self.llm_settings, self.embedding_model_settings, self.settings,
+                                             llm_client=self.llm_client, embedding_client=self.embedding_client)
+            except Exception as e:
+                print(f"ERROR: {e}")
+            with self._cond:
+                self.runs += 1
+                if report is None:
+                    self.failed += 1
+                else:
+                    self.reports.append(report)
+                    self.summaries += report['summaries']
+                    self.compacted += report['compacted']
+                    if report['summaries'] >= self.settings['max_summaries'] and not self._closed:
+                        # more may be due, the session goes to the back so other sessions are not starved
+                        self._queue[(collection_name, unique_session_id)] = None
+                self._running = False
+                self._cond.notify_all()
@@ -0,0 +1,323 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+_verbose = False
+
+
+def set_verbose(verbose = True):
+    """
+    Turns printing of prompts and retrieval progress on or off, it is off by default
+    :param verbose: (bool) the flag
+    """
+    global _verbose
+    _verbose = verbose
+
+
+def is_verbose():
+    """
+    :return: (bool) True if prompts and retrieval progress are printed
+    """
+    return _verbose
+
+
+class Hook:
+    """
+    Base class of instrumentation hooks, on_turn is called once for every finished turn with its record:
+    'name', 'start_ns' (unix time in nanoseconds), 'seconds', 'attributes', 'counts' (token and memory counts),
+    'spans' (list of 'name', 'start' (seconds after turn start), 'seconds' and 'attributes'),
+    'timings' (total seconds per span name) and 'error' (None or error message)
+    """
+
+    def on_turn(self, record):
+        pass
+
+
+class CallbackHook(Hook):
+    """
+    Calls a function with the record of every finished turn
+    """
+
+    def __init__(self, callback):
+        """
+        :param callback: (callable) function taking the turn record (dict)
+        """
+        self.callback = callback
+
+    def on_turn(self, record):
+        self.callback(record)
+
+
+class OpenTelemetryHook(Hook):
+    """
+    Exports every turn as an OpenTelemetry span with one child span per stage
+    """
+
+    def __init__(self, tracer):
+        """
+        :param tracer: (object) OpenTelemetry tracer, like opentelemetry.trace.get_tracer('auto_llm_chatbot')
+        """
+        self.tracer = tracer
+
+    def on_turn(self, record):
+        from opentelemetry import trace
+        from opentelemetry.trace import Status, StatusCode
+
+        start_ns = record['start_ns']
+        attributes = _primitive({**record['attributes'], **record['counts']})
+        parent = self.tracer.start_span(record['name'], start_time=start_ns, attributes=attributes)
+        context = trace.set_span_in_context(parent)
+        for span in record['spans']:
+            child = self.tracer.start_span(span['name'], context=context,
+                                           start_time=start_ns + int(span['start'] * 1e9),
+                                           attributes=_primitive(span['attributes']))
+            child.end(end_time=start_ns + int((span['start'] + span['seconds']) * 1e9))
+        if record['error'] is not None:
+            parent.set_status(Status(StatusCode.ERROR, record['error']))
+        parent.end(end_time=start_ns + int(record['seconds'] * 1e9))
+
+
+class MetricsRegistry(Hook):
+    """
+    Prometheus style metrics of turns: latency histograms per turn and stage, counters of turns, tokens and memories.
+    expose() returns them in the Prometheus text format
+    """
+
+    def __init__(self, prefix = 'auto_llm_chatbot',
+                 buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)):
+        """
+        :param prefix: (str) prefix of metric names
+        :param buckets: (tuple) upper bounds of latency histogram buckets in seconds
+        """
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = dict()
+        self._counters = dict()
+
+    def _observe(self, name, labels, seconds):
+        histogram = self._histograms.setdefault(name, dict()).setdefault(
+            labels, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def _increment(self, name, labels, value = 1):
+        counters = self._counters.setdefault(name, dict())
+        counters[labels] = counters.get(labels, 0) + value
+
+    def on_turn(self, record):
+        status = 'ok' if record['error'] is None else 'error'
+        with self._lock:
+            self._observe('turn_seconds', (('turn', record['name']),), record['seconds'])
+            self._increment('turns_total', (('turn', record['name']), ('status', status)))
+            for span in record['spans']:
+                self._observe('stage_seconds', (('stage', span['name']),), span['seconds'])
+            for name, value in record['counts'].items():
+                self._increment(f'{name}_total', (), value)
+
+    def expose(self):
+        """
+        :return: (str) all metrics in the Prometheus text exposition format
+        """
+        lines = list()
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                name = f'{self.prefix}_{name}'
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    for bound, count in zip(self.buckets, histogram['buckets']):
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", repr(bound)),))} {count}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram["sum"]}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+            for name, series in sorted(self._counters.items()):
+                name = f'{self.prefix}_{name}'
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def _primitive(attributes):
+    # opentelemetry attributes can be str, bool, int or float only
+    return {key: value for key, value in attributes.items() if isinstance(value, (str, bool, int, float))}
+
+
+_hooks = list()
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """
+    Adds a hook which receives the turns of every ChatEngine and of the module level chat functions
+    :param hook: (Hook) the hook
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    :param hook: (Hook) a hook added with add_hook
+    """
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+_current = contextvars.ContextVar('auto_llm_chatbot_turn', default=None)
+
+
+class Turn:
+    """
+    Timings and counts of one turn, spans are recorded in the turn which is active in the current context
+    """
+
+    def __init__(self, name, hooks, attributes):
+        self.name = name
+        self.hooks = hooks
+        self.attributes = attributes
+        self.counts = dict()
+        self.spans = list()
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter()
+        self._finished = False
+
+    @contextmanager
+    def active(self):
+        """
+        Makes this turn the current turn, spans and counts of the block are recorded in it
+        """
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the block as a stage of this turn
+        :param name: (str) name of the stage
+        :param attributes: attributes of the span, the yielded dict can be updated in the block
+        """
+        started = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            self.add_span(name, started, time.perf_counter(), **attributes)
+
+    def add_span(self, name, started, finished, **attributes):
+        """
+        Adds a stage timed by the caller
+        :param name: (str) name of the stage
+        :param started: (float) time.perf_counter() at start of the stage
+        :param finished: (float) time.perf_counter() at end of the stage
+        """
+        self.spans.append({'name': name, 'start': started - self._started, 'seconds': finished - started,
+                           'attributes': attributes})
+
+    def count(self, **counts):
+        """
+        Adds to the counts of this turn, like prompt_tokens=10
+        """
+        for name, value in counts.items():
+            if value is not None:
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self, error = None):
+        """
+        Ends the turn and sends its record to the hooks, only the first call has an effect
+        :param error: (Exception) the error which ended the turn, if any
+        """
+        if self._finished:
+            return
+        self._finished = True
+        seconds = time.perf_counter() - self._started
+        timings = dict()
+        for span in self.spans:
+            timings[span['name']] = timings.get(span['name'], 0.0) + span['seconds']
+        record = {'name': self.name, 'start_ns': self.start_ns, 'seconds': seconds, 'attributes': self.attributes,
+                  'counts': self.counts, 'spans': self.spans, 'timings': timings,
+                  'error': None if error is None else f'{type(error).__name__}: {error}'}
+        for hook in self.hooks:
+            try:
+                hook.on_turn(record)
+            except Exception as e:
+                # instrumentation must never break a chat
+                print(f"ERROR: {e}")
+
+
+def start_turn(name, hooks = None, **attributes):
+    """
+    Starts a turn, it must be finished with Turn.finish
+    :param name: (str) name of the turn, like 'chat'
+    :param hooks: (list) hooks of the turn, hooks added with add_hook always receive the turn
+    :param attributes: attributes of the turn, like collection_name or unique_session_id
+    :return: (Turn) the turn, None if there are no hooks
+    """
+    with _hooks_lock:
+        hooks = list(hooks or ()) + _hooks
+    if not hooks:
+        # nothing to report to, so no need to time anything
+        return None
+    return Turn(name, hooks, attributes)
+
+
+@contextmanager
+def turn(name, hooks = None, **attributes):
+    """
+    Records the block as one turn, see start_turn
+    """
+    record = start_turn(name, hooks, **attributes)
+    if record is None:
+        yield None
+        return
+    try:
+        with record.active():
+            yield record
+    except BaseException as e:
+        record.finish(error=e)
+        raise
+    record.finish()
+
+
+def active(record):
+    """
+    :param record: (Turn) a turn or None
+    :return: context manager making the turn current, it does nothing for None
+    """
+    if record is None:
+        return nullcontext()
+    return record.active()
+
+
+def span(name, **attributes):
+    """
+    Times the block as a stage of the current turn, it does nothing outside of a turn
+    :param name: (str) name of the stage, like 'vector_query'
+    :param attributes: attributes of the span
+    :return: context manager yielding the attributes dict (None outside of a turn)
+    """
+    record = _current.get()
+    if record is None:
+        return nullcontext()
+    return record.span(name, **attributes)
+
+
+def count(**counts):
+    """
+    Adds to the counts of the current turn, it does nothing outside of a turn
+    """
+    record = _current.get()
+    if record is not None:
+        record.count(**counts)
@@ -0,0 +1,69 @@
+import math
+import re
+import threading
+from collections import Counter
+
+_token_pattern = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """
+    Local estimate of the number of tokens of a text, no tokenizer download or request is needed.
+    Roughly one token per 4 characters, but at least one token per word or punctuation mark
+    :param text: (str) the text
+    :return: (int) estimated number of tokens
+    """
+    if not text:
+        return 0
+    return max(len(_token_pattern.findall(text)), math.ceil(len(text) / 4))
+
+
+_memory_stats = Counter()
+_memory_stats_lock = threading.Lock()
+
+
+def get_memory_stats():
+    """
+    :return: (dict) totals of all assembled turns, 'turns', 'fetched', 'used', 'tokens' and 'tokens_saved'
+    """
+    with _memory_stats_lock:
+        return dict(_memory_stats)
+
+
+def assemble_memories(results, token_budget = None, token_counter = None):
+    """
+    Builds the memories of a turn from vector database results of one or more queries.
+    Messages found by several queries are kept once with their best distance, nearest messages come first
+    and messages are added while they fit in the token budget.
+    :param results: (dict) 'ids', 'documents' and 'distances', each a list per query embedding
+    :param token_budget: (int) maximum tokens of memories optional, if None then all unique messages are used
+    :param token_counter: (callable) counts tokens of a text optional, default estimate_tokens
+    :return: (dict) 'memories' as string of list of messages and 'memory_stats' of this turn
+    """
+    if token_counter is None:
+        token_counter = estimate_tokens
+    best = dict()
+    fetched = list()
+    for ids, documents, distances in zip(results['ids'], results['documents'], results['distances']):
+        for unique_message_id, document, distance in zip(ids, documents, distances):
+            fetched.append(document)
+            if unique_message_id not in best or distance < best[unique_message_id][0]:
+                best[unique_message_id] = (distance, document)
+
+    selected = list()
+    for distance, document in sorted(best.values(), key=lambda hit: hit[0]):
+        # budget is for memories as they are written in the prompt
+        if token_budget is not None and token_counter(f'{selected + [document]}') > token_budget:
+            # a shorter message further down may still fit
+            continue
+        selected.append(document)
+
+    memories = f'{selected}'
+    stats = {'fetched': len(fetched), 'unique': len(best), 'used': len(selected),
+             'tokens': token_counter(memories),
+             'tokens_saved': token_counter(f'{fetched}') - token_counter(memories)}
+    with _memory_stats_lock:
+        _memory_stats['turns'] += 1
+        for name in ('fetched', 'used', 'tokens', 'tokens_saved'):
+            _memory_stats[name] += stats[name]
+    return {'memories': memories, 'memory_stats': stats}
@@ -0,0 +1,476 @@
+import json
+import os
+import threading
+import weakref
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from urllib.parse import quote
+
+
+class MemoryBackend(ABC):
+    """
+    Storage of conversation messages and their embeddings, one store per (collection_name, unique_session_id)
+    """
+
+    @abstractmethod
+    def add(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        """
+        Adds messages to the session store, ids which already exist are ignored
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        :param unique_message_ids: (list) The unique message ids
+        :param embeddings: (list) The embedding of each message
+        :param documents: (list) The message data of each message
+        :param metadatas: (list) The metadata dict of each message
+        """
+        pass
+
+    @abstractmethod
+    def query(self, collection_name, unique_session_id, query_embeddings, n_results):
+        """
+        Finds the nearest messages (squared l2 distance) for each query embedding
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        :param query_embeddings: (list) list of query embeddings
+        :param n_results: (int) number of messages to return per query embedding
+        :return: (dict) 'ids', 'documents' and 'distances', each a list per query embedding, nearest first
+        """
+        pass
+
+    @abstractmethod
+    def count(self, collection_name, unique_session_id):
+        """
+        :return: (int) number of messages stored for the session
+        """
+        pass
+
+    def is_empty(self, collection_name, unique_session_id):
+        """
+        :return: (bool) True if no message is stored for the session, it can be cheaper than count
+        """
+        return self.count(collection_name, unique_session_id) == 0
+
+    def check_names(self, collection_name, unique_session_id):
+        """
+        Raises ValueError when the session can not be stored under these names, chats check it before the first call
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        """
+        pass
+
+    def get(self, collection_name, unique_session_id):
+        """
+        Reads all messages of the session, it is used by compaction
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        :return: (dict) 'ids', 'embeddings', 'documents' and 'metadatas' lists, one item per message
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support reading a whole session')
+
+    def delete(self, collection_name, unique_session_id, unique_message_ids):
+        """
+        Deletes messages of the session, ids which do not exist are ignored
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        :param unique_message_ids: (list) The unique message ids
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support deleting messages')
+
+    def upsert(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        """
+        Adds messages to the session store, messages which already exist are replaced, it is used by bulk import
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        :param unique_message_ids: (list) The unique message ids
+        :param embeddings: (list) The embedding of each message
+        :param documents: (list) The message data of each message
+        :param metadatas: (list) The metadata dict of each message
+        """
+        self.delete(collection_name, unique_session_id, unique_message_ids)
+        self.add(collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas)
+
+
+# striped locks, get_or_create of different collections runs in parallel
+_collection_locks = [threading.Lock() for _ in range(64)]
+
+
+def _collection_lock(vector_db_name):
+    return _collection_locks[zlib.crc32(vector_db_name.encode('utf-8')) % len(_collection_locks)]
+
+
+def get_collection(chroma_client, vector_db_name):
+    """
+    Thread safe get_or_create_collection, chroma fails when same collection is created by two threads at a time
+    :param chroma_client: (object) The chroma client instance
+    :param vector_db_name: (str) The name of the collection
+    :return: (object) chroma collection
+    """
+    with _collection_lock(vector_db_name):
+        return chroma_client.get_or_create_collection(name=vector_db_name)
+
+
+def _check_vector_db_name(vector_db_name):
+    # writes in background only print their errors, so the length rule of chroma is checked up front
+    if not 3 <= len(vector_db_name) <= 63:
+        raise ValueError(f"Invalid chroma collection name {vector_db_name!r}. "
+                         f"Chroma collection names have 3 to 63 characters")
+
+
+class _ChromaCollections(MemoryBackend, ABC):
+    """
+    Base of chroma backends, collections are looked up once and kept in a LRU cache,
+    so a turn does not pay a get_or_create round trip per operation
+    """
+
+    def __init__(self, chroma_client, max_collections = 4096):
+        """
+        :param chroma_client: (object) The chroma client instance
+        :param max_collections: (int) max number of collections kept in cache
+        """
+        self.chroma_client = chroma_client
+        self.max_collections = max_collections
+        self._collections = OrderedDict()
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _vector_db_name(self, collection_name, unique_session_id):
+        """
+        :return: (str) name of the chroma collection which stores the session
+        """
+        pass
+
+    def check_names(self, collection_name, unique_session_id):
+        _check_vector_db_name(self._vector_db_name(collection_name, unique_session_id))
+
+    def _collection(self, vector_db_name):
+        with self._lock:
+            vector_db = self._collections.get(vector_db_name)
+            if vector_db is not None:
+                self._collections.move_to_end(vector_db_name)
+                return vector_db
+        _check_vector_db_name(vector_db_name)
+        # the round trip is made outside of the cache lock, only lookups of the same name wait for each other
+        vector_db = get_collection(self.chroma_client, vector_db_name)
+        with self._lock:
+            self._collections[vector_db_name] = vector_db
+            while len(self._collections) > self.max_collections:
+                self._collections.popitem(last=False)
+        return vector_db
+
+    def _call(self, vector_db_name, method, **kwargs):
+        """
+        Calls a method of the collection, it is looked up again if it was deleted since it was cached
+        """
+        try:
+            return getattr(self._collection(vector_db_name), method)(**kwargs)
+        except Exception as e:
+            from chromadb.errors import InvalidCollectionException
+            if not isinstance(e, InvalidCollectionException):
+                raise
+        with self._lock:
+            self._collections.pop(vector_db_name, None)
+        return getattr(self._collection(vector_db_name), method)(**kwargs)
+
+
+class ChromaBackend(_ChromaCollections):
+    """
+    Chroma DB backend, one chroma collection per session named {collection_name}-{unique_session_id}
+    """
+
+    def _vector_db_name(self, collection_name, unique_session_id):
+        return f'{collection_name}-{unique_session_id}'
+
+    def add(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        self._call(self._vector_db_name(collection_name, unique_session_id), 'add',
+                   ids=list(unique_message_ids), embeddings=list(embeddings), documents=list(documents),
+                   metadatas=list(metadatas))
+
+    def query(self, collection_name, unique_session_id, query_embeddings, n_results):
+        results = self._call(self._vector_db_name(collection_name, unique_session_id), 'query',
+                             query_embeddings=query_embeddings, n_results=n_results,
+                             include=['documents', 'distances'])
+        return {'ids': results['ids'], 'documents': results['documents'], 'distances': results['distances']}
+
+    def count(self, collection_name, unique_session_id):
+        return self._call(self._vector_db_name(collection_name, unique_session_id), 'count')
+
+    def get(self, collection_name, unique_session_id):
+        results = self._call(self._vector_db_name(collection_name, unique_session_id), 'get',
+                             include=['embeddings', 'documents', 'metadatas'])
+        return {'ids': results['ids'], 'embeddings': list(results['embeddings']), 'documents': results['documents'],
+                'metadatas': results['metadatas']}
+
+    def delete(self, collection_name, unique_session_id, unique_message_ids):
+        if unique_message_ids:
+            self._call(self._vector_db_name(collection_name, unique_session_id), 'delete', ids=list(unique_message_ids))
+
+    def upsert(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        self._call(self._vector_db_name(collection_name, unique_session_id), 'upsert',
+                   ids=list(unique_message_ids), embeddings=list(embeddings), documents=list(documents),
+                   metadatas=list(metadatas))
+
+
+class SharedChromaBackend(_ChromaCollections):
+    """
+    Chroma DB backend, one chroma collection per collection_name shared by all sessions,
+    messages are filtered by 'unique_session_id' metadata
+    """
+
+    def _vector_db_name(self, collection_name, unique_session_id):
+        return collection_name
+
+    @staticmethod
+    def shared_id(unique_session_id, unique_message_id):
+        """
+        Message ids are unique per session only, the chroma id of a message in the shared collection holds both
+        :return: (str) the chroma id
+        """
+        return json.dumps([unique_session_id, unique_message_id])
+
+    def add(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        self._call(collection_name, 'add',
+                   ids=[self.shared_id(unique_session_id, unique_message_id)
+                        for unique_message_id in unique_message_ids],
+                   embeddings=list(embeddings), documents=list(documents),
+                   metadatas=[{**metadata, 'unique_session_id': unique_session_id} for metadata in metadatas])
+
+    def query(self, collection_name, unique_session_id, query_embeddings, n_results):
+        results = self._call(collection_name, 'query', query_embeddings=query_embeddings, n_results=n_results,
+                             where={'unique_session_id': unique_session_id},
+                             include=['documents', 'distances'])
+        # chroma can return one result too many for a filtered query after deletes
+        return {'ids': [[json.loads(shared_id)[1] for shared_id in ids[:n_results]] for ids in results['ids']],
+                'documents': [documents[:n_results] for documents in results['documents']],
+                'distances': [distances[:n_results] for distances in results['distances']]}
+
+    def count(self, collection_name, unique_session_id):
+        return len(self._call(collection_name, 'get', where={'unique_session_id': unique_session_id},
+                              include=[])['ids'])
+
+    def is_empty(self, collection_name, unique_session_id):
+        # one id is enough, count reads every id of the session
+        return not self._call(collection_name, 'get', where={'unique_session_id': unique_session_id},
+                              limit=1, include=[])['ids']
+
+    def get(self, collection_name, unique_session_id):
+        results = self._call(collection_name, 'get', where={'unique_session_id': unique_session_id},
+                             include=['embeddings', 'documents', 'metadatas'])
+        return {'ids': [json.loads(shared_id)[1] for shared_id in results['ids']],
+                'embeddings': list(results['embeddings']), 'documents': results['documents'],
+                'metadatas': results['metadatas']}
+
+    def delete(self, collection_name, unique_session_id, unique_message_ids):
+        if unique_message_ids:
+            self._call(collection_name, 'delete', ids=[self.shared_id(unique_session_id, unique_message_id)
+                                                       for unique_message_id in unique_message_ids])
+
+    def upsert(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        self._call(collection_name, 'upsert',
+                   ids=[self.shared_id(unique_session_id, unique_message_id)
+                        for unique_message_id in unique_message_ids],
+                   embeddings=list(embeddings), documents=list(documents),
+                   metadatas=[{**metadata, 'unique_session_id': unique_session_id} for metadata in metadatas])
+
+
+class NumpyBackend(MemoryBackend):
+    """
+    In-process backend for small per-session histories, each session is a contiguous float32 matrix
+    searched exactly with one matrix product, persisted as memory-mapped .npy file and a .jsonl file of messages
+    """
+
+    def __init__(self, path = 'numpy_memory', max_sessions = 256):
+        """
+        :param path: (str) directory of the session files, it is created if missing
+        :param max_sessions: (int) max number of sessions kept loaded, each one holds a memory map (a file descriptor),
+                             the least recently used session is unloaded first
+        """
+        # numpy is imported by the methods, so it is not loaded unless this backend is used
+        self.path = path
+        self.max_sessions = max_sessions
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._sessions = OrderedDict()
+
+    def _files(self, collection_name, unique_session_id):
+        name = quote(f'{collection_name}-{unique_session_id}', safe='-_.')
+        return os.path.join(self.path, f'{name}.npy'), os.path.join(self.path, f'{name}.jsonl')
+
+    def _session(self, collection_name, unique_session_id, create = True):
+        # create is False for reads, an empty session is then returned without being kept loaded
+        import numpy as np
+        key = (collection_name, unique_session_id)
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+        else:
+            vectors_file, messages_file = self._files(collection_name, unique_session_id)
+            vectors = None
+            records = list()
+            if os.path.exists(vectors_file) and os.path.exists(messages_file):
+                with open(messages_file, encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+                if os.path.exists(vectors_file + '.delete.npy'):
+                    # delete was interrupted, its vectors belong to the messages only if they were replaced
+                    if len(np.load(vectors_file + '.delete.npy', mmap_mode='r')) == len(records):
+                        os.replace(vectors_file + '.delete.npy', vectors_file)
+                    else:
+                        os.remove(vectors_file + '.delete.npy')
+                vectors = np.load(vectors_file, mmap_mode='r')
+                # a crash between the two writes leaves extra rows in one file
+                size = min(len(vectors), len(records))
+                vectors = vectors[:size]
+                if len(records) > size:
+                    records = records[:size]
+                    with open(messages_file, 'w', encoding='utf-8') as f:
+                        for record in records:
+                            f.write(json.dumps(record) + '\n')
+            session = {'vectors': vectors, 'records': records, 'ids': {record['id'] for record in records},
+                       'norms': None}
+            if not records and not create:
+                return session
+            self._sessions[key] = session
+            while len(self._sessions) > self.max_sessions:
+                # the memory map is closed once queries running on it finish
+                self._sessions.popitem(last=False)
+        return session
+
+    def add(self, collection_name, unique_session_id, unique_message_ids, embeddings, documents, metadatas):
+        import numpy as np
+        with self._lock:
+            session = self._session(collection_name, unique_session_id)
+            new_records = list()
+            new_vectors = list()
+            for unique_message_id, embedding, document, metadata in zip(unique_message_ids, embeddings, documents,
+                                                                        metadatas):
+                if unique_message_id in session['ids']:
+                    continue
+                session['ids'].add(unique_message_id)
+                new_records.append({'id': unique_message_id, 'document': document, 'metadata': metadata})
+                new_vectors.append(embedding)
+            if not new_records:
+                return
+            new_vectors = np.asarray(new_vectors, dtype=np.float32)
+            if session['vectors'] is not None and len(session['vectors']):
+                new_vectors = np.concatenate([session['vectors'], new_vectors])
+            # releasing the memory map before the file is replaced
+            session['vectors'] = None
+
+            vectors_file, messages_file = self._files(collection_name, unique_session_id)
+            temp_file = vectors_file + '.tmp.npy'
+            np.save(temp_file, new_vectors)
+            os.replace(temp_file, vectors_file)
+            with open(messages_file, 'a', encoding='utf-8') as f:
+                for record in new_records:
+                    f.write(json.dumps(record) + '\n')
+            session['vectors'] = np.load(vectors_file, mmap_mode='r')
+            session['records'].extend(new_records)
+            session['norms'] = None
+
+    def query(self, collection_name, unique_session_id, query_embeddings, n_results):
+        import numpy as np
+        with self._lock:
+            session = self._session(collection_name, unique_session_id, create=False)
+            vectors = session['vectors']
+            records = session['records']
+            if vectors is None or not len(vectors):
+                return {'ids': [[] for _ in query_embeddings], 'documents': [[] for _ in query_embeddings],
+                        'distances': [[] for _ in query_embeddings]}
+            if session['norms'] is None:
+                session['norms'] = np.einsum('ij,ij->i', vectors, vectors)
+            norms = session['norms']
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        # squared l2 distance, same as chroma default space
+        distances = norms[None, :] - 2 * (queries @ vectors.T) + np.einsum('ij,ij->i', queries, queries)[:, None]
+        k = min(n_results, len(records))
+        if k < len(records):
+            nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            nearest = np.tile(np.arange(len(records)), (len(queries), 1))
+        nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1),
+                                     axis=1)
+        return {'ids': [[records[i]['id'] for i in row] for row in nearest],
+                'documents': [[records[i]['document'] for i in row] for row in nearest],
+                'distances': [[float(distances[q, i]) for i in row] for q, row in enumerate(nearest)]}
+
+    def count(self, collection_name, unique_session_id):
+        with self._lock:
+            return len(self._session(collection_name, unique_session_id, create=False)['records'])
+
+    def get(self, collection_name, unique_session_id):
+        import numpy as np
+        with self._lock:
+            session = self._session(collection_name, unique_session_id, create=False)
+            records = list(session['records'])
+            vectors = session['vectors']
+            return {'ids': [record['id'] for record in records],
+                    'embeddings': [] if vectors is None else [np.array(vector) for vector in vectors],
+                    'documents': [record['document'] for record in records],
+                    'metadatas': [record['metadata'] for record in records]}
+
+    def delete(self, collection_name, unique_session_id, unique_message_ids):
+        import numpy as np
+        with self._lock:
+            session = self._session(collection_name, unique_session_id, create=False)
+            unique_message_ids = set(unique_message_ids) & session['ids']
+            if not unique_message_ids:
+                return
+            keep = [i for i, record in enumerate(session['records']) if record['id'] not in unique_message_ids]
+            vectors = np.asarray(session['vectors'])[keep]
+            records = [session['records'][i] for i in keep]
+            session['vectors'] = None
+
+            # rows are removed from the middle, so messages are replaced first and the pending vectors file
+            # is completed on load if a crash happens before it replaces the vectors
+            vectors_file, messages_file = self._files(collection_name, unique_session_id)
+            np.save(vectors_file + '.delete.npy', vectors)
+            with open(messages_file + '.tmp', 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+            os.replace(messages_file + '.tmp', messages_file)
+            os.replace(vectors_file + '.delete.npy', vectors_file)
+            session['vectors'] = np.load(vectors_file, mmap_mode='r')
+            session['records'] = records
+            session['ids'] -= unique_message_ids
+            session['norms'] = None
+
+
+_client_backends = weakref.WeakKeyDictionary()
+_client_backends_lock = threading.Lock()
+
+
+def as_backend(chroma_client):
+    """
+    :param chroma_client: (object) a MemoryBackend or a chroma client instance
+    :return: (MemoryBackend) the backend, chroma clients are wrapped in ChromaBackend, one per client
+            so its collection cache is reused
+    """
+    if isinstance(chroma_client, MemoryBackend):
+        return chroma_client
+    with _client_backends_lock:
+        backend = _client_backends.get(chroma_client)
+        if backend is None:
+            backend = _client_backends[chroma_client] = ChromaBackend(chroma_client)
+    return backend
+
+
+def create_backend(chroma_settings, chroma_client = None):
+    """
+    Creates the memory backend from chroma_settings 'backend' key, it can be 'chroma' (default),
+    'chroma_shared' or 'numpy'
+    :param chroma_settings: (dict) the settings, 'path' is the directory of numpy backend
+                            and 'max_sessions' the number of its sessions kept loaded
+    :param chroma_client: (object) chroma client for chroma backends
+    :return: (MemoryBackend) the backend
+    """
+    backend = chroma_settings.get('backend', 'chroma')
+    if isinstance(backend, MemoryBackend):
+        return backend
+    if backend == 'numpy':
+        return NumpyBackend(path=chroma_settings.get('path') or 'numpy_memory',
+                            max_sessions=chroma_settings.get('max_sessions', 256))
+    if backend == 'chroma_shared':
+        return SharedChromaBackend(chroma_client)
+    if backend != 'chroma':
+        raise ValueError(f"Invalid memory backend {backend!r}. Supported backends are: chroma, chroma_shared, numpy")
+    return ChromaBackend(chroma_client)
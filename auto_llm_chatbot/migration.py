@@ -0,0 +1,104 @@
+import argparse
+import time
+
+try:
+    from memory_backends import SharedChromaBackend, get_collection
+    from chroma_handler import create_client
+except:
+    from auto_llm_chatbot.memory_backends import SharedChromaBackend, get_collection
+    from auto_llm_chatbot.chroma_handler import create_client
+
+
+def _session_of(collection):
+    """
+    :param collection: (object) chroma collection
+    :return: (tuple) (collection_name, unique_session_id) of a per session collection, None for other collections
+    """
+    record = collection.get(limit=1, include=['metadatas'])
+    if not record['ids'] or not record['metadatas'][0]:
+        return None
+    metadata = record['metadatas'][0]
+    collection_name = metadata.get('collection_name')
+    unique_session_id = metadata.get('unique_session_id')
+    if collection_name is None or unique_session_id is None:
+        return None
+    if collection.name != f'{collection_name}-{unique_session_id}':
+        return None
+    return collection_name, unique_session_id
+
+
+def migrate_to_shared_collections(chroma_client, collection_name: str = None, batch_size: int = 1000,
+                                  delete_source: bool = False, verbose: bool = True):
+    """
+    Copies per session collections ({collection_name}-{unique_session_id}) into one shared collection per
+    collection_name, the layout of SharedChromaBackend. Messages of many sessions are written in one call,
+    messages which are already copied are overwritten so an interrupted migration can be run again.
+    :param chroma_client: (object) The chroma client instance
+    :param collection_name: (str) Only migrate sessions of this collection name optional, if None then all
+    :param batch_size: (int) Number of messages read and written per chroma call
+    :param delete_source: (bool) Delete each per session collection after it is copied
+    :param verbose: (bool) Print progress
+    :return: (dict) 'sessions', 'messages' copied and 'seconds' taken
+    """
+    started = time.perf_counter()
+    pending = dict()
+    stats = {'sessions': 0, 'messages': 0, 'seconds': 0.0}
+
+    def flush(name):
+        batch = pending.pop(name, None)
+        if batch and batch['ids']:
+            get_collection(chroma_client, name).upsert(**batch)
+            stats['messages'] += len(batch['ids'])
+
+    for collection in chroma_client.list_collections():
+        if isinstance(collection, str):
+            collection = chroma_client.get_collection(collection)
+        session = _session_of(collection)
+        if session is None or (collection_name is not None and session[0] != collection_name):
+            continue
+        name, unique_session_id = session
+        offset = 0
+        while True:
+            records = collection.get(limit=batch_size, offset=offset,
+                                     include=['embeddings', 'documents', 'metadatas'])
+            if not records['ids']:
+                break
+            offset += len(records['ids'])
+            batch = pending.setdefault(name, {'ids': [], 'embeddings': [], 'documents': [], 'metadatas': []})
+            for unique_message_id, embedding, document, metadata in zip(records['ids'], records['embeddings'],
+                                                                        records['documents'], records['metadatas']):
+                batch['ids'].append(SharedChromaBackend.shared_id(unique_session_id, unique_message_id))
+                batch['embeddings'].append(list(embedding))
+                batch['documents'].append(document)
+                batch['metadatas'].append({**(metadata or {}), 'unique_session_id': unique_session_id})
+                if len(batch['ids']) >= batch_size:
+                    flush(name)
+                    batch = pending.setdefault(name, {'ids': [], 'embeddings': [], 'documents': [],
+                                                      'metadatas': []})
+        if delete_source:
+            # the copied messages must be stored before the source is gone
+            flush(name)
+            chroma_client.delete_collection(collection.name)
+        stats['sessions'] += 1
+        if verbose and stats['sessions'] % 1000 == 0:
+            print(f"Migrated {stats['sessions']} sessions, {stats['messages']} messages")
+
+    for name in list(pending):
+        flush(name)
+    stats['seconds'] = time.perf_counter() - started
+    if verbose:
+        print(f"Migrated {stats['sessions']} sessions, {stats['messages']} messages in {stats['seconds']:.1f}s")
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy per session chroma collections into shared collections')
+    parser.add_argument('--host', default=None, help='chroma server host, persistent client if not given')
+    parser.add_argument('--port', type=int, default=None, help='chroma server port')
+    parser.add_argument('--collection-name', default=None, help='only migrate this collection name')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--delete-source', action='store_true', help='delete per session collections once copied')
+    args = parser.parse_args()
+
+    migrate_to_shared_collections(create_client(args.host, args.port), collection_name=args.collection_name,
+                                  batch_size=args.batch_size, delete_source=args.delete_source)
@@ -1,21 +1,180 @@
-import ollama
-from ollama import Client
-from openai import OpenAI
-from abc import ABC, abstractmethod
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
 
+try:
+    from providers import (CustomLLM, OllamaProvider, OpenAIProvider, as_provider, create_provider,
+                           register_provider)
+except:
+    from auto_llm_chatbot.providers import (CustomLLM, OllamaProvider, OpenAIProvider, as_provider, create_provider,
+                                            register_provider)
 
-def ollama_chat(model, messages, options: dict, base_url = None):
+
+class EmbeddingCache:
+    """
+    LRU cache of embeddings keyed by (provider, model, sha256 of text)
+    with optional sqlite file as second tier, which survives restarts.
+    Embeddings are kept as float32 arrays, 2000 embeddings of 768 dimensions take about 6 MB
+    """
+
+    def __init__(self, max_size = 2000, ttl = None, path = None):
+        """
+        :param max_size: (int) max number of embeddings kept in memory
+        :param ttl: (float) seconds after which an embedding expires, if None then embeddings never expire
+        :param path: (str) sqlite file path for the on-disk tier, if None then only in-memory cache is used
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                             '(key TEXT PRIMARY KEY, embedding BLOB, created REAL)')
+            self._db.commit()
+
+    @staticmethod
+    def key(provider, model, text):
+        return f"{provider}:{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get_many(self, provider, model, texts):
+        """
+        :param provider: (str) embedding provider
+        :param model: (str) embedding model name
+        :param texts: (list) list of texts
+        :return: (list) embedding of each text, None for texts not in cache
+        """
+        now = time.time()
+        embeddings = list()
+        with self._lock:
+            for text in texts:
+                key = self.key(provider, model, text)
+                embedding = None
+                item = self._memory.get(key)
+                if item is not None:
+                    if self._expired(item[1], now):
+                        del self._memory[key]
+                    else:
+                        self._memory.move_to_end(key)
+                        embedding = item[0].tolist()
+                        self.hits += 1
+                if embedding is None and self._db is not None:
+                    row = self._db.execute('SELECT embedding, created FROM embeddings WHERE key = ?',
+                                           (key,)).fetchone()
+                    if row is not None and not self._expired(row[1], now):
+                        stored = array('f', row[0])
+                        self._remember(key, stored, row[1])
+                        embedding = stored.tolist()
+                        self.hits += 1
+                        self.disk_hits += 1
+                if embedding is None:
+                    self.misses += 1
+                embeddings.append(embedding)
+        return embeddings
+
+    def put_many(self, provider, model, texts, embeddings):
+        """
+        :param provider: (str) embedding provider
+        :param model: (str) embedding model name
+        :param texts: (list) list of texts
+        :param embeddings: (list) embedding of each text
+        """
+        now = time.time()
+        with self._lock:
+            rows = list()
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(provider, model, text)
+                stored = array('f', embedding)
+                self._remember(key, stored, now)
+                rows.append((key, stored.tobytes(), now))
+            if self._db is not None and rows:
+                self._db.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)', rows)
+                self._db.commit()
+
+    def _remember(self, key, embedding, created):
+        self._memory[key] = (embedding, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        """
+        :return: (dict) hit / miss counters and number of embeddings in memory
+        """
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'size': len(self._memory)}
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM embeddings')
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# default cache, used when embedding_model_settings has no 'cache'
+embedding_cache = EmbeddingCache()
+
+
+def get_embedding_cache(embedding_model_settings):
+    """
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :return: (EmbeddingCache) cache from settings 'cache' key, default cache if key is missing or None if it is False
+    """
+    cache = embedding_model_settings.get('cache')
+    if cache is None:
+        return embedding_cache
+    if cache is False:
+        return None
+    return cache
+
+
+def write_settings(embedding_model_settings):
+    """
+    Embeddings of conversations written to memory are never asked for again, so they skip the default cache
+    and do not evict the embeddings of queries. A cache of the settings own is still used
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :return: (dict) settings for embeddings which are written to memory
+    """
+    if embedding_model_settings.get('cache') is None:
+        return {**embedding_model_settings, 'cache': False}
+    return embedding_model_settings
+
+
+def ollama_chat(model, messages, options: dict, base_url = None, client = None):
     if options is None:
         options = dict()
-    if base_url is None:
-        response = ollama.chat(model=model, messages=messages, options=options)
-    else:
+    if client is None:
+        import ollama
+        from ollama import Client
+        if base_url is None:
+            return ollama.chat(model=model, messages=messages, options=options)
         client = Client(host=base_url)
-        response = client.chat(model=model, messages=messages, options=options)
+    response = client.chat(model=model, messages=messages, options=options)
     return response
 
 
 def ollama_generate(model, prompt, options: dict, base_url = None):
+    import ollama
+    from ollama import Client
     if options is None:
         options = dict()
     if base_url is None:
@@ -27,6 +186,8 @@ def ollama_generate(model, prompt, options: dict, base_url = None):
 
 
 def ollama_embeddings(model, prompt, base_url = None):
+    import ollama
+    from ollama import Client
     if base_url is None:
         response = ollama.embeddings(model=model, prompt=prompt)
     else:
@@ -35,11 +196,13 @@ def ollama_embeddings(model, prompt, base_url = None):
     return response
 
 
-def openai_chat(messages: list[dict], api_key, base_url, model = "gpt-3.5-turbo"):
-    client = OpenAI(
-        base_url=base_url,
-        api_key=api_key,
-    )
+def openai_chat(messages: list[dict], api_key, base_url, model = "gpt-3.5-turbo", client = None):
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(
+            base_url=base_url,
+            api_key=api_key,
+        )
     chat_completion = client.chat.completions.create(
         messages=messages,
         model=model,
@@ -47,36 +210,85 @@ def openai_chat(messages: list[dict], api_key, base_url, model = "gpt-3.5-turbo"
     return chat_completion
 
 
-def run_embedding(embedding_model_settings, query):
-    if embedding_model_settings['provider'] == 'ollama':
-        if embedding_model_settings['base_url'] is None:
-            query_embedding = ollama.embeddings(model=embedding_model_settings['model'], prompt=query)
-        else:
-            client = Client(host=embedding_model_settings['base_url'])
-            query_embedding = client.embeddings(model=embedding_model_settings['model'], prompt=query)
-        query_embedding = query_embedding['embedding']
-    else:
-        llm_client = OpenAI(api_key=embedding_model_settings['api_key'],
-                            base_url=embedding_model_settings['base_url'])
-        query_embedding = llm_client.embeddings.create(
-            input=query,
-            model=embedding_model_settings['model']
-        )
-        query_embedding = query_embedding.data[0].embedding
-    return query_embedding
+def _embed_texts(embedding_model_settings, texts, client = None):
+    llm = as_provider(embedding_model_settings, client=client)
+    return llm.embed(texts, embedding_model_settings['model'])
 
 
-class CustomLLM:
-    def __init__(self, name = 'custom_llm'):
-        self.name = name
+def _cache_provider(embedding_model_settings):
+    # ollama /api/embed vectors are normalized, they are cached apart from /api/embeddings vectors
+    if embedding_model_settings['provider'] == 'ollama' and embedding_model_settings.get('embed_endpoint') == 'embed':
+        return 'ollama-embed'
+    return embedding_model_settings['provider']
 
-    @abstractmethod
-    def chat(self) -> str:
-        """
-        Create custom chat model here it should return inference output as text
-        :return: (str) output of model
-        """
-        pass
+
+def _cached_embeddings(embedding_model_settings, texts):
+    # returns the cache, embeddings found in cache and the distinct texts which are still to be embedded
+    cache = get_embedding_cache(embedding_model_settings)
+    if cache is None:
+        return None, dict(), list(dict.fromkeys(texts))
+    distinct = list(dict.fromkeys(texts))
+    found = cache.get_many(_cache_provider(embedding_model_settings), embedding_model_settings['model'], distinct)
+    found = {text: embedding for text, embedding in zip(distinct, found) if embedding is not None}
+    return cache, found, [text for text in distinct if text not in found]
+
+
+def run_embedding(embedding_model_settings, query, client = None):
+    """
+    This function creates embeddings, a list of texts is embedded in one request
+    ollama embeddings are created with one /api/embeddings request per text, or with one /api/embed request
+    if embedding_model_settings['embed_endpoint'] is 'embed'
+    embeddings are served from the embedding cache when possible, see get_embedding_cache
+    :param embedding_model_settings: (dict) dictionary of embeddings models settings
+    :param query: (str or list) text or list of texts
+    :param client: (object) optional reusable ollama / openai client
+    :return: (list) embedding of the text, or list of embeddings (one per text) if query is a list
+    """
+    texts = query if isinstance(query, list) else [query]
+    if not texts:
+        return []
+    cache, found, missing = _cached_embeddings(embedding_model_settings, texts)
+    if missing:
+        new_embeddings = _embed_texts(embedding_model_settings, missing, client=client)
+        if cache is not None:
+            cache.put_many(_cache_provider(embedding_model_settings), embedding_model_settings['model'],
+                           missing, new_embeddings)
+        found.update(zip(missing, new_embeddings))
+    query_embedding = [found[text] for text in texts]
+    if isinstance(query, list):
+        return query_embedding
+    return query_embedding[0]
+
+
+def response_usage(provider, response):
+    """
+    :param provider: (enum) It can be 'openai' or 'ollama'
+    :param response: (object) chat response or last chunk of a streamed chat
+    :return: (dict) prompt_tokens, completion_tokens and cached_tokens, None when the response does not report them
+    """
+    return (OllamaProvider if provider == 'ollama' else OpenAIProvider).usage(response)
+
+
+async def _aembed_texts(embedding_model_settings, texts, client):
+    llm = as_provider(embedding_model_settings, async_client=client)
+    return await llm.aembed(texts, embedding_model_settings['model'])
+
+
+async def arun_embedding(embedding_model_settings, query, client):
+    texts = query if isinstance(query, list) else [query]
+    if not texts:
+        return []
+    cache, found, missing = _cached_embeddings(embedding_model_settings, texts)
+    if missing:
+        new_embeddings = await _aembed_texts(embedding_model_settings, missing, client=client)
+        if cache is not None:
+            cache.put_many(_cache_provider(embedding_model_settings), embedding_model_settings['model'],
+                           missing, new_embeddings)
+        found.update(zip(missing, new_embeddings))
+    query_embedding = [found[text] for text in texts]
+    if isinstance(query, list):
+        return query_embedding
+    return query_embedding[0]
 
 
 if __name__ == '__main__':
@@ -97,9 +309,10 @@ if __name__ == '__main__':
 
 
     class MyCustomLLM(CustomLLM):
-        def chat(self) -> str:
+        def chat(self, messages, model, options = None, timeout = None):
             return "This is the custom chat response."
 
 
-    llm = MyCustomLLM()
-    print(llm.chat())
+    register_provider('my_llm', lambda settings: MyCustomLLM('my_llm'))
+    llm = create_provider({'provider': 'my_llm'})
+    print(llm.content(llm.chat([{"role": "user", "content": prompt}], 'my-model')))
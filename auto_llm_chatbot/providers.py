@@ -0,0 +1,693 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from instrumentation import span, count
+except:
+    from auto_llm_chatbot.instrumentation import span, count
+
+
+class CustomLLM:
+    """
+    Interface of chat and embedding providers. Subclass it, implement chat (and embed for embedding models),
+    register it with register_provider and use its name as 'provider' in llm_settings or embedding_model_settings.
+    Streaming and asyncio methods fall back to chat and embed
+    """
+
+    def __init__(self, name = 'custom_llm'):
+        self.name = name
+
+    @abstractmethod
+    def chat(self, messages, model, options = None, timeout = None):
+        """
+        Create custom chat model here
+        :param messages: (list) chat messages in openai format
+        :param model: (str) model name
+        :param options: (dict) model options optional
+        :param timeout: (float) max seconds of the call optional
+        :return: (object) the response, content() returns its text
+        """
+        pass
+
+    def embed(self, texts, model, timeout = None):
+        """
+        :param texts: (list) texts to embed
+        :param model: (str) embedding model name
+        :param timeout: (float) max seconds of the call optional
+        :return: (list) embedding of each text
+        """
+        raise NotImplementedError(f'{self.name} provider does not support embeddings')
+
+    def content(self, response):
+        """
+        :return: (str) text of a chat response
+        """
+        return response
+
+    @staticmethod
+    def usage(response):
+        """
+        :return: (dict) prompt_tokens, completion_tokens and cached_tokens (prompt tokens served from the prompt cache)
+                 of a chat response, None when not reported
+        """
+        return {'prompt_tokens': None, 'completion_tokens': None, 'cached_tokens': None}
+
+    def chat_stream(self, messages, model, options = None, usage = None, timeout = None):
+        """
+        Streams the chat, yields text chunks of the answer
+        :param usage: (dict) optional, token counts are put in it when the stream ends, see usage
+        """
+        response = self.chat(messages, model, options, timeout=timeout)
+        if usage is not None:
+            usage.update(self.usage(response))
+        yield self.content(response)
+
+    async def achat(self, messages, model, options = None, timeout = None):
+        return await asyncio.to_thread(self.chat, messages, model, options, timeout=timeout)
+
+    async def aembed(self, texts, model, timeout = None):
+        return await asyncio.to_thread(self.embed, texts, model, timeout=timeout)
+
+    async def achat_stream(self, messages, model, options = None, usage = None, timeout = None):
+        response = await self.achat(messages, model, options, timeout=timeout)
+        if usage is not None:
+            usage.update(self.usage(response))
+        yield self.content(response)
+
+    def connect(self):
+        """
+        Creates the clients before the first call, so their creation is not timed in the first chat
+        """
+        pass
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class Endpoint:
+    """
+    One server of a provider, with its clients and request counts
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        # clients by (asyncio, timeout)
+        self.clients = dict()
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        # time of the last connection error, timeout or overload, the endpoint is avoided for a while after it
+        self.failed_at = None
+
+
+class LLMProvider(CustomLLM):
+    """
+    Provider with one or more endpoints serving the same models. Every call goes to the endpoint with the least
+    outstanding requests, failed calls are retried on another endpoint with exponential backoff, and with hedge_after
+    a second request is sent to another endpoint when the first one is slow, the first answer wins.
+    Subclasses create the clients and implement the calls of one client
+    """
+
+    # seconds an endpoint is avoided after a retryable error, while other endpoints are healthy
+    failure_cooldown = 5.0
+
+    def __init__(self, name, base_url = None, api_key = None, timeout = None, max_retries = 2, retry_backoff = 0.5,
+                 hedge_after = None):
+        """
+        :param name: (str) name of the provider
+        :param base_url: (str) base url, or list of base urls of the endpoints, None for the default url of provider
+        :param api_key: (str) API key optional
+        :param timeout: (float) max seconds of every call optional, if None then the client default is used
+        :param max_retries: (int) retries of a failed call, only connection errors, timeouts, 429 and 5xx are retried
+        :param retry_backoff: (float) seconds before the first retry, doubled for every next retry
+        :param hedge_after: (float) seconds after which a slow call is sent again to another endpoint optional
+        """
+        super().__init__(name)
+        base_urls = base_url if isinstance(base_url, (list, tuple)) else [base_url]
+        self.endpoints = [Endpoint(url) for url in base_urls]
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.hedge_after = hedge_after
+        self.retries = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+        self._turns = itertools.count()
+        self._pool = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :param settings: (dict) llm_settings or embedding_model_settings, 'base_url' can be a list of urls
+                         and 'timeout', 'max_retries', 'retry_backoff' and 'hedge_after' are optional
+        :return: (LLMProvider) the provider
+        """
+        return cls(base_url=settings.get('base_url'), api_key=settings.get('api_key'),
+                   timeout=settings.get('timeout'), max_retries=settings.get('max_retries', 2),
+                   retry_backoff=settings.get('retry_backoff', 0.5), hedge_after=settings.get('hedge_after'))
+
+    @abstractmethod
+    def create_client(self, base_url, timeout, asynchronous):
+        """
+        :return: (object) sdk client of an endpoint
+        """
+        pass
+
+    def retryable(self, error):
+        """
+        :return: (bool) True if the call which raised the error can be sent again
+        """
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+    def use_client(self, client, asynchronous = False):
+        """
+        Uses an existing sdk client for the first endpoint
+        :return: (LLMProvider) this provider
+        """
+        self.endpoints[0].clients[(asynchronous, self.timeout)] = client
+        return self
+
+    def stats(self):
+        """
+        :return: (dict) retries, hedged calls and per endpoint requests, failures and outstanding requests
+        """
+        with self._lock:
+            return {'retries': self.retries, 'hedges': self.hedges,
+                    'endpoints': [{'base_url': endpoint.base_url, 'requests': endpoint.requests,
+                                   'failures': endpoint.failures, 'outstanding': endpoint.outstanding}
+                                  for endpoint in self.endpoints]}
+
+    def _client(self, endpoint, timeout, asynchronous):
+        key = (asynchronous, timeout)
+        client = endpoint.clients.get(key)
+        if client is None:
+            with self._lock:
+                client = endpoint.clients.get(key)
+                if client is None:
+                    client = self.create_client(endpoint.base_url, timeout, asynchronous)
+                    endpoint.clients[key] = client
+        return client
+
+    def _acquire(self, failed = ()):
+        with self._lock:
+            endpoints = [endpoint for endpoint in self.endpoints if endpoint not in failed] or self.endpoints
+            # healthy endpoints first, then least outstanding requests, ties are taken in turn
+            now = time.monotonic()
+            start = next(self._turns)
+            endpoint = min((endpoints[(start + i) % len(endpoints)] for i in range(len(endpoints))),
+                           key=lambda endpoint: (endpoint.failed_at is not None
+                                                 and now - endpoint.failed_at < self.failure_cooldown,
+                                                 endpoint.outstanding))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _release(self, endpoint, error = None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is not None:
+                endpoint.failures += 1
+                if self.retryable(error):
+                    endpoint.failed_at = time.monotonic()
+
+    def _retry(self, attempt, error):
+        if attempt >= self.max_retries or not self.retryable(error):
+            return False
+        with self._lock:
+            self.retries += 1
+        count(llm_retries=1)
+        return True
+
+    def _backoff(self, attempt):
+        return self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+    def _run(self, endpoint, call, timeout, failed):
+        try:
+            result = call(self._client(endpoint, timeout, False))
+        except BaseException as e:
+            failed.add(endpoint)
+            self._release(endpoint, error=e)
+            raise
+        self._release(endpoint)
+        return result
+
+    def _call(self, call, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        failed = set()
+        for attempt in itertools.count():
+            if attempt:
+                time.sleep(self._backoff(attempt))
+            try:
+                if self.hedge_after is None:
+                    return self._run(self._acquire(failed), call, timeout, failed)
+                return self._hedged(call, timeout, failed)
+            except Exception as e:
+                if not self._retry(attempt, e):
+                    raise
+
+    def _hedged(self, call, timeout, failed):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=64, thread_name_prefix=f'{self.name}-hedge')
+        first = self._acquire(failed)
+        futures = [self._pool.submit(self._run, first, call, timeout, failed)]
+        done, _ = wait(futures, timeout=self.hedge_after)
+        if not done:
+            second = self._acquire(failed | {first})
+            futures.append(self._pool.submit(self._run, second, call, timeout, failed))
+            with self._lock:
+                self.hedges += 1
+            count(llm_hedges=1)
+        error = None
+        pending = futures
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # the slower request finishes in background and its answer is dropped
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _arun(self, endpoint, call, timeout, failed):
+        try:
+            result = await call(self._client(endpoint, timeout, True))
+        except asyncio.CancelledError:
+            # the other request of a hedged call answered first
+            self._release(endpoint)
+            raise
+        except BaseException as e:
+            failed.add(endpoint)
+            self._release(endpoint, error=e)
+            raise
+        self._release(endpoint)
+        return result
+
+    async def _acall(self, call, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        failed = set()
+        for attempt in itertools.count():
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt))
+            try:
+                if self.hedge_after is None:
+                    return await self._arun(self._acquire(failed), call, timeout, failed)
+                return await self._ahedged(call, timeout, failed)
+            except Exception as e:
+                if not self._retry(attempt, e):
+                    raise
+
+    async def _ahedged(self, call, timeout, failed):
+        first = self._acquire(failed)
+        tasks = {asyncio.ensure_future(self._arun(first, call, timeout, failed))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                second = self._acquire(failed | {first})
+                tasks.add(asyncio.ensure_future(self._arun(second, call, timeout, failed)))
+                with self._lock:
+                    self.hedges += 1
+                count(llm_hedges=1)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def chat(self, messages, model, options = None, timeout = None):
+        return self._call(lambda client: self._chat(client, messages, model, options), timeout)
+
+    def embed(self, texts, model, timeout = None):
+        return self._call(lambda client: self._embed(client, texts, model), timeout)
+
+    async def achat(self, messages, model, options = None, timeout = None):
+        return await self._acall(lambda client: self._achat(client, messages, model, options), timeout)
+
+    async def aembed(self, texts, model, timeout = None):
+        return await self._acall(lambda client: self._aembed(client, texts, model), timeout)
+
+    def chat_stream(self, messages, model, options = None, usage = None, timeout = None):
+        # a stream is retried only if it fails before its first chunk, it is never hedged
+        timeout = self.timeout if timeout is None else timeout
+        failed = set()
+        for attempt in itertools.count():
+            if attempt:
+                time.sleep(self._backoff(attempt))
+            endpoint = self._acquire(failed)
+            started = False
+            error = None
+            try:
+                for chunk in self._stream(self._client(endpoint, timeout, False), messages, model, options, usage):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                error = e
+                failed.add(endpoint)
+                if started or not self._retry(attempt, e):
+                    raise
+            finally:
+                self._release(endpoint, error=error)
+
+    async def achat_stream(self, messages, model, options = None, usage = None, timeout = None):
+        timeout = self.timeout if timeout is None else timeout
+        failed = set()
+        for attempt in itertools.count():
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt))
+            endpoint = self._acquire(failed)
+            started = False
+            error = None
+            try:
+                async for chunk in self._astream(self._client(endpoint, timeout, True), messages, model, options,
+                                                 usage):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                error = e
+                failed.add(endpoint)
+                if started or not self._retry(attempt, e):
+                    raise
+            finally:
+                self._release(endpoint, error=error)
+
+    def connect(self):
+        for endpoint in self.endpoints:
+            self._client(endpoint, self.timeout, False)
+
+    def close(self):
+        """
+        Closes the http connections of the sync clients
+        """
+        with self._lock:
+            clients = [client for endpoint in self.endpoints for (asynchronous, _), client in endpoint.clients.items()
+                       if not asynchronous]
+            for endpoint in self.endpoints:
+                endpoint.clients = {key: client for key, client in endpoint.clients.items() if key[0]}
+            pool, self._pool = self._pool, None
+        for client in clients:
+            self._close_client(client)
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    async def aclose(self):
+        """
+        Closes the http connections of the asyncio clients, next asyncio call creates new ones
+        """
+        with self._lock:
+            clients = [client for endpoint in self.endpoints for (asynchronous, _), client in endpoint.clients.items()
+                       if asynchronous]
+            for endpoint in self.endpoints:
+                endpoint.clients = {key: client for key, client in endpoint.clients.items() if not key[0]}
+        for client in clients:
+            await self._aclose_client(client)
+
+    @abstractmethod
+    def _chat(self, client, messages, model, options):
+        pass
+
+    @abstractmethod
+    def _embed(self, client, texts, model):
+        pass
+
+    @abstractmethod
+    def _stream(self, client, messages, model, options, usage):
+        pass
+
+    @abstractmethod
+    async def _achat(self, client, messages, model, options):
+        pass
+
+    @abstractmethod
+    async def _aembed(self, client, texts, model):
+        pass
+
+    @abstractmethod
+    def _astream(self, client, messages, model, options, usage):
+        pass
+
+    @abstractmethod
+    def _close_client(self, client):
+        pass
+
+    @abstractmethod
+    async def _aclose_client(self, client):
+        pass
+
+
+def _embed_endpoint(embed_endpoint):
+    if embed_endpoint not in ('embeddings', 'embed'):
+        raise ValueError(f"Invalid embed endpoint {embed_endpoint!r}. Supported embed endpoints are: embeddings, embed")
+    return embed_endpoint
+
+
+class OllamaProvider(LLMProvider):
+    """
+    Ollama servers, base_url can be a list of replicas
+    """
+
+    # concurrent /api/embeddings requests of one embed call
+    embed_concurrency = 8
+
+    def __init__(self, base_url = None, api_key = None, keep_alive = None, embed_endpoint = 'embeddings', **kwargs):
+        """
+        :param keep_alive: (str or float) how long the model and its prompt cache stay loaded after a call, like '30m'
+                           or -1 for ever, if None then the server default is used
+        :param embed_endpoint: (str) 'embeddings' (default) sends one /api/embeddings request per text, 'embed' sends
+                               all texts in one /api/embed request. /api/embed returns l2 normalized vectors, so they
+                               can not be searched against memories stored with the other endpoint
+        """
+        super().__init__('ollama', base_url=base_url, api_key=api_key, **kwargs)
+        self.keep_alive = keep_alive
+        self.embed_endpoint = _embed_endpoint(embed_endpoint)
+
+    @classmethod
+    def from_settings(cls, settings):
+        provider = super().from_settings(settings)
+        provider.keep_alive = settings.get('keep_alive')
+        provider.embed_endpoint = _embed_endpoint(settings.get('embed_endpoint', 'embeddings'))
+        return provider
+
+    def create_client(self, base_url, timeout, asynchronous):
+        from ollama import Client, AsyncClient
+        with span('client_creation', provider=self.name):
+            return (AsyncClient if asynchronous else Client)(host=base_url, timeout=timeout)
+
+    def retryable(self, error):
+        import httpx
+        from ollama import ResponseError
+        if isinstance(error, ResponseError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, httpx.TransportError) or super().retryable(error)
+
+    def content(self, response):
+        return response['message']['content']
+
+    @staticmethod
+    def usage(response):
+        # prompt_eval_count is the prompt tokens evaluated, the tokens reused from the cache are not reported
+        return {'prompt_tokens': response.get('prompt_eval_count'),
+                'completion_tokens': response.get('eval_count'), 'cached_tokens': None}
+
+    def _chat(self, client, messages, model, options):
+        return client.chat(model=model, messages=messages, options=options or dict(), keep_alive=self.keep_alive)
+
+    def _embed(self, client, texts, model):
+        if self.embed_endpoint == 'embed':
+            return client.embed(model=model, input=texts, keep_alive=self.keep_alive)['embeddings']
+
+        # /api/embeddings takes one prompt, the texts are sent concurrently
+        def embed_one(text):
+            return client.embeddings(model=model, prompt=text, keep_alive=self.keep_alive)['embedding']
+
+        if len(texts) == 1:
+            return [embed_one(texts[0])]
+        with ThreadPoolExecutor(max_workers=min(len(texts), self.embed_concurrency)) as pool:
+            return list(pool.map(embed_one, texts))
+
+    def _stream(self, client, messages, model, options, usage):
+        for chunk in client.chat(model=model, messages=messages, options=options or dict(), stream=True,
+                                 keep_alive=self.keep_alive):
+            content = chunk['message']['content']
+            if content:
+                yield content
+            if usage is not None and chunk.get('done'):
+                usage.update(self.usage(chunk))
+
+    async def _achat(self, client, messages, model, options):
+        return await client.chat(model=model, messages=messages, options=options or dict(),
+                                 keep_alive=self.keep_alive)
+
+    async def _aembed(self, client, texts, model):
+        if self.embed_endpoint == 'embed':
+            return (await client.embed(model=model, input=texts, keep_alive=self.keep_alive))['embeddings']
+        semaphore = asyncio.Semaphore(self.embed_concurrency)
+
+        async def embed_one(text):
+            async with semaphore:
+                return (await client.embeddings(model=model, prompt=text, keep_alive=self.keep_alive))['embedding']
+
+        return list(await asyncio.gather(*(embed_one(text) for text in texts)))
+
+    async def _astream(self, client, messages, model, options, usage):
+        async for chunk in await client.chat(model=model, messages=messages, options=options or dict(), stream=True,
+                                             keep_alive=self.keep_alive):
+            content = chunk['message']['content']
+            if content:
+                yield content
+            if usage is not None and chunk.get('done'):
+                usage.update(self.usage(chunk))
+
+    def _close_client(self, client):
+        # ollama client wraps a httpx client
+        client._client.close()
+
+    async def _aclose_client(self, client):
+        await client._client.aclose()
+
+
+class OpenAIProvider(LLMProvider):
+    """
+    OpenAI or any OpenAI-compatible servers, base_url can be a list of servers of the same models
+    """
+
+    def __init__(self, base_url = None, api_key = None, **kwargs):
+        super().__init__('openai', base_url=base_url, api_key=api_key, **kwargs)
+
+    def create_client(self, base_url, timeout, asynchronous):
+        from openai import OpenAI, AsyncOpenAI
+        extra = {'timeout': timeout} if timeout is not None else dict()
+        with span('client_creation', provider=self.name):
+            # retries are done by the provider, so another endpoint can be tried
+            return (AsyncOpenAI if asynchronous else OpenAI)(base_url=base_url, api_key=self.api_key, max_retries=0,
+                                                            **extra)
+
+    def retryable(self, error):
+        import openai
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code == 429 or error.status_code >= 500
+        return isinstance(error, openai.APIConnectionError) or super().retryable(error)
+
+    def content(self, response):
+        return response.choices[0].message.content
+
+    @staticmethod
+    def usage(response):
+        usage = getattr(response, 'usage', None)
+        if usage is None:
+            return {'prompt_tokens': None, 'completion_tokens': None, 'cached_tokens': None}
+        details = getattr(usage, 'prompt_tokens_details', None)
+        # newer responses have prompt_tokens_details, older sdk versions keep it as a dict
+        if isinstance(details, dict):
+            cached_tokens = details.get('cached_tokens')
+        else:
+            cached_tokens = getattr(details, 'cached_tokens', None)
+        return {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens,
+                'cached_tokens': cached_tokens}
+
+    def _chat(self, client, messages, model, options):
+        return client.chat.completions.create(messages=messages, model=model)
+
+    def _embed(self, client, texts, model):
+        response = client.embeddings.create(input=texts, model=model)
+        return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+    def _stream(self, client, messages, model, options, usage):
+        extra = {'stream_options': {'include_usage': True}} if usage is not None else dict()
+        for chunk in client.chat.completions.create(messages=messages, model=model, stream=True, **extra):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if usage is not None and chunk.usage is not None:
+                usage.update(self.usage(chunk))
+
+    async def _achat(self, client, messages, model, options):
+        return await client.chat.completions.create(messages=messages, model=model)
+
+    async def _aembed(self, client, texts, model):
+        response = await client.embeddings.create(input=texts, model=model)
+        return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+    async def _astream(self, client, messages, model, options, usage):
+        extra = {'stream_options': {'include_usage': True}} if usage is not None else dict()
+        async for chunk in await client.chat.completions.create(messages=messages, model=model, stream=True,
+                                                                **extra):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if usage is not None and chunk.usage is not None:
+                usage.update(self.usage(chunk))
+
+    def _close_client(self, client):
+        client.close()
+
+    async def _aclose_client(self, client):
+        await client.close()
+
+
+_providers = {'ollama': OllamaProvider.from_settings, 'openai': OpenAIProvider.from_settings}
+_providers_lock = threading.Lock()
+
+
+def register_provider(name, factory):
+    """
+    Adds a provider which can be used as 'provider' in llm_settings and embedding_model_settings
+    :param name: (str) name of the provider
+    :param factory: (callable) function of the settings dict returning a CustomLLM, like MyLLM.from_settings
+    """
+    with _providers_lock:
+        _providers[name] = factory
+
+
+def create_provider(settings):
+    """
+    :param settings: (dict) llm_settings or embedding_model_settings
+    :return: (CustomLLM) new provider for the settings
+    """
+    with _providers_lock:
+        factory = _providers.get(settings['provider'])
+        names = ', '.join(sorted(_providers))
+    if factory is None:
+        raise ValueError(f"Invalid provider {settings['provider']!r}. Supported providers are: {names}")
+    return factory(settings)
+
+
+def as_provider(settings, client = None, async_client = None):
+    """
+    :param settings: (dict) llm_settings or embedding_model_settings
+    :param client: (object) a provider, an ollama / openai client or None
+    :param async_client: (object) a provider, an ollama AsyncClient / AsyncOpenAI client or None
+    :return: (CustomLLM) the given provider, or a new provider which uses the given sdk clients
+    """
+    for given in (client, async_client):
+        if isinstance(given, CustomLLM):
+            return given
+    provider = create_provider(settings)
+    if client is not None:
+        provider.use_client(client)
+    if async_client is not None:
+        provider.use_client(async_client, asynchronous=True)
+    return provider
+
+
+def provider_key(settings):
+    """
+    :return: (tuple) the settings which make a provider, equal keys can share one provider
+    """
+    return tuple(repr(settings.get(key)) for key in ('provider', 'base_url', 'api_key', 'timeout', 'max_retries',
+                                                       'retry_backoff', 'hedge_after', 'keep_alive',
+                                                       'embed_endpoint'))
@@ -0,0 +1,176 @@
+import atexit
+import threading
+from collections import Counter
+
+try:
+    from models import run_embedding, write_settings
+    from chroma_handler import push_msgs_to_vector_store
+    from instrumentation import turn, span
+except:
+    from auto_llm_chatbot.models import run_embedding, write_settings
+    from auto_llm_chatbot.chroma_handler import push_msgs_to_vector_store
+    from auto_llm_chatbot.instrumentation import turn, span
+
+
+class WriteBehindQueue:
+    """
+    Background writer for conversation messages, messages are embedded in batches
+    and pushed with one collection.add() per session collection
+    """
+
+    def __init__(self, chroma_client, embedding_model_settings, embedding_client = None,
+                 batch_size = 64, max_delay = 0.05, hooks = None):
+        """
+        :param chroma_client: (object) The chroma client instance or a MemoryBackend
+        :param embedding_model_settings: (dict) dictionary of embeddings models settings
+        :param embedding_client: (object) optional reusable ollama / openai embedding client
+        :param batch_size: (int) max number of messages written in one batch
+        :param max_delay: (float) seconds to wait for more messages before writing a batch
+        :param hooks: (list) optional instrumentation hooks, every batch is reported as a 'write_behind' turn
+        """
+        self.chroma_client = chroma_client
+        self.embedding_model_settings = embedding_model_settings
+        self.embedding_client = embedding_client
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.hooks = hooks
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._cond = threading.Condition()
+        self._pending = list()
+        self._unwritten = Counter()
+        self._urgent = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='auto-llm-chatbot-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, collection_name, unique_session_id, unique_message_id, data, embedding = None):
+        """
+        Queues a message, it is embedded (if embedding is None) and pushed to vector store in background
+        :param collection_name: (str) The name of the collection
+        :param unique_session_id: (str) The unique session
+        :param unique_message_id: (str) The unique message
+        :param data: (str) The message data you want to push to the vector store
+        :param embedding: (list) optional embedding of data
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Write-behind queue is closed')
+            self._pending.append((collection_name, unique_session_id, unique_message_id, data, embedding))
+            self._unwritten[(collection_name, unique_session_id)] += 1
+            self.submitted += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def has_pending(self, collection_name, unique_session_id):
+        """
+        :return: (bool) True if the session has messages which are not written yet
+        """
+        with self._cond:
+            return (collection_name, unique_session_id) in self._unwritten
+
+    def wait_for_session(self, collection_name, unique_session_id, timeout = None):
+        """
+        Blocks until all queued messages of the session are written, so the next turn reads its own writes
+        :return: (bool) False if timeout expired first
+        """
+        key = (collection_name, unique_session_id)
+        with self._cond:
+            if key not in self._unwritten:
+                return True
+            self._urgent = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: key not in self._unwritten, timeout=timeout)
+
+    def flush(self, timeout = None):
+        """
+        Blocks until all queued messages are written
+        :return: (bool) False if timeout expired first
+        """
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._unwritten, timeout=timeout)
+
+    def close(self, timeout = None):
+        """
+        Writes all queued messages and stops the background thread
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        atexit.unregister(self.close)
+
+    def stats(self):
+        """
+        :return: (dict) number of submitted, written and failed messages, written batches and queued messages
+        """
+        with self._cond:
+            return {'submitted': self.submitted, 'written': self.written, 'failed': self.failed,
+                    'batches': self.batches, 'pending': sum(self._unwritten.values())}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                if not self._urgent and not self._closed and len(self._pending) < self.batch_size:
+                    # waiting a little to coalesce more messages in this batch
+                    self._cond.wait(self.max_delay)
+                batch = self._pending[:self.batch_size]
+                self._pending = self._pending[self.batch_size:]
+                if not self._pending:
+                    self._urgent = False
+            written = self._write(batch)
+            with self._cond:
+                for collection_name, unique_session_id, *_ in batch:
+                    key = (collection_name, unique_session_id)
+                    self._unwritten[key] -= 1
+                    if self._unwritten[key] <= 0:
+                        del self._unwritten[key]
+                self.written += written
+                self.failed += len(batch) - written
+                self.batches += 1
+                self._cond.notify_all()
+
+    def _write(self, batch):
+        with turn('write_behind', self.hooks, messages=len(batch)):
+            return self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        try:
+            missing = [data for _, _, _, data, embedding in batch if embedding is None]
+            with span('write_embedding', texts=len(missing)):
+                embedded = dict(zip(missing, run_embedding(
+                    embedding_model_settings=write_settings(self.embedding_model_settings), query=missing,
+                    client=self.embedding_client)))
+        except Exception as e:
+            print(f"ERROR: {e}")
+            return 0
+
+        sessions = dict()
+        counts = Counter()
+        for collection_name, unique_session_id, unique_message_id, data, embedding in batch:
+            counts[(collection_name, unique_session_id)] += 1
+            messages = sessions.setdefault((collection_name, unique_session_id), dict())
+            # chroma rejects duplicate ids in one add, and ignores ids which already exist
+            if unique_message_id not in messages:
+                messages[unique_message_id] = (embedding if embedding is not None else embedded[data], data)
+
+        written = 0
+        for (collection_name, unique_session_id), messages in sessions.items():
+            if push_msgs_to_vector_store(collection_name=collection_name, unique_session_id=unique_session_id,
+                                         unique_message_ids=list(messages),
+                                         chroma_client=self.chroma_client,
+                                         embeddings=[embedding for embedding, _ in messages.values()],
+                                         data=[data for _, data in messages.values()]):
+                written += counts[(collection_name, unique_session_id)]
+        return written
@@ -0,0 +1,170 @@
+"""
+Parity check of the memory backends, it fails (exit status 1) when a backend answers differently from ChromaBackend.
+
+The same add, duplicate add, query, count, is_empty, get, delete and reload cases run against ChromaBackend,
+SharedChromaBackend and NumpyBackend, each in a new directory. Ids, documents and metadata must be equal
+and distances and embeddings equal within --tolerance. The result of every case is reported as JSON.
+
+    python benchmarks/backend_parity.py
+    python benchmarks/backend_parity.py --messages 500 --dim 768
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+COLLECTION = 'parity'
+SESSIONS = ('session-a', 'session-b')
+
+
+def _chroma(path):
+    import chromadb
+    from chromadb.config import Settings
+    return chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+
+
+def _open(name, path):
+    from auto_llm_chatbot.memory_backends import ChromaBackend, SharedChromaBackend, NumpyBackend
+    if name == 'chroma':
+        return ChromaBackend(_chroma(path))
+    if name == 'chroma_shared':
+        return SharedChromaBackend(_chroma(path))
+    return NumpyBackend(path=path)
+
+
+def _reopen(name, path):
+    if name != 'numpy':
+        # chroma keeps one system per path in process, it is dropped so the store is read from disk again
+        from chromadb.api.client import SharedSystemClient
+        SharedSystemClient.clear_system_cache()
+    return _open(name, path)
+
+
+def _data(messages, dim):
+    import numpy as np
+    rng = np.random.default_rng(0)
+    data = dict()
+    for session in SESSIONS:
+        data[session] = {'ids': [f'm{i}' for i in range(messages)],
+                         'embeddings': rng.standard_normal((messages, dim)).astype(np.float32).tolist(),
+                         'documents': [f'{session} message {i}' for i in range(messages)],
+                         'metadatas': [{'role': 'user' if i % 2 else 'assistant', 'turn': i}
+                                       for i in range(messages)]}
+    data['queries'] = rng.standard_normal((3, dim)).astype(np.float32).tolist()
+    return data
+
+
+def _sorted_get(result):
+    # chroma does not promise an order for get, messages are compared by id
+    order = sorted(range(len(result['ids'])), key=lambda i: result['ids'][i])
+    return {'ids': [result['ids'][i] for i in order],
+            'documents': [result['documents'][i] for i in order],
+            # the shared layout stores the session in the metadata of every message
+            'metadatas': [{key: value for key, value in result['metadatas'][i].items() if key != 'unique_session_id'}
+                          for i in order],
+            'embeddings': [[float(value) for value in result['embeddings'][i]] for i in order]}
+
+
+def run_cases(name, path, data, n_results):
+    """
+    Runs the cases against one backend
+    :param name: (str) 'chroma', 'chroma_shared' or 'numpy'
+    :param path: (str) empty directory of the store
+    :param data: (dict) messages per session and query embeddings
+    :param n_results: (int) results per query
+    :return: (dict) answer of the backend per case
+    """
+    backend = _open(name, path)
+    half = len(data[SESSIONS[0]]['ids']) // 2
+    answers = dict()
+
+    def query(case):
+        for session in SESSIONS:
+            answers[f'{case}/{session}'] = backend.query(COLLECTION, session, data['queries'], n_results)
+
+    answers['count_empty'] = backend.count(COLLECTION, SESSIONS[0])
+    answers['is_empty'] = backend.is_empty(COLLECTION, SESSIONS[0])
+    query('query_empty')
+    for session in SESSIONS:
+        batch = data[session]
+        backend.add(COLLECTION, session, batch['ids'][:half], batch['embeddings'][:half],
+                    batch['documents'][:half], batch['metadatas'][:half])
+    answers['count_add'] = [backend.count(COLLECTION, session) for session in SESSIONS]
+    answers['is_empty_add'] = [backend.is_empty(COLLECTION, session) for session in SESSIONS]
+    query('query_add')
+
+    # second add repeats the first half, existing ids are ignored
+    for session in SESSIONS:
+        batch = data[session]
+        backend.add(COLLECTION, session, batch['ids'], batch['embeddings'],
+                    [document + ' duplicate' for document in batch['documents']], batch['metadatas'])
+    answers['count_duplicate'] = [backend.count(COLLECTION, session) for session in SESSIONS]
+    query('query_duplicate')
+    answers['get'] = _sorted_get(backend.get(COLLECTION, SESSIONS[0]))
+
+    deleted = data[SESSIONS[0]]['ids'][::3] + ['missing']
+    backend.delete(COLLECTION, SESSIONS[0], deleted)
+    answers['count_delete'] = [backend.count(COLLECTION, session) for session in SESSIONS]
+    query('query_delete')
+
+    backend = _reopen(name, path)
+    answers['count_reload'] = [backend.count(COLLECTION, session) for session in SESSIONS]
+    query('query_reload')
+    answers['get_reload'] = _sorted_get(backend.get(COLLECTION, SESSIONS[0]))
+    return answers
+
+
+def _differences(expected, actual, tolerance, key = ''):
+    if isinstance(expected, dict):
+        if set(expected) != set(actual):
+            return [f'{key}: keys {sorted(actual)} != {sorted(expected)}']
+        return [difference for name in expected
+                for difference in _differences(expected[name], actual[name], tolerance, f'{key}.{name}')]
+    if isinstance(expected, list):
+        if len(expected) != len(actual):
+            return [f'{key}: {len(actual)} items != {len(expected)}']
+        return [difference for i, (a, b) in enumerate(zip(expected, actual))
+                for difference in _differences(a, b, tolerance, f'{key}[{i}]')]
+    if isinstance(expected, float):
+        if abs(expected - actual) > tolerance * max(1.0, abs(expected)):
+            return [f'{key}: {actual} != {expected}']
+        return []
+    if expected != actual:
+        return [f'{key}: {actual!r} != {expected!r}']
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=60, help='messages per session')
+    parser.add_argument('--dim', type=int, default=32, help='size of embeddings')
+    parser.add_argument('--n-results', type=int, default=5, help='results per query')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='relative tolerance of distances')
+    args = parser.parse_args()
+    # chroma logs every duplicate id and deleted id which does not exist
+    logging.getLogger('chromadb').setLevel(logging.ERROR)
+
+    data = _data(args.messages, args.dim)
+    answers = dict()
+    for name in ('chroma', 'chroma_shared', 'numpy'):
+        with tempfile.TemporaryDirectory(prefix=f'backend_parity_{name}_') as directory:
+            answers[name] = run_cases(name, directory, data, args.n_results)
+
+    results = list()
+    failed = False
+    for name in ('chroma_shared', 'numpy'):
+        for case, expected in answers['chroma'].items():
+            differences = _differences(expected, answers[name][case], args.tolerance)
+            failed = failed or bool(differences)
+            results.append({'backend': name, 'case': case, 'ok': not differences, 'differences': differences[:5]})
+    print(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
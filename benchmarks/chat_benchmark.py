@@ -0,0 +1,263 @@
+"""
+Offline benchmark of auto_llm_chatbot.chatbot.chat() against the local fake Ollama / OpenAI server.
+
+Scenarios cover memory off and on, try_queries off and on, and sessions with a growing history.
+Every scenario runs in a new process and a new directory, so clients, engines and chroma start cold.
+Per scenario it reports p50/p99 turn latency, throughput, prompt and cached tokens per turn, chroma disk growth
+and requests per endpoint, as JSON.
+
+    python benchmarks/chat_benchmark.py --history 0 100 1000 --turns 50 --output results.json
+    python benchmarks/chat_benchmark.py --output new.json --compare results.json
+
+Prompt caching of the servers is simulated with --prefill-latency, with --window the previous turns are sent as
+buffer_window_chats, so prompt layouts can be compared on multi-turn sessions:
+
+    python benchmarks/chat_benchmark.py --memory on --try-queries off --history 100 --window 10 \
+        --prefill-latency 0.0005 --output system.json
+    python benchmarks/chat_benchmark.py --memory on --try-queries off --history 100 --window 10 \
+        --prefill-latency 0.0005 --memory-settings '{"prompt_layout": "stable_prefix"}' --compare system.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SYSTEM_MESSAGE = 'You are a helpful assistant.'
+
+
+def _disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def scenario_name(scenario):
+    if not scenario['memory']:
+        return f"{scenario['provider']}-memory_off"
+    return (f"{scenario['provider']}-memory_on-try_queries_{'on' if scenario['try_queries'] else 'off'}"
+            f"-history_{scenario['history']}")
+
+
+def run_scenario(scenario):
+    """
+    Runs one scenario in the current directory, it is called in the scenario process
+    :param scenario: (dict) provider, url, memory, try_queries, history, turns, window and memory_settings
+    :return: (dict) measurements of the scenario
+    """
+    from auto_llm_chatbot import chatbot
+    from auto_llm_chatbot.instrumentation import CallbackHook, add_hook
+    from auto_llm_chatbot.chroma_handler import push_msgs_to_vector_store
+    from auto_llm_chatbot.models import run_embedding
+
+    base_url = scenario['url'] if scenario['provider'] == 'ollama' else scenario['url'] + '/v1'
+    llm_settings = {'provider': scenario['provider'], 'base_url': base_url, 'model': 'fake-chat',
+                    'options': {}, 'api_key': 'fake'}
+    embedding_model_settings = {'provider': scenario['provider'], 'base_url': base_url, 'model': 'fake-embed',
+                                'api_key': 'fake'}
+    chroma_settings = {'host': None, 'port': None, 'settings': None}
+    memory_settings = {'try_queries': scenario['try_queries'], 'results_per_query': 3,
+                       **scenario.get('memory_settings', {})}
+    collection_name = 'benchmark'
+    unique_session_id = 'session'
+
+    prefill_seconds = 0.0
+    if scenario['memory'] and scenario['history']:
+        # history is written in bulk, it is not part of the measured turns
+        started = time.perf_counter()
+        engine = chatbot.get_engine(llm_settings, chroma_settings, embedding_model_settings, memory_settings)
+        for offset in range(0, scenario['history'], 256):
+            size = min(256, scenario['history'] - offset)
+            documents = [f'user: remember that fact {i} is about topic {i % 50}\nassistant: noted, fact {i}'
+                         for i in range(offset, offset + size)]
+            push_msgs_to_vector_store(collection_name, unique_session_id,
+                                      [f'history{i}' for i in range(offset, offset + size)],
+                                      engine.memory_backend,
+                                      run_embedding(embedding_model_settings, documents,
+                                                    client=engine.embedding_client),
+                                      documents)
+        prefill_seconds = time.perf_counter() - started
+
+    # token counts of the chat turns, ollama reports only the prompt tokens evaluated after its cached prefix
+    tokens = {'prompt_tokens': 0, 'cached_tokens': 0}
+
+    def _count_tokens(record):
+        if record['name'] == 'chat':
+            for name in tokens:
+                tokens[name] += record['counts'].get(name, 0)
+
+    add_hook(CallbackHook(_count_tokens))
+
+    disk_before = _disk_usage('chroma')
+    latencies = list()
+    window = list()
+    started = time.perf_counter()
+    for i in range(scenario['turns']):
+        query = f'What did I tell you earlier about topic {i % 50} and fact {i}?'
+        turn_started = time.perf_counter()
+        response = chatbot.chat(query, SYSTEM_MESSAGE,
+                                llm_settings, chroma_settings, embedding_model_settings, memory_settings,
+                                memory=scenario['memory'], collection_name=collection_name,
+                                unique_session_id=unique_session_id, unique_message_id=f'turn{i}',
+                                buffer_window_chats=window[-2 * scenario.get('window', 0):] or None)
+        latencies.append(time.perf_counter() - turn_started)
+        if not isinstance(response, str):
+            # memory off returns the response of the provider
+            response = chatbot.get_engine(llm_settings, chroma_settings, embedding_model_settings,
+                                          memory_settings).llm_client.content(response)
+        window += [{'role': 'user', 'content': query}, {'role': 'assistant', 'content': response}]
+    if scenario['memory']:
+        chatbot.get_engine(llm_settings, chroma_settings, embedding_model_settings, memory_settings).flush()
+    seconds = time.perf_counter() - started
+    disk_after = _disk_usage('chroma')
+
+    # first turn creates the clients and opens chroma, it is reported on its own
+    warm = latencies[1:] or latencies
+    return {
+        'name': scenario_name(scenario),
+        'provider': scenario['provider'],
+        'memory': scenario['memory'],
+        'try_queries': scenario['try_queries'],
+        'history': scenario['history'],
+        'turns': scenario['turns'],
+        'window': scenario.get('window', 0),
+        'prefill_seconds': round(prefill_seconds, 3),
+        'first_turn_ms': round(latencies[0] * 1000, 3),
+        'p50_ms': round(_percentile(warm, 50) * 1000, 3),
+        'p99_ms': round(_percentile(warm, 99) * 1000, 3),
+        'mean_ms': round(sum(warm) / len(warm) * 1000, 3),
+        'turns_per_second': round(len(latencies) / seconds, 2),
+        'prompt_tokens_per_turn': round(tokens['prompt_tokens'] / len(latencies), 1),
+        'cached_tokens_per_turn': round(tokens['cached_tokens'] / len(latencies), 1),
+        'disk_bytes_before': disk_before,
+        'disk_bytes_after': disk_after,
+        'disk_growth_bytes': disk_after - disk_before,
+        'disk_growth_bytes_per_turn': round((disk_after - disk_before) / len(latencies), 1),
+    }
+
+
+def scenarios(args, url):
+    for provider in args.providers:
+        if 'off' in args.memory:
+            yield {'provider': provider, 'url': url, 'memory': False, 'try_queries': False, 'history': 0,
+                   'turns': args.turns, 'window': args.window}
+        if 'on' in args.memory:
+            for try_queries in args.try_queries:
+                for history in args.history:
+                    yield {'provider': provider, 'url': url, 'memory': True, 'try_queries': try_queries == 'on',
+                           'history': history, 'turns': args.turns, 'window': args.window,
+                           'memory_settings': args.memory_settings}
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """
+    Prints the change of latency and throughput of every scenario against a baseline report
+    """
+    old = {result['name']: result for result in baseline['results']}
+    print(f"{'scenario':<55} {'p50':>9} {'p99':>9} {'turns/s':>9}", file=sys.stderr)
+    for result in report['results']:
+        if result['name'] not in old:
+            continue
+        before = old[result['name']]
+        print(f"{result['name']:<55} "
+              f"{(result['p50_ms'] / before['p50_ms'] - 1) * 100:>+8.1f}% "
+              f"{(result['p99_ms'] / before['p99_ms'] - 1) * 100:>+8.1f}% "
+              f"{(result['turns_per_second'] / before['turns_per_second'] - 1) * 100:>+8.1f}%", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--providers', nargs='+', default=['ollama'], choices=['ollama', 'openai'])
+    parser.add_argument('--memory', nargs='+', default=['off', 'on'], choices=['off', 'on'])
+    parser.add_argument('--try-queries', nargs='+', default=['off', 'on'], choices=['off', 'on'])
+    parser.add_argument('--history', type=int, nargs='+', default=[0, 100, 1000],
+                        help='number of messages already in the session')
+    parser.add_argument('--turns', type=int, default=50, help='measured turns per scenario')
+    parser.add_argument('--window', type=int, default=0, help='previous turns sent as buffer_window_chats')
+    parser.add_argument('--memory-settings', type=json.loads, default={},
+                        help='extra memory_settings as JSON, like \'{"write_behind": true}\'')
+    parser.add_argument('--chat-latency', type=float, default=0.02, help='seconds per chat request')
+    parser.add_argument('--embed-latency', type=float, default=0.005, help='seconds per embedding request')
+    parser.add_argument('--dim', type=int, default=384, help='size of embeddings')
+    parser.add_argument('--prefill-latency', type=float, default=0.0,
+                        help='seconds per prompt token which is not in the prefix cache of the server')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    parser.add_argument('--compare', default=None, help='JSON report of an earlier run to compare with')
+    parser.add_argument('--run-scenario', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario is not None:
+        print(json.dumps(run_scenario(json.loads(args.run_scenario))))
+        return
+
+    from benchmarks.fake_servers import FakeServer
+
+    server = FakeServer(chat_latency=args.chat_latency, embed_latency=args.embed_latency, dim=args.dim,
+                        prefill_latency=args.prefill_latency).start()
+    env = dict(os.environ, ANONYMIZED_TELEMETRY='False')
+    results = list()
+    try:
+        for scenario in scenarios(args, server.url):
+            before = server.stats()
+            server.clear_cache()
+            with tempfile.TemporaryDirectory(prefix='chat_benchmark_') as directory:
+                process = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                          '--run-scenario', json.dumps(scenario)],
+                                         cwd=directory, env=env, capture_output=True, text=True)
+            if process.returncode != 0:
+                print(process.stderr, file=sys.stderr)
+                raise RuntimeError(f'scenario {scenario_name(scenario)} failed')
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            after = server.stats()
+            result['requests'] = {path: after[path] - before.get(path, 0) for path in after
+                                  if after[path] != before.get(path, 0)}
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    finally:
+        server.stop()
+
+    report = {
+        'commit': _commit(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'chat_latency': args.chat_latency, 'embed_latency': args.embed_latency, 'dim': args.dim,
+                   'prefill_latency': args.prefill_latency, 'turns': args.turns, 'window': args.window,
+                   'memory_settings': args.memory_settings},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
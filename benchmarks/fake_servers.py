@@ -0,0 +1,274 @@
+"""
+Local stand-in for Ollama and OpenAI servers, used by the benchmarks so they run offline.
+
+It speaks the Ollama /api/chat, /api/embeddings and /api/embed protocols and the OpenAI /v1/chat/completions
+and /v1/embeddings protocols, with and without streaming. Chat answers echo the user message and embeddings
+are deterministic vectors derived from the text, so runs are repeatable. Latency is configurable per endpoint kind.
+Chat prompts go through a prefix cache like the KV cache of Ollama and the prompt caching of OpenAI, only the tokens
+after the longest prefix shared with a recent prompt of the same model are prefilled, and usage reports them.
+
+    python benchmarks/fake_servers.py --port 11434 --chat-latency 0.05
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def fake_embedding(text, dim = 384):
+    """
+    :param text: (str) the text
+    :param dim: (int) size of the vector
+    :return: (list) unit vector seeded by the sha256 of the text, same text always gives same vector
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def _answer(messages):
+    if 'first principle' in messages[0]['content']:
+        # query refinement prompt of chroma_handler.create_queries
+        last = messages[-1]['content']
+        return json.dumps([f'what did the user say about {last[:40]}', f'earlier conversation on {last[:40]}'])
+    return 'echo: ' + messages[-1]['content']
+
+
+def _prompt_tokens(messages):
+    # words of the messages, every message starts with a token of its role like in chat templates
+    tokens = list()
+    for message in messages:
+        tokens.append(f"<{message['role']}>")
+        tokens.extend(message['content'].split())
+    return tokens
+
+
+def _shared_prefix(tokens, other):
+    size = 0
+    for a, b in zip(tokens, other):
+        if a != b:
+            break
+        size += 1
+    return size
+
+
+class FakeServer:
+    """
+    Threaded http server answering like Ollama and OpenAI (under /v1), start() runs it in a daemon thread
+    """
+
+    def __init__(self, host = '127.0.0.1', port = 0, chat_latency = 0.0, token_latency = 0.0,
+                 embed_latency = 0.0, dim = 384, prefill_latency = 0.0, cache_slots = 8):
+        """
+        :param host: (str) host to listen on
+        :param port: (int) port to listen on, 0 picks a free port
+        :param chat_latency: (float) seconds before a chat answer (or its first streamed chunk)
+        :param token_latency: (float) seconds between streamed chunks
+        :param embed_latency: (float) seconds per embedding request
+        :param dim: (int) size of embeddings
+        :param prefill_latency: (float) seconds per prompt token which is not in the prefix cache
+        :param cache_slots: (int) recent prompts kept in the prefix cache of each model
+        """
+        self.chat_latency = chat_latency
+        self.token_latency = token_latency
+        self.embed_latency = embed_latency
+        self.dim = dim
+        self.prefill_latency = prefill_latency
+        self.requests = Counter()
+        self._prompts = defaultdict(lambda: deque(maxlen=cache_slots))
+        self._lock = threading.Lock()
+        ThreadingHTTPServer.request_queue_size = 1024
+        self.httpd = ThreadingHTTPServer((host, port), _handler(self))
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake-llm-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        """
+        :return: (dict) number of requests per path
+        """
+        with self._lock:
+            return dict(self.requests)
+
+    def _count(self, path):
+        with self._lock:
+            self.requests[path] += 1
+
+    def clear_cache(self):
+        """
+        Empties the prefix cache, like a restart of the server
+        """
+        with self._lock:
+            self._prompts.clear()
+
+    def prefill(self, model, messages):
+        """
+        Looks up the prompt in the prefix cache of the model and sleeps for the tokens which are not cached
+        :param model: (str) the model
+        :param messages: (list) chat messages in openai format
+        :return: (int, int) prompt tokens and cached prompt tokens
+        """
+        tokens = _prompt_tokens(messages)
+        with self._lock:
+            prompts = self._prompts[model]
+            # a prompt is never served fully from the cache, its last token is evaluated again
+            cached = min(max((_shared_prefix(tokens, prompt) for prompt in prompts), default=0), len(tokens) - 1)
+            prompts.append(tokens)
+        time.sleep(self.prefill_latency * (len(tokens) - cached))
+        return len(tokens), cached
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # headers and body are written separately, without this small answers wait for delayed acks
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            # ollama client checks the server version on some calls
+            self._json({'version': '0.3.2'} if self.path == '/api/version' else {'models': []})
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            try:
+                body = json.loads(raw)
+            except ValueError:
+                body = None
+            if not body:
+                # cancelled request of a client which is closing
+                self.close_connection = True
+                return
+            server._count(self.path)
+            if self.path == '/api/chat':
+                self._ollama_chat(body)
+            elif self.path == '/api/embeddings':
+                time.sleep(server.embed_latency)
+                self._json({'embedding': fake_embedding(body['prompt'], server.dim)})
+            elif self.path == '/api/embed':
+                time.sleep(server.embed_latency)
+                texts = [body['input']] if isinstance(body['input'], str) else body['input']
+                self._json({'model': body['model'], 'embeddings': [fake_embedding(text, server.dim)
+                                                                   for text in texts]})
+            elif self.path == '/v1/chat/completions':
+                self._openai_chat(body)
+            elif self.path == '/v1/embeddings':
+                time.sleep(server.embed_latency)
+                texts = [body['input']] if isinstance(body['input'], str) else body['input']
+                self._json({'object': 'list', 'model': body['model'],
+                            'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, server.dim)}
+                                     for i, text in enumerate(texts)],
+                            'usage': {'prompt_tokens': len(texts), 'total_tokens': len(texts)}})
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        def _ollama_chat(self, body):
+            content = _answer(body['messages'])
+            prompt_tokens, cached_tokens = server.prefill(body['model'], body['messages'])
+            # like ollama, prompt_eval_count counts only the tokens evaluated after the cached prefix
+            done = {'model': body['model'], 'message': {'role': 'assistant', 'content': ''}, 'done': True,
+                    'prompt_eval_count': prompt_tokens - cached_tokens, 'eval_count': len(content.split())}
+            time.sleep(server.chat_latency)
+            if not body.get('stream'):
+                done['message']['content'] = content
+                self._json(done)
+                return
+            self._start_stream('application/x-ndjson')
+            for word in _words(content):
+                self._chunk(json.dumps({'model': body['model'], 'message': {'role': 'assistant', 'content': word},
+                                        'done': False}) + '\n')
+                time.sleep(server.token_latency)
+            self._chunk(json.dumps(done) + '\n')
+            self._chunk('')
+
+        def _openai_chat(self, body):
+            content = _answer(body['messages'])
+            prompt_tokens, cached_tokens = server.prefill(body['model'], body['messages'])
+            usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content.split()),
+                     'total_tokens': prompt_tokens + len(content.split()),
+                     'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+            time.sleep(server.chat_latency)
+            if not body.get('stream'):
+                self._json({'id': 'fake', 'object': 'chat.completion', 'created': int(time.time()),
+                            'model': body['model'],
+                            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                                         'finish_reason': 'stop'}],
+                            'usage': usage})
+                return
+            self._start_stream('text/event-stream')
+            chunk = {'id': 'fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': body['model']}
+            for word in _words(content):
+                self._chunk('data: ' + json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {'content': word},
+                                                                         'finish_reason': None}]}) + '\n\n')
+                time.sleep(server.token_latency)
+            if (body.get('stream_options') or {}).get('include_usage'):
+                self._chunk('data: ' + json.dumps({**chunk, 'choices': [], 'usage': usage}) + '\n\n')
+            self._chunk('data: [DONE]\n\n')
+            self._chunk('')
+
+        def _json(self, response):
+            data = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _start_stream(self, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+        def _chunk(self, text):
+            data = text.encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    return Handler
+
+
+def _words(content):
+    words = content.split(' ')
+    return [word + ' ' for word in words[:-1]] + words[-1:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11434)
+    parser.add_argument('--chat-latency', type=float, default=0.0)
+    parser.add_argument('--token-latency', type=float, default=0.0)
+    parser.add_argument('--embed-latency', type=float, default=0.0)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--prefill-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeServer(host=args.host, port=args.port, chat_latency=args.chat_latency,
+                      token_latency=args.token_latency, embed_latency=args.embed_latency, dim=args.dim,
+                      prefill_latency=args.prefill_latency)
+    print(f'Serving ollama on {fake.url} and openai on {fake.url}/v1')
+    try:
+        fake.httpd.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,74 @@
+"""
+Import time check of the package, it fails (exit status 1) when an import is over its budget
+or loads a heavy dependency which must stay lazy.
+
+Each statement runs `python -X importtime` in a new process, the best of --repeats runs is reported as JSON.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --budget-ms 150 --repeats 10
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# statement, modules which must not be imported by it
+CHECKS = [
+    ('import auto_llm_chatbot', ('chromadb', 'ollama', 'openai', 'numpy', 'lazyme', 'tqdm')),
+    ('from auto_llm_chatbot import chat', ('chromadb', 'ollama', 'openai', 'numpy', 'lazyme', 'tqdm')),
+    ('from auto_llm_chatbot.chatbot import ChatEngine', ('chromadb', 'ollama', 'openai', 'numpy', 'lazyme', 'tqdm')),
+]
+
+_line = re.compile(r'^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(\S+)\s*$')
+
+
+def _importtime(statement):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT, env=env,
+                             capture_output=True, text=True, check=True)
+    modules = dict()
+    for line in process.stderr.splitlines():
+        match = _line.match(line)
+        if match is not None:
+            modules[match.group(3)] = int(match.group(1))
+    return modules
+
+
+def measure(statement, startup):
+    """
+    :param statement: (str) import statement
+    :param startup: (set) modules imported by the interpreter itself
+    :return: (float, set) milliseconds spent in the modules imported by the statement and their names
+    """
+    modules = _importtime(statement)
+    # self times, so nested imports are counted once however they are reached
+    return sum(micros for module, micros in modules.items() if module not in startup) / 1000, set(modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=150.0, help='max milliseconds of each import statement')
+    parser.add_argument('--repeats', type=int, default=5, help='runs per statement, the fastest one counts')
+    args = parser.parse_args()
+
+    startup = set(_importtime('pass'))
+    results = list()
+    failed = False
+    for statement, forbidden in CHECKS:
+        runs = [measure(statement, startup) for _ in range(args.repeats)]
+        milliseconds = round(min(run[0] for run in runs), 3)
+        loaded = sorted(module for module in forbidden if module in runs[0][1])
+        ok = milliseconds <= args.budget_ms and not loaded
+        failed = failed or not ok
+        results.append({'statement': statement, 'milliseconds': milliseconds, 'budget_ms': args.budget_ms,
+                        'heavy_modules_loaded': loaded, 'ok': ok})
+    print(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
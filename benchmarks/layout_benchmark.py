@@ -0,0 +1,128 @@
+"""
+Compares the chroma storage layouts of auto_llm_chatbot, one collection per session ('chroma') and one
+shared collection filtered by session metadata ('chroma_shared').
+
+    python benchmarks/layout_benchmark.py --sessions 10000 100000 --output layouts.json
+
+For every layout and session count it reports load time, disk usage, client start up time,
+time to first query and query latency (p50/p99) of random sessions, as JSON.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import chromadb
+from chromadb.api.client import SharedSystemClient
+from chromadb.config import Settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from auto_llm_chatbot.memory_backends import create_backend
+
+
+def _client(path):
+    return chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+
+
+def _disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def _vector(rng, dim):
+    return [rng.random() for _ in range(dim)]
+
+
+def run_layout(layout, sessions, messages_per_session, dim, queries, results_per_query, path, seed=0):
+    """
+    :return: (dict) the measurements of one layout
+    """
+    rng = random.Random(seed)
+    backend = create_backend({'backend': layout}, chroma_client=_client(path))
+    started = time.perf_counter()
+    for session in range(sessions):
+        unique_session_id = f'session{session}'
+        backend.add('conversation', unique_session_id,
+                    unique_message_ids=[f'message{i}' for i in range(messages_per_session)],
+                    embeddings=[_vector(rng, dim) for _ in range(messages_per_session)],
+                    documents=[f'{unique_session_id} message {i}' for i in range(messages_per_session)],
+                    metadatas=[{'collection_name': 'conversation', 'unique_session_id': unique_session_id,
+                                'unique_message_id': f'message{i}'} for i in range(messages_per_session)])
+    load_seconds = time.perf_counter() - started
+    del backend
+
+    # opening the existing store as a new process would, chroma caches clients by path
+    SharedSystemClient.clear_system_cache()
+    started = time.perf_counter()
+    backend = create_backend({'backend': layout}, chroma_client=_client(path))
+    startup_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    backend.query('conversation', 'session0', [_vector(rng, dim)], results_per_query)
+    first_query_seconds = time.perf_counter() - started
+
+    latencies = list()
+    for _ in range(queries):
+        unique_session_id = f'session{rng.randrange(sessions)}'
+        started = time.perf_counter()
+        results = backend.query('conversation', unique_session_id, [_vector(rng, dim)], results_per_query)
+        latencies.append(time.perf_counter() - started)
+        assert all(document.startswith(f'{unique_session_id} ') for document in results['documents'][0])
+
+    return {
+        'layout': layout,
+        'sessions': sessions,
+        'messages': sessions * messages_per_session,
+        'load_seconds': round(load_seconds, 3),
+        'load_messages_per_second': round(sessions * messages_per_session / load_seconds, 1),
+        'disk_bytes': _disk_usage(path),
+        'startup_seconds': round(startup_seconds, 4),
+        'first_query_seconds': round(first_query_seconds, 4),
+        'query_p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+        'query_p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--layouts', nargs='+', default=['chroma', 'chroma_shared'])
+    parser.add_argument('--messages-per-session', type=int, default=4)
+    parser.add_argument('--dim', type=int, default=64)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--results-per-query', type=int, default=3)
+    parser.add_argument('--path', default=None, help='directory for the chroma stores, temporary if not given')
+    parser.add_argument('--output', default=None, help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    base_path = args.path or tempfile.mkdtemp(prefix='layout_benchmark_')
+    report = list()
+    try:
+        for sessions in args.sessions:
+            for layout in args.layouts:
+                path = os.path.join(base_path, f'{layout}-{sessions}')
+                shutil.rmtree(path, ignore_errors=True)
+                result = run_layout(layout, sessions, args.messages_per_session, args.dim, args.queries,
+                                    args.results_per_query, path)
+                print(json.dumps(result), file=sys.stderr)
+                report.append(result)
+    finally:
+        if args.path is None:
+            shutil.rmtree(base_path, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))